@@ -1,7 +1,7 @@
 # DeepLearnUtils 
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
-import io,json
+import io,json,zlib
 from urllib.request import Request, urlopen
 from urllib.parse import urlencode
 
@@ -39,12 +39,27 @@ class InferenceClient(object):
          
         return imread(io.BytesIO(req.read())) # return image read from response byte stream
     
-    def inferImageVolume(self,name,vol,**kwargs):
-        '''Apply inferrence on the given image volume with shape XYZT with the named container on the server.'''
-        out=np.zeros_like(vol)
+    def inferImageVolume(self,name,vol,compress=True,**kwargs):
+        '''
+        Apply inferrence on the given image volume with shape XYZT with the named container on the server. The volume 
+        is sent in one request to the /infervolume route as .npy data, compressed with zlib if `compress' is True.
+        '''
+        stream=io.BytesIO()
+        np.save(stream,np.asarray(vol),allow_pickle=False) # encode volume as npy
+        data=stream.getvalue()
+        headers={'Content-Type':'application/octet-stream'}
+        
+        if compress:
+            data=zlib.compress(data)
+            headers['Content-Encoding']='deflate'
+            
+        fullurl='%s/infervolume/%s?%s'%(self.url,name,urlencode(kwargs))
+        
+        r=Request(fullurl,headers=headers,data=data) # post volume data
+        req=urlopen(r)
+        data=req.read()
         
-        for ind in np.ndindex(*vol.shape[2:]):
-            ind=(slice(None),slice(None))+ind
-            out[ind]=self.inferImage(name,vol[ind],**kwargs)
+        if req.headers.get('Content-Encoding')=='deflate':
+            data=zlib.decompress(data)
             
-        return out
+        return np.load(io.BytesIO(data),allow_pickle=False) # return volume read from response byte stream
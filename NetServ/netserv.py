@@ -28,6 +28,17 @@ def getContainerMap():
     
 This echo object would be accessed through URL path /inferpng/echo. 
 
+The route /infervolume/<name> applies a container to every 2D slice of a volume in one request. The volume is POSTed
+as the bytes of a .npy file (see numpy.save) of shape XY[Z[T...]], optionally compressed with zlib or gzip as given by
+the Content-Encoding header, and the result volume is sent back as .npy bytes encoded the same way. The XY slices are
+given to the container's inferBatch() in batches of its maxBatchSize. The result volume has the shape of the first 
+result slice followed by the Z[T...] dimensions of the input.
+
+Concurrent requests to the same container are grouped into batches by a BatchScheduler which calls the container's 
+inferBatch() method with up to `maxBatchSize' images at once, waiting at most the --maxdelay time for a batch to fill. 
+Containers override inferBatch() to apply their network to a whole batch in one forward pass. Each container is only
+used by one thread at a time, so the infer() and inferBatch() methods need not be thread-safe.
+
 A running server can be tested with an input image "input.png" as such:
     
     curl -X POST --data-binary "@input.png" -H "Content-Type:image/png" localhost:5000/inferimg/echo -o output.png
@@ -38,7 +49,8 @@ or using forms as such:
 
 '''
 from __future__ import division, print_function
-import io, argparse, ast, logging, importlib.util
+import io, argparse, ast, logging, importlib.util, threading, time, zlib, gzip
+from concurrent.futures import Future
 
 from flask import Flask, request, send_file, jsonify
 
@@ -48,16 +60,97 @@ from imageio import imwrite, imread
 
 
 class InferenceContainer(object):
-    def __init__(self,name,description,inputMap,outputMap,argMap):
+    def __init__(self,name,description,inputMap,outputMap,argMap,maxBatchSize=1):
         self.name=name
         self.description=description
         self.inputMap=inputMap
         self.outputMap=outputMap
         self.argMap=argMap
+        self.maxBatchSize=maxBatchSize
         
     def infer(self,*inputMatrices,**kwargs):
         pass
     
+    def inferBatch(self,inputs,**kwargs):
+        '''
+        Apply inference to the list of input images `inputs' with the same arguments, returning a list of results. By 
+        default this calls infer() for each, containers with `maxBatchSize' above 1 should override this to stack inputs
+        into batches for their network (if inputs differ in shape they must be grouped or padded).
+        '''
+        return [self.infer(inp,**kwargs) for inp in inputs]
+    
+    
+class BatchScheduler(object):
+    '''
+    Groups concurrent inference requests for container `container' into batches. Each call to submit() from a request 
+    thread queues its image and blocks until the result is available. A scheduling thread takes queued requests with
+    the same arguments, waiting up to `maxDelay' seconds after the first arrives for the batch to reach the container's
+    maxBatchSize, then applies inferBatch() to the batch and returns the results to the waiting requests. Containers 
+    with a maxBatchSize of 1 have each request applied alone. Calls to inferBatch() are made while holding `inferLock',
+    other code using the container from request threads must hold it too so that the container is never used 
+    concurrently.
+    '''
+    def __init__(self,container,maxDelay=0.01):
+        self.container=container
+        self.maxDelay=maxDelay
+        self.inferLock=threading.Lock()
+        self.pending=[] # list of (argument key, image, arguments, future) tuples in arrival order
+        self.cond=threading.Condition()
+        self.thread=threading.Thread(target=self._scheduleThread,daemon=True)
+        self.thread.start()
+        
+    def submit(self,img,**kwargs):
+        '''Queue `img' for inference with arguments `kwargs' and return the result once its batch has been applied.'''
+        future=Future()
+        
+        with self.cond:
+            self.pending.append((repr(sorted(kwargs.items())),img,kwargs,future))
+            self.cond.notify()
+            
+        return future.result()
+    
+    def _takeBatch(self):
+        '''Wait for a batch of requests with matching arguments to fill or for its deadline, then remove and return it.'''
+        maxBatchSize=max(1,self.container.maxBatchSize)
+        
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            
+            key=self.pending[0][0]
+            deadline=time.monotonic()+self.maxDelay
+            
+            while True:
+                batch=[p for p in self.pending if p[0]==key][:maxBatchSize]
+                remaining=deadline-time.monotonic()
+                
+                if len(batch)==maxBatchSize or remaining<=0:
+                    break
+                
+                self.cond.wait(remaining)
+                
+            self.pending=[p for p in self.pending if not any(p is b for b in batch)]
+            
+        return batch
+    
+    def _scheduleThread(self):
+        while True:
+            batch=self._takeBatch()
+            
+            try:
+                with self.inferLock:
+                    results=self.container.inferBatch([b[1] for b in batch],**batch[0][2])
+                
+                if len(results)!=len(batch):
+                    raise ValueError('inferBatch() returned %i results for %i inputs'%(len(results),len(batch)))
+                
+                for b,result in zip(batch,results):
+                    b[3].set_result(result)
+            except Exception as e:
+                for b in batch:
+                    if not b[3].done():
+                        b[3].set_exception(e)
+    
     
 class EchoContainer(InferenceContainer):
     def __init__(self):
@@ -69,11 +162,23 @@ class EchoContainer(InferenceContainer):
 
 app = Flask(__name__)
 containers={ 'echo': EchoContainer() }
+schedulers={}
+schedulerLock=threading.Lock()
+maxBatchDelay=0.01
+
+
+def getScheduler(name):
+    '''Returns the BatchScheduler for the named container, creating it if necessary.'''
+    with schedulerLock:
+        if name not in schedulers:
+            schedulers[name]=BatchScheduler(containers[name],maxBatchDelay)
+            
+        return schedulers[name]
 
 
 @app.route('/')
 def directory():
-    return jsonify(['/list','/info/<name>','/inferimg/<name>'])
+    return jsonify(['/list','/info/<name>','/inferimg/<name>','/infervolume/<name>'])
 
 
 @app.route('/list')
@@ -107,7 +212,7 @@ def inferimg(name):
     imgmat=imread(io.BytesIO(data)) # read posted image file to matrix
     logging.info('infer(): %r %r %r %r %r %r'%(name,imgmat.shape,imgmat.dtype,imgmat.min(),imgmat.max(),args))
 
-    result=obj.infer(imgmat,**args) # apply inference
+    result=getScheduler(name).submit(imgmat,**args) # apply inference, as part of a batch if the container allows
     
     stream=io.BytesIO()
     imwrite(stream,result,format='png') # save result to png file stream
@@ -116,13 +221,84 @@ def inferimg(name):
     return send_file(stream,'image/png') # respond with stream
 
 
+def decodeArray(data,encoding=None):
+    '''Load the array from .npy file bytes `data', decompressing these first if `encoding' is "deflate" or "gzip".'''
+    if encoding=='deflate':
+        data=zlib.decompress(data)
+    elif encoding=='gzip':
+        data=gzip.decompress(data)
+    elif encoding:
+        raise ValueError('Unsupported encoding %r'%(encoding,))
+        
+    return np.load(io.BytesIO(data),allow_pickle=False)
+
+
+def encodeArray(arr,encoding=None):
+    '''Returns the .npy file bytes for `arr', compressed if `encoding' is "deflate" or "gzip".'''
+    stream=io.BytesIO()
+    np.save(stream,arr,allow_pickle=False)
+    data=stream.getvalue()
+    
+    if encoding=='deflate':
+        data=zlib.compress(data)
+    elif encoding=='gzip':
+        data=gzip.compress(data)
+        
+    return data
+
+
+@app.route('/infervolume/<name>', methods=['POST'])
+def infervolume(name):
+    obj=containers[name]
+    args={k:ast.literal_eval(v) for k,v in request.args.items()} # keep only one value per argument name
+    encoding=request.headers.get('Content-Encoding')
+    
+    data=request.data or request.files['in'].read() # read posted data or a form file called 'in'
+    vol=decodeArray(data,encoding)
+    
+    if vol.ndim<2 or vol.size==0:
+        return jsonify({'error':'Volume must have at least 2 dimensions and be non-empty, got shape %r'%(vol.shape,)}),400
+    
+    logging.info('infervolume(): %r %r %r %r %r %r'%(name,vol.shape,vol.dtype,vol.min(),vol.max(),args))
+    
+    indices=list(np.ndindex(*vol.shape[2:]))
+    batchSize=max(1,obj.maxBatchSize)
+    scheduler=getScheduler(name)
+    out=None
+    
+    for i in range(0,len(indices),batchSize):
+        batchIndices=indices[i:i+batchSize]
+        
+        with scheduler.inferLock: # prevent concurrent use of the container with the scheduler
+            results=obj.inferBatch([vol[(slice(None),slice(None))+ind] for ind in batchIndices],**args)
+            
+        if len(results)!=len(batchIndices):
+            raise ValueError('inferBatch() returned %i results for %i inputs'%(len(results),len(batchIndices)))
+        
+        if out is None: # result slices have the shape and type of the first, followed by the volume's slice dimensions
+            out=np.zeros(results[0].shape+vol.shape[2:],results[0].dtype)
+        
+        for ind,result in zip(batchIndices,results):
+            out[(Ellipsis,)+ind]=result
+            
+    response=app.response_class(encodeArray(out,encoding),mimetype='application/octet-stream')
+    
+    if encoding:
+        response.headers['Content-Encoding']=encoding
+        
+    return response
+
+
 if __name__=='__main__':
     parser=argparse.ArgumentParser('netserv.py',description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('scripts',help='Script files to import as modules for initialization',nargs='*')
     parser.add_argument('--host',help='Server host address',default='0.0.0.0')
     parser.add_argument('--port',help='Post to listen on',type=int,default=5000)
+    parser.add_argument('--maxdelay',help='Maximum time in seconds to wait for a batch to fill',type=float,default=0.01)
     args=parser.parse_args()
     
+    maxBatchDelay=args.maxdelay
+    
     for i,script in enumerate(args.scripts):
         # load script as module
         spec=importlib.util.spec_from_file_location("initmod%i"%i, script)
@@ -133,6 +309,6 @@ if __name__=='__main__':
         containers.update({c.name:c for c in mod.getContainers()})
         
     logging.info('Running server with networks %r'%(list(containers.keys()),))
-    app.run(host=args.host,port=args.port)
+    app.run(host=args.host,port=args.port,threaded=True) # requests must be handled concurrently to be batched
     
    
\ No newline at end of file
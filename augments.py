@@ -2,10 +2,11 @@
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
 from __future__ import division, print_function
-from functools import partial,wraps
+from functools import partial,wraps,lru_cache
+import threading
 import numpy as np
 import scipy.ndimage
-import scipy.fftpack as ft
+import scipy.fft as ft
 
 import trainutils
         
@@ -22,22 +23,26 @@ def augment(prob=0.5,applyIndices=None):
     is applied to is given the list of input arrays as positional arguments and then should return a callable operation
     which performs the augmentation. This wrapper then chooses whether to apply the operation to the arguments and if so
     to which ones. The `prob' argument states the probability the augment is applied, and `applyIndices' gives indices of
-    the arrays to apply to (or None for all). The arguments are also keyword arguments in the resulting augment function.
+    the arrays to apply to (or None for all). The arguments are also keyword arguments in the resulting augment function,
+    as is `rng' which is a np.random.Generator to draw random values from (via trainutils.getRandom()) in place of the
+    current thread's generator or the global np.random state. A batch form of the augment can be added with the
+    `batchaugment' decorator and is then stored as its `batch' member, similarly an affine form of a geometric augment can
+    be added with `affineaugment' and is stored as `affine'.
     '''
     def _inner(func):
         @wraps(func)
         def _func(*args,**kwargs):
             _prob=kwargs.pop('prob',prob)
-            
-            if _prob<1.0 and not trainutils.randChoice(_prob):
-                return args
-            
             _applyIndices=kwargs.pop('applyIndices',applyIndices)
             
-            op=func(*args,**kwargs)
-            indices=list(_applyIndices or range(len(args)))
-            
-            return tuple((op(im) if i in indices else im) for i,im in enumerate(args))
+            with trainutils.useRandom(kwargs.pop('rng',None)):
+                if _prob<1.0 and not trainutils.randChoice(_prob):
+                    return args
+                
+                op=func(*args,**kwargs)
+                indices=list(_applyIndices or range(len(args)))
+                
+                return tuple((op(im) if i in indices else im) for i,im in enumerate(args))
         
         if _func.__doc__:
             _func.__doc__+='''
@@ -45,19 +50,149 @@ def augment(prob=0.5,applyIndices=None):
 Added keyword arguments:
     prob: probability of applying this augment (default: 0.5)
     applyIndices: indices of arrays to apply augment to (default: None meaning all)
+    rng: np.random.Generator to draw random values from (default: None meaning the current thread's generator)
 '''        
+        _func.prob=prob
+        _func.applyIndices=applyIndices
+        _func.batch=None
+        _func.affine=None
+        return _func
+    
+    return _inner
+
+
+def batchaugment(aug):
+    '''
+    Creates the batch form of augment `aug' when applied to a function returning an array modifying callable. This works
+    like `augment' except the input arrays have a leading batch dimension, the function this is applied to should choose
+    random parameters for each item in the batch and return a callable applying these to a whole batch array at once.
+    The probability `prob' is applied to each batch item independently, only the chosen items are passed to the function
+    and replaced in the results. The same `prob' and `applyIndices' defaults and keyword arguments as `aug' are used, as
+    is the `rng' keyword argument. The resulting function is assigned to `aug.batch' which pipelines use in place of
+    calling `aug' for each batch item.
+    '''
+    def _inner(func):
+        @wraps(func)
+        def _func(*args,**kwargs):
+            with trainutils.useRandom(kwargs.pop('rng',None)):
+                return _apply(*args,**kwargs)
+            
+        def _apply(*args,**kwargs):
+            _prob=kwargs.pop('prob',aug.prob)
+            _applyIndices=kwargs.pop('applyIndices',aug.applyIndices)
+            batchSize=args[0].shape[0]
+            
+            if _prob<1.0:
+                selected=np.flatnonzero(trainutils.getRandom().random(batchSize)<=_prob)
+                if selected.shape[0]==0:
+                    return args
+            else:
+                selected=np.arange(batchSize)
+            
+            isAll=selected.shape[0]==batchSize
+            subargs=args if isAll else tuple(a[selected] for a in args)
+            
+            op=func(*subargs,**kwargs)
+            indices=list(_applyIndices or range(len(args)))
+            
+            def _applyOp(arr,subarr):
+                result=op(subarr)
+                if isAll:
+                    return result
+                
+                out=arr.astype(np.result_type(arr.dtype,result.dtype)) # copy of the batch with unchosen items unchanged
+                out[selected]=result
+                return out
+                
+            return tuple((_applyOp(im,subim) if i in indices else im) for i,(im,subim) in enumerate(zip(args,subargs)))
+        
+        aug.batch=_func
         return _func
     
     return _inner
 
 
+def affineaugment(aug):
+    '''
+    Defines the affine form of geometric augment `aug' when applied to a function returning transform matrices. The
+    function is given the same batch arrays and keyword arguments as a batch form and returns a (B,3,3) array with a
+    homogeneous matrix for each batch item. Each matrix maps output coordinates of axes 1 and 2 of the batch arrays to
+    the input coordinates to sample from, both relative to the array center. The function is assigned to `aug.affine'
+    which fuseAffineAugments() uses to compose consecutive geometric augments into a single resampling operation.
+    '''
+    def _inner(func):
+        aug.affine=func
+        return func
+    
+    return _inner
+
+
+def identityMatrices(count):
+    '''Returns a (`count',3,3) array of identity matrices.'''
+    return np.tile(np.eye(3),(count,1,1))
+
+
+def getBatchAugment(aug):
+    '''Returns the batch form of augment `aug', which may be a partial object wrapping an augment, or None if it has none.'''
+    if isinstance(aug,partial):
+        batch=getBatchAugment(aug.func)
+        return batch and partial(batch,*aug.args,**aug.keywords)
+    
+    return getattr(aug,'batch',None)
+
+
+def applyAugmentsBatch(augs,*arrays,rng=None):
+    '''
+    Apply the augments `augs' in order to the batch arrays `arrays', returning the tuple of augmented batch arrays. Augments
+    with batch forms are applied to the whole batch at once, runs of augments without are applied to each item in turn.
+    If `rng' is given this np.random.Generator is used by the augments for random values.
+    '''
+    with trainutils.useRandom(rng):
+        return _applyAugmentsBatch(augs,arrays)
+    
+    
+def _applyAugmentsBatch(augs,arrays):
+    batchSize=arrays[0].shape[0]
+    itemAugs=[]
+    
+    def _applyItems(arrays):
+        items=[]
+        for i in range(batchSize):
+            item=[a[i] for a in arrays]
+            for aug in itemAugs:
+                item=aug(*item)
+                
+            items.append(item)
+            
+        return tuple(map(np.stack,zip(*items)))
+    
+    for aug in augs:
+        batchAug=getBatchAugment(aug)
+        
+        if batchAug is None:
+            itemAugs.append(aug)
+        else:
+            if itemAugs:
+                arrays=_applyItems(arrays)
+                itemAugs=[]
+                
+            arrays=batchAug(*arrays)
+            
+    if itemAugs:
+        arrays=_applyItems(arrays)
+            
+    return tuple(arrays)
+
+
 def checkSegmentMargin(func):
     '''
     Decorate an augment callable `func` with a check to ensure a given segmentation image in the set does not
     touch the margins of the image when geometric transformations are applied. The keyword arguments `margin`,
     `maxCount` and `nonzeroIndex` are used to check the image at index `nonzeroIndex` has the given margin of
     pixels around its edges, trying `maxCount` number of times to get a modifier by calling `func` before 
-    giving up and producing a identity modifier in its place. 
+    giving up and producing a identity modifier in its place. If the modifier has a `transformPoints` member, a callable
+    mapping a (N,2) array of input indices to output indices, this is used to check where the extreme points of the
+    segmentation land rather than applying the modifier to the segmentation itself.
     '''
     @wraps(func)
     def _check(*args,**kwargs):
@@ -65,6 +200,7 @@ def checkSegmentMargin(func):
         maxCount=max(1,kwargs.pop('maxCount',5))
         nonzeroIndex=kwargs.pop('nonzeroIndex',-1)
         acceptedOutput=False
+        points=None
         
         while maxCount>0 and not acceptedOutput:
             op=func(*args,**kwargs)
@@ -72,6 +208,11 @@ def checkSegmentMargin(func):
             
             if nonzeroIndex==-1:
                 acceptedOutput=True
+            elif hasattr(op,'transformPoints'):
+                if points is None: # the segmentation's points are calculated once for all attempts
+                    points=trainutils.nonzeroExtremePoints(args[nonzeroIndex])
+                    
+                acceptedOutput=trainutils.pointsInMargins(op.transformPoints(points),args[nonzeroIndex].shape,margin)
             else:
                 seg=op(args[nonzeroIndex]).astype(np.int32)
                 acceptedOutput=trainutils.zeroMargins(seg,margin)
@@ -82,6 +223,62 @@ def checkSegmentMargin(func):
         return op
     
     return _check
+
+
+def checkSegmentMarginBatch(func):
+    '''
+    Batch form of `checkSegmentMargin' for decorating batch augment callables. The segmentation at index `nonzeroIndex`
+    is checked for each batch item and `func` is called again only for those items failing the margin check, items which
+    still fail after `maxCount` attempts are left unmodified. If the modifier has a `transformItemPoints` member, a 
+    callable mapping a batch item index and (N,2) array of input indices to output indices, this is used to check where
+    the extreme points of each item's segmentation land rather than applying the modifier to the segmentations.
+    '''
+    @wraps(func)
+    def _check(*args,**kwargs):
+        margin=max(1,kwargs.pop('margin',5))
+        maxCount=max(1,kwargs.pop('maxCount',5))
+        nonzeroIndex=kwargs.pop('nonzeroIndex',-1)
+        
+        if nonzeroIndex==-1:
+            return func(*args,**kwargs)
+        
+        remaining=np.arange(args[0].shape[0])
+        accepted=[] # list of (indices,op,selection) with the items of `indices' chosen by `selection' accepted for `op'
+        points={} # batch index -> extreme points of that item's segmentation, calculated once for all attempts
+        segShape=args[nonzeroIndex].shape[1:]
+        
+        while maxCount>0 and remaining.shape[0]>0:
+            subargs=tuple(a[remaining] for a in args)
+            op=func(*subargs,**kwargs)
+            maxCount-=1
+            
+            if hasattr(op,'transformItemPoints'):
+                selection=np.zeros(remaining.shape[0],bool)
+                
+                for i,index in enumerate(remaining):
+                    if index not in points:
+                        points[index]=trainutils.nonzeroExtremePoints(args[nonzeroIndex][index])
+                        
+                    selection[i]=trainutils.pointsInMargins(op.transformItemPoints(i,points[index]),segShape,margin)
+            else:
+                segs=op(subargs[nonzeroIndex]).astype(np.int32)
+                selection=np.array([trainutils.zeroMargins(seg,margin) for seg in segs],bool)
+            
+            accepted.append((remaining,op,selection))
+            remaining=remaining[~selection]
+            
+        def _op(arr):
+            results=[(inds[sel],op(arr[inds])[sel]) for inds,op,sel in accepted if np.any(sel)]
+            out=arr.astype(np.result_type(arr.dtype,*[r.dtype for _,r in results]))
+            
+            for inds,result in results:
+                out[inds]=result
+                
+            return out
+                
+        return _op
+    
+    return _check
             
 
 @augment()
@@ -90,16 +287,57 @@ def transpose(*arrs):
     return partial(np.swapaxes,axis1=0,axis2=1)
 
 
+@batchaugment(transpose)
+def transposeBatch(*arrs):
+    '''Batch form of transpose(), swapping axes 1 and 2 of each of `arrs'.'''
+    return partial(np.swapaxes,axis1=1,axis2=2)
+
+
 @augment()
 def flip(*arrs):
     '''Flip each of `arrs' with a random choice of up-down or left-right.'''
     return np.fliplr if trainutils.randChoice() else np.flipud
 
 
+@batchaugment(flip)
+def flipBatch(*arrs):
+    '''Batch form of flip(), choosing up-down or left-right for each batch item.'''
+    rng=trainutils.getRandom()
+    lr=rng.random(arrs[0].shape[0])<=0.5
+    
+    def _flip(im):
+        out=np.empty_like(im)
+        out[lr]=im[lr,:,::-1]
+        out[~lr]=im[~lr,::-1]
+        return out
+    
+    return _flip
+
+
 @augment()
 def rot90(*arrs):
     '''Rotate each of `arrs' a random choice of quarter, half, or three-quarter circle rotations.'''
-    return partial(np.rot90,k=np.random.randint(1,3))
+    rng=trainutils.getRandom()
+    return partial(np.rot90,k=rng.integers(1,3))
+
+
+@batchaugment(rot90)
+def rot90Batch(*arrs):
+    '''Batch form of rot90(), choosing the rotation for each batch item.'''
+    rng=trainutils.getRandom()
+    quarter=rng.integers(1,3,arrs[0].shape[0])==1
+    
+    def _rot90(im):
+        if np.all(quarter):
+            return np.rot90(im,1,axes=(1,2))
+        
+        out=np.rot90(im,2,axes=(1,2)).copy()
+        if np.any(quarter):
+            out[quarter]=np.rot90(im[quarter],1,axes=(1,2))
+            
+        return out
+    
+    return _rot90
         
 
 @augment(prob=1.0)
@@ -108,6 +346,12 @@ def normalize(*arrs):
     return trainutils.rescaleArray
 
 
+@batchaugment(normalize)
+def normalizeBatch(*arrs):
+    '''Batch form of normalize(), normalizing each batch item independently.'''
+    return trainutils.rescaleInstanceArray
+
+
 @augment(prob=1.0)
 def randPatch(*arrs,patchSize=(32,32)):
     '''Randomly choose a patch from `arrs' of dimensions `patchSize'.'''
@@ -115,8 +359,9 @@ def randPatch(*arrs,patchSize=(32,32)):
     
     def _randPatch():
         h,w=im.shape[:2]
-        ry=np.random.randint(0,h-ph)
-        rx=np.random.randint(0,w-pw)
+        rng=trainutils.getRandom()
+        ry=rng.integers(0,h-ph)
+        rx=rng.integers(0,w-pw)
             
         return im[ry:ry+ph,rx:rx+pw]
     
@@ -129,8 +374,9 @@ def shift(*arrs,dimFract=2,order=3):
     '''Shift arrays randomly by `dimfract' fractions of the array dimensions.'''
     testim=arrs[0]
     x,y=testim.shape[:2]
-    shiftx=np.random.randint(-x//dimFract,x//dimFract)
-    shifty=np.random.randint(-y//dimFract,y//dimFract)
+    rng=trainutils.getRandom()
+    shiftx=rng.integers(-x//dimFract,x//dimFract)
+    shifty=rng.integers(-y//dimFract,y//dimFract)
     
     def _shift(im):
         h,w=im.shape[:2]
@@ -140,39 +386,128 @@ def shift(*arrs,dimFract=2,order=3):
         dest[destslices]=im[srcslices]
         
         return dest
+    
+    _shift.transformPoints=lambda points:points-(shiftx,shifty)
             
     return _shift
 
 
+@batchaugment(shift)
+@checkSegmentMarginBatch
+def shiftBatch(*arrs,dimFract=2,order=3):
+    '''Batch form of shift(), shifting each batch item by its own random amount.'''
+    b,x,y=arrs[0].shape[:3]
+    rng=trainutils.getRandom()
+    shiftx=rng.integers(-x//dimFract,x//dimFract,b)
+    shifty=rng.integers(-y//dimFract,y//dimFract,b)
+    
+    def _shift(im):
+        h,w=im.shape[1:3]
+        rows=np.arange(h)[None]+shiftx[:,None] # source row for each destination row of each item
+        cols=np.arange(w)[None]+shifty[:,None]
+        valid=((rows>=0)&(rows<h))[:,:,None]&((cols>=0)&(cols<w))[:,None,:]
+        
+        inds=np.arange(im.shape[0])[:,None,None]
+        dest=im[inds,np.clip(rows,0,h-1)[:,:,None],np.clip(cols,0,w-1)[:,None,:]]
+        dest[~valid]=0
+        
+        return dest
+    
+    _shift.transformItemPoints=lambda i,points:points-(shiftx[i],shifty[i])
+    
+    return _shift
+
+
+@affineaugment(shift)
+def shiftAffine(*arrs,dimFract=2,order=3):
+    '''Affine form of shift(), producing a translation for each batch item.'''
+    b,x,y=arrs[0].shape[:3]
+    
+    mats=identityMatrices(b)
+    rng=trainutils.getRandom()
+    mats[:,0,2]=rng.integers(-x//dimFract,x//dimFract,b)
+    mats[:,1,2]=rng.integers(-y//dimFract,y//dimFract,b)
+    
+    return mats
+
+
 @augment()
 @checkSegmentMargin
 def rotate(*arrs):
     '''Shift arrays randomly around the array center.'''
     
-    angle=np.random.random()*360
+    rng=trainutils.getRandom()
+    angle=rng.random()*360
     
     def _rotate(im):
         return scipy.ndimage.rotate(im,angle=angle,reshape=False)
     
+    def _transformPoints(points):
+        center=(np.asarray(arrs[0].shape[:2])-1)/2.0
+        c,s=np.cos(np.deg2rad(angle)),np.sin(np.deg2rad(angle))
+        return (points-center).dot(np.array([[c,s],[-s,c]]))+center # inverse of the rotation used by ndimage.rotate
+    
+    _rotate.transformPoints=_transformPoints
+    
     return _rotate
 
 
+@affineaugment(rotate)
+def rotateAffine(*arrs):
+    '''Affine form of rotate(), producing a rotation around the array center for each batch item.'''
+    rng=trainutils.getRandom()
+    angles=rng.random(arrs[0].shape[0])*360
+    c,s=np.cos(np.deg2rad(angles)),np.sin(np.deg2rad(angles))
+    
+    mats=identityMatrices(angles.shape[0])
+    mats[:,0,0]=c
+    mats[:,0,1]=s
+    mats[:,1,0]=-s
+    mats[:,1,1]=c
+    
+    return mats
+
+
 @augment()
 @checkSegmentMargin
 def zoom(*arrs,zoomrange=0.2):
     '''Return the image/mask pair zoomed by a random amount with the mask kept within `margin' pixels of the edges.'''
     
-    z=zoomrange-np.random.random()*zoomrange*2
-    zx=z+1.0+zoomrange*0.25-np.random.random()*zoomrange*0.5
-    zy=z+1.0+zoomrange*0.25-np.random.random()*zoomrange*0.5
+    rng=trainutils.getRandom()
+    z=zoomrange-rng.random()*zoomrange*2
+    zx=z+1.0+zoomrange*0.25-rng.random()*zoomrange*0.5
+    zy=z+1.0+zoomrange*0.25-rng.random()*zoomrange*0.5
         
     def _zoom(im):
         ztemp=scipy.ndimage.zoom(im,(zx,zy)+tuple(1 for _ in range(2,im.ndim)),order=2)
         return trainutils.resizeCenter(ztemp,*im.shape)
+    
+    def _transformPoints(points):
+        dims=np.asarray(arrs[0].shape[:2])
+        zdims=np.round(dims*(zx,zy)).astype(int) # dimensions of the zoomed array before resizeCenter
+        return points*(zdims-1)/np.maximum(1,dims-1)+dims//2-zdims//2
+    
+    _zoom.transformPoints=_transformPoints
             
     return _zoom
 
 
+@affineaugment(zoom)
+def zoomAffine(*arrs,zoomrange=0.2):
+    '''Affine form of zoom(), producing a scaling around the array center for each batch item.'''
+    b=arrs[0].shape[0]
+    rng=trainutils.getRandom()
+    z=zoomrange-rng.random(b)*zoomrange*2
+    zx=z+1.0+zoomrange*0.25-rng.random(b)*zoomrange*0.5
+    zy=z+1.0+zoomrange*0.25-rng.random(b)*zoomrange*0.5
+    
+    mats=identityMatrices(b)
+    mats[:,0,0]=1.0/zx
+    mats[:,1,1]=1.0/zy
+    
+    return mats
+
+
 @augment()
 @checkSegmentMargin
 def rotateZoomPIL(*arrs,margin=5,minFract=0.5,maxFract=2,resample=0):
@@ -182,9 +517,10 @@ def rotateZoomPIL(*arrs,margin=5,minFract=0.5,maxFract=2,resample=0):
     testim=arrs[0]
     x,y=testim.shape[:2]
     
-    angle=np.random.random()*360
-    zoomx=x+np.random.randint(-x*minFract,x*maxFract)
-    zoomy=y+np.random.randint(-y*minFract,y*maxFract)
+    rng=trainutils.getRandom()
+    angle=rng.random()*360
+    zoomx=x+rng.integers(-x*minFract,x*maxFract)
+    zoomy=y+rng.integers(-y*minFract,y*maxFract)
     
     filters=(Image.NEAREST,Image.LINEAR,Image.BICUBIC)
     
@@ -211,60 +547,330 @@ def rotateZoomPIL(*arrs,margin=5,minFract=0.5,maxFract=2,resample=0):
     return _trans
 
   
-@augment()
-def deformPIL(*arrs,defrange=25,numControls=3,margin=2,mapOrder=1):
-    '''Deforms arrays randomly with a deformation grid of size `numControls'**2 with `margins' grid values fixed.'''
-    assert pilAvailable,'PIL (pillow) not installed'
+def _bicubic(x,a=-0.5):
+    x=np.abs(x)
+    near=((a+2)*x-(a+3))*x*x+1
+    far=(((x-5)*x+8)*x-4)*a
+    return np.where(x<1,near,np.where(x<2,far,0))
+
+
+@lru_cache(maxsize=32)
+def bicubicResizeMatrix(inSize,outSize):
+    '''
+    Returns the (`outSize',`inSize') matrix resizing a 1D array of length `inSize' to `outSize' with the same bicubic
+    weights PIL uses, so that resizing a 2D array `arr' is `matrix(h,H).dot(arr).dot(matrix(w,W).T)'.
+    '''
+    scale=inSize/outSize
+    filterscale=max(scale,1.0)
+    support=2.0*filterscale
+    mat=np.zeros((outSize,inSize))
     
-    h,w = arrs[0].shape[:2]
+    for i in range(outSize):
+        center=(i+0.5)*scale
+        xmin=max(0,int(center-support+0.5))
+        xmax=min(inSize,int(center+support+0.5))
+        weights=_bicubic((np.arange(xmin,xmax)-center+0.5)/filterscale)
+        mat[i,xmin:xmax]=weights/weights.sum()
+        
+    return mat
+
+
+@lru_cache(maxsize=32)
+def indexGrid(h,w):
+    '''Returns the cached (2,`h',`w') array of indices for a `h'x`w' image, this must not be modified.'''
+    grid=np.indices((h,w),dtype=np.float64)
+    grid.flags.writeable=False
+    return grid
+
+
+def deformField(h,w,defrange=25,numControls=3,margin=2):
+    '''
+    Returns a (2,`h',`w') array of coordinates for a random deformation of a `h'x`w' image, this is a control grid of
+    `numControls'**2 random shifts within `defrange' with a fixed border of `margin' zero shifts upsampled to full size
+    and added to the index grid.
+    '''
+    size=numControls+margin*2
+    imshift=np.zeros((2,size,size))
+    rng=trainutils.getRandom()
+    imshift[:,margin:-margin,margin:-margin]=rng.integers(-defrange,defrange,(2,numControls,numControls))
     
-    imshift=np.zeros((2,numControls+margin*2,numControls+margin*2))
-    imshift[:,margin:-margin,margin:-margin]=np.random.randint(-defrange,defrange,(2,numControls,numControls))
+    rowmat=bicubicResizeMatrix(size,h)
+    colmat=bicubicResizeMatrix(size,w)
+    
+    return indexGrid(h,w)+np.matmul(np.matmul(rowmat,imshift),colmat.T)
+
 
-    imshiftx=np.array(Image.fromarray(imshift[0]).resize((w,h),Image.QUAD))
-    imshifty=np.array(Image.fromarray(imshift[1]).resize((w,h),Image.QUAD))
+class DeformFieldPool(object):
+    '''
+    Pool of pregenerated deformation fields from deformField() for reuse across epochs. The first `poolSize' requests
+    for a given image shape generate new fields, after which a random stored field is returned for each request.
+    '''
+    def __init__(self,poolSize,defrange=25,numControls=3,margin=2):
+        self.poolSize=poolSize
+        self.defrange=defrange
+        self.numControls=numControls
+        self.margin=margin
+        self.fields={}
+        self.lock=threading.Lock()
+        
+    def getField(self,h,w):
+        with self.lock:
+            fields=self.fields.setdefault((h,w),[])
+            
+            if len(fields)<self.poolSize:
+                fields.append(deformField(h,w,self.defrange,self.numControls,self.margin))
+                return fields[-1]
+            
+        rng=trainutils.getRandom()
+        return fields[rng.integers(len(fields))]
+        
+        
+def mapField(im,field,order=1):
+    '''
+    Map the array `im' with the coordinates `field' from deformField() over its first 2 dimensions, with further axes
+    treated as channels and points outside the image taking the value 0. For orders 0 and 1 all channels are sampled at
+    once using the same indices and weights, higher orders use scipy.ndimage.map_coordinates for each channel.
+    '''
+    h,w=im.shape[:2]
+    channels=im.reshape(h,w,-1)
+    
+    if order>1:
+        result=np.stack([scipy.ndimage.map_coordinates(channels[...,c],field,order=order,mode='constant') 
+                         for c in range(channels.shape[2])],2)
+        return result.reshape(im.shape)
+    
+    # like map_coordinates with mode='constant', coordinates outside [0,n-1] in either dimension produce zeros
+    valid=((field[0]>=0)&(field[0]<=h-1)&(field[1]>=0)&(field[1]<=w-1)).ravel()[:,None]
+    flat=channels.reshape(-1,channels.shape[2]).astype(np.result_type(im.dtype,np.float32))
+    
+    if order==0:
+        rows=np.clip(np.floor(field[0]+0.5).astype(int),0,h-1)
+        cols=np.clip(np.floor(field[1]+0.5).astype(int),0,w-1)
+        result=flat[(rows*w+cols).ravel()]
+    else:
+        row0=np.clip(np.floor(field[0]),0,h-1)
+        col0=np.clip(np.floor(field[1]),0,w-1)
+        fr=np.clip(field[0]-row0,0,1).ravel()[:,None]
+        fc=np.clip(field[1]-col0,0,1).ravel()[:,None]
+        rows=row0.astype(int)
+        cols=col0.astype(int)
+        rows1=np.minimum(rows+1,h-1)
+        cols1=np.minimum(cols+1,w-1)
+        
+        result=flat[(rows*w+cols).ravel()]*((1-fr)*(1-fc))
+        result+=flat[(rows*w+cols1).ravel()]*((1-fr)*fc)
+        result+=flat[(rows1*w+cols).ravel()]*(fr*(1-fc))
+        result+=flat[(rows1*w+cols1).ravel()]*(fr*fc)
         
-    y,x=np.meshgrid(np.arange(w), np.arange(h))
-    indices=np.reshape(x+imshiftx, (-1, 1)),np.reshape(y+imshifty, (-1, 1))
+        if np.issubdtype(im.dtype,np.integer):
+            result=np.rint(result)
+            
+    result*=valid
+        
+    return result.astype(im.dtype).reshape(im.shape)
+
+
+@augment()
+def deformPIL(*arrs,defrange=25,numControls=3,margin=2,mapOrder=1,fieldPool=None):
+    '''
+    Deforms arrays randomly with a deformation grid of size `numControls'**2 with `margins' grid values fixed. If given,
+    `fieldPool' is a DeformFieldPool to draw the deformation from instead of generating a new one, this overrides the
+    other deformation arguments. PIL is no longer needed since the grid upsampling is done by matrix multiplication.
+    '''
+    h,w = arrs[0].shape[:2]
+    
+    if fieldPool is not None:
+        field=fieldPool.getField(h,w)
+    else:
+        field=deformField(h,w,defrange,numControls,margin)
 
     def _mapChannels(im):
-        if im.ndim==2:
-            result=scipy.ndimage.map_coordinates(im,indices, order=mapOrder, mode='constant')
-            result=result.reshape(im.shape)
-        else:
-            result=np.dstack([_mapChannels(im[...,i]) for i in range(im.shape[-1])])
-            
-        return result
+        return mapField(im,field,mapOrder)
     
     return _mapChannels
 
 
+@lru_cache(maxsize=32)
+def radialProbField(h,w):
+    '''Returns the cached (`h',`w') array of distances from the center in normalized coordinates, this must not be modified.'''
+    x,y=np.meshgrid(np.linspace(-1,1,h),np.linspace(-1,1,w),indexing='ij')
+    probfield=np.sqrt(x**2+y**2)
+    probfield.flags.writeable=False
+    return probfield
+
+
+def fftDropout(arr,dropout,axes=(0,1),workers=None):
+    '''
+    Apply the boolean k-space `dropout' mask to `arr' with one FFT over the spatial `axes', the mask is broadcast over
+    the remaining axes so every channel (and batch item if `dropout' is per item) is transformed in the same call. The
+    `workers' value is passed to scipy.fft to parallelize over the planes of `arr', the default None uses one thread
+    since augments are usually run in multiple worker threads or processes already.
+    '''
+    result=ft.fft2(arr,axes=axes,workers=workers)
+    result=ft.fftshift(result,axes=axes)
+    result*=dropout
+    result=ft.ifft2(result,axes=axes,overwrite_x=True,workers=workers)
+    return np.abs(result)
+
+
 @augment()
-def distortFFT(*arrs,minDist=0.1,maxDist=1.0):
+def distortFFT(*arrs,minDist=0.1,maxDist=1.0,workers=None):
     '''Distorts arrays by applying dropout in k-space with a per-pixel probability based on distance from center.'''
     h,w=arrs[0].shape[:2]
-
-    x,y=np.meshgrid(np.linspace(-1,1,h),np.linspace(-1,1,w))
-    probfield=np.sqrt(x**2+y**2)
     
-    if arrs[0].ndim==3:
-        probfield=np.repeat(probfield[...,np.newaxis],arrs[0].shape[2],2)
+    rng=trainutils.getRandom()
+    dropout=rng.uniform(minDist,maxDist,(h,w))>radialProbField(h,w)
+
+    def _distort(im):
+        mask=dropout.reshape(dropout.shape+(1,)*(im.ndim-2)) # apply the same dropout to every channel
+        return fftDropout(im,mask,(0,1),workers)
     
-    dropout=np.random.uniform(minDist,maxDist,arrs[0].shape)>probfield
+    return _distort
+
 
+@batchaugment(distortFFT)
+def distortFFTBatch(*arrs,minDist=0.1,maxDist=1.0,workers=None):
+    '''Batch form of distortFFT(), transforming every batch item and channel with one FFT over the spatial axes.'''
+    b,h,w=arrs[0].shape[:3]
+    
+    rng=trainutils.getRandom()
+    dropout=rng.uniform(minDist,maxDist,(b,h,w))>radialProbField(h,w)
+    
     def _distort(im):
-        if im.ndim==2:
-            result=ft.fft2(im)
-            result=ft.fftshift(result)
-            result=result*dropout[:,:,0]
-            result=ft.ifft2(result)
-            result=np.abs(result)
+        mask=dropout.reshape(dropout.shape+(1,)*(im.ndim-3))
+        return fftDropout(im,mask,(1,2),workers)
+    
+    return _distort
+
+
+def affineResample(arr,mats,order=3,mode='constant',cval=0.0):
+    '''
+    Resample each item of batch array `arr' with its matrix from `mats' as produced by affine augment forms, mapping the
+    output coordinates of axes 1 and 2 relative to the array center to input coordinates. Each 2D plane of each item is
+    interpolated once with spline order `order', other axes are left unchanged. The result has the dtype of `arr'.
+    '''
+    b,h,w=arr.shape[:3]
+    center=np.array([(h-1)/2.0,(w-1)/2.0])
+    planes=np.moveaxis(arr.reshape(b,h,w,-1),3,1) # BCHW view of the array with all channel axes flattened to C
+    out=np.empty(planes.shape,arr.dtype)
+    
+    for i in range(b):
+        mat=mats[i,:2,:2]
+        offset=center+mats[i,:2,2]-mat.dot(center)
+        
+        for c in range(planes.shape[1]):
+            scipy.ndimage.affine_transform(planes[i,c],mat,offset,output=out[i,c],order=order,mode=mode,cval=cval)
+            
+    return np.moveaxis(out,1,3).reshape(arr.shape)
+
+
+def fuseAffineAugments(augs,orders=None,mode='constant',cval=0.0):
+    '''
+    Returns a copy of the augment list `augs' with each run of consecutive augments having affine forms (eg. rotate, zoom,
+    and shift, or partial objects of these) replaced by a single augment. This composes the transforms of the run into
+    one matrix per item and resamples each array once with affineResample(), avoiding the cost and blurring of repeated
+    interpolation. The `orders' sequence gives the spline order for each array, eg. (3,0) for an image/segmentation pair,
+    the last value is used for arrays beyond its length and the default is 3. The `prob' value of each augment in the run
+    is applied to its transform independently, augments given `applyIndices' cannot be fused and are left as they are.
+    If any augment in a run is given `nonzeroIndex' the margin check of `checkSegmentMargin' is applied to the composed
+    transform using the largest `margin' and `maxCount' values given.
+    '''
+    orders=tuple(orders or (3,))
+    result=[]
+    run=[]
+    
+    def _fuseRun(run):
+        components=[]
+        check={}
+        
+        for affine,prob,kwargs in run:
+            kwargs=dict(kwargs)
+            margin=kwargs.pop('margin',5)
+            maxCount=kwargs.pop('maxCount',5)
+            nonzeroIndex=kwargs.pop('nonzeroIndex',-1)
+            components.append((affine,prob,kwargs))
+            
+            if nonzeroIndex!=-1:
+                check['nonzeroIndex']=nonzeroIndex
+                check['margin']=max(margin,check.get('margin',1))
+                check['maxCount']=max(maxCount,check.get('maxCount',1))
+                
+        return fusedAffineAugment(components,orders,mode,cval,**check)
+    
+    for aug in augs:
+        func,kwargs=(aug.func,dict(aug.keywords)) if isinstance(aug,partial) and not aug.args else (aug,{})
+        affine=getattr(func,'affine',None)
+        prob=kwargs.pop('prob',getattr(func,'prob',1.0))
+        applyIndices=kwargs.pop('applyIndices',getattr(func,'applyIndices',None))
+        
+        if affine is not None and applyIndices is None:
+            run.append((affine,prob,kwargs))
         else:
-            result=np.dstack([_distort(im[...,i]) for i in range(im.shape[-1])])
+            if run:
+                result.append(_fuseRun(run))
+                run=[]
+                
+            result.append(aug)
+            
+    if run:
+        result.append(_fuseRun(run))
+        
+    return result
+
+
+def fusedAffineAugment(components,orders=(3,),mode='constant',cval=0.0,nonzeroIndex=-1,margin=5,maxCount=5):
+    '''
+    Returns an augment applying the composed transforms of `components', a list of (affine form, probability, keyword
+    arguments) triples, with one affineResample() call per array using the spline order for that array from `orders'.
+    The returned augment applies to single items and has a batch form, see fuseAffineAugments() for details.
+    '''
+    def _getMatrices(arrs):
+        b=arrs[0].shape[0]
+        mats=identityMatrices(b)
+        rng=trainutils.getRandom()
+        
+        for affine,prob,kwargs in components:
+            chosen=rng.random(b)<=prob
+            if np.any(chosen):
+                # compose with earlier transforms, output coordinates are mapped through later transforms first
+                mats[chosen]=np.matmul(mats[chosen],affine(*arrs,**kwargs)[chosen])
+                
+        return mats
+    
+    def _fusedBatch(*arrs,rng=None):
+        with trainutils.useRandom(rng):
+            return _applyFused(arrs)
+        
+    def _applyFused(arrs):
+        mats=_getMatrices(arrs)
+        
+        if nonzeroIndex!=-1:
+            segs=arrs[nonzeroIndex]
+            center=(np.asarray(segs.shape[1:3])-1)/2.0
+            points=[trainutils.nonzeroExtremePoints(seg)-center for seg in segs]
+            remaining=np.arange(segs.shape[0])
+            count=maxCount
+            
+            while count>0 and remaining.shape[0]>0:
+                # check the segmentation points mapped by the inverse matrices instead of resampling the segmentations
+                inv=np.linalg.inv(mats[remaining])
+                outpts=[points[i].dot(m[:2,:2].T)+m[:2,2]+center for i,m in zip(remaining,inv)]
+                accepted=np.array([trainutils.pointsInMargins(p,segs.shape[1:3],margin) for p in outpts],bool)
+                remaining=remaining[~accepted]
+                count-=1
+                
+                if count>0 and remaining.shape[0]>0:
+                    mats[remaining]=_getMatrices(tuple(a[remaining] for a in arrs))
+                    
+            mats[remaining]=np.eye(3) # items which never passed are left untransformed
             
-        return result
+        return tuple(affineResample(a,mats,orders[min(i,len(orders)-1)],mode,cval) for i,a in enumerate(arrs))
     
-    return _distort
+    def _fused(*arrs,rng=None):
+        return tuple(a[0] for a in _fusedBatch(*[a[None] for a in arrs],rng=rng))
+    
+    _fused.batch=_fusedBatch
+    return _fused
 
 
 def splitSegmentation(*arrs,numLabels=2,segIndex=-1):
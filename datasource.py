@@ -1,14 +1,25 @@
 
 from __future__ import division, print_function
+import os
+import ast
+import uuid
+import hashlib
+import tempfile
+import time
 import threading
 import multiprocessing as mp
-import platform
 import queue
-from multiprocessing import sharedctypes
+import collections
+from multiprocessing import sharedctypes, shared_memory
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager, ExitStack
 
 import numpy as np
 
+import trainutils
+from augments import applyAugmentsBatch
+from packeddata import PackedReader
+
 
 def toShared(array):
     '''Convert the given Numpy array to a shared ctypes object.'''
@@ -16,9 +27,59 @@ def toShared(array):
     return sharedctypes.RawArray(carr._type_, carr)
 
 
-def fromShared(array):
-    '''Map the given ctypes object to a Numpy array, this is expected to be a shared object from the parent.'''
+def toSharedBytes(array):
+    '''
+    Copy `array' into a flat shared ctypes byte array, returning this with the shape and dtype needed by fromShared() to
+    map it back to an array. Unlike the result of toShared() this can be passed to processes using any start method.
+    '''
+    raw=sharedctypes.RawArray('b',max(1,array.nbytes))
+    np.frombuffer(raw,array.dtype,array.size).reshape(array.shape)[...]=array
+    return raw,array.shape,array.dtype
+
+
+def fromShared(array,shape=None,dtype=None):
+    '''
+    Map the given ctypes object to a Numpy array, this is expected to be a shared object from the parent. If `shape' and
+    `dtype' are given `array' is a flat byte array from toSharedBytes() which is mapped to an array of that shape and type.
+    '''
+    if shape is not None:
+        return np.frombuffer(array,dtype,int(np.prod(shape))).reshape(shape)
+    
     return np.ctypeslib.as_array(array)
+
+
+def toSharedMemory(array,name=None):
+    '''
+    Copy `array' into a new shared memory block named `name' (or a generated name if None), returning the block object and
+    an array using it as its buffer. The block exists until unlink() is called on it, other processes can attach to it
+    with fromSharedMemory() given its name, shape, and dtype.
+    '''
+    shm=shared_memory.SharedMemory(name=name,create=True,size=max(1,array.nbytes))
+    shared=np.ndarray(array.shape,array.dtype,buffer=shm.buf)
+    shared[...]=array
+    return shm,shared
+
+
+def attachSharedMemory(name):
+    '''Attach to the existing shared memory block `name' without tracking it, so that only its creator unlinks it.'''
+    try:
+        return shared_memory.SharedMemory(name=name,track=False) # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def fromSharedMemory(name,shape,dtype):
+    '''Attach to the shared memory block `name', returning the block object and an array of `shape' and `dtype' using it.'''
+    shm=attachSharedMemory(name)
+    return shm,np.ndarray(shape,dtype,buffer=shm.buf)
+
+
+def toMemmap(array,fileName):
+    '''Copy `array' into the new .npy file `fileName', returning a memory-mapped array of the file's contents.'''
+    mm=np.lib.format.open_memmap(fileName,'w+',array.dtype,array.shape)
+    mm[...]=array
+    mm.flush()
+    return mm
         
         
 def initProc(inArrays_,augs_,augments_):
@@ -26,43 +87,185 @@ def initProc(inArrays_,augs_,augments_):
     global inArrays
     global augs
     global augments
-    inArrays=tuple(map(fromShared,inArrays_))
-    augs=tuple(map(fromShared,augs_))
+    inArrays=tuple(fromShared(*a) for a in inArrays_)
+    augs=tuple(fromShared(*a) for a in augs_)
     augments=augments_
     
     
-def applyAugmentsProc(indices):
-    '''Apply the augmentations to the input array at the given indices.'''
+def applyAugmentsProc(indices,seed=None):
+    '''Apply the augmentations to the input array at the given indices, drawing random values from a generator for `seed'.'''
     global inArrays
     global augs
     global augments
     
-    for i in indices:
-        inarrs=[a[i] for a in inArrays]
-        
-        for aug in augments:
-            inarrs=aug(*inarrs)
-            
-        for ina,outa in zip(inarrs,augs):
-            outa[i]=ina
+    rng=None if seed is None else np.random.default_rng(seed)
+    inarrs=applyAugmentsBatch(augments,*[a[indices] for a in inArrays],rng=rng)
         
+    for ina,outa in zip(inarrs,augs):
+        outa[indices]=ina
+
+
+def ringWorkerProc(indices,inArrays,outArrays,augments,workSem,readySems,stopEvent,errorQueue,seed=None):
+    '''
+    Worker process loop for DataSource.ringBatchGen(). The shared arrays `inArrays' and `outArrays' have the slot index as
+    their first dimension. Each release of `workSem' signals that the next slot in ring order has been filled, the batch
+    items at `indices' are then augmented (as a batch) into the slot's output arrays and readySems[slot] is released once.
+    The loop exits when `stopEvent' is set, any raised exception is put into `errorQueue' for the parent to re-raise.
+    Random values are drawn from a generator created from SeedSequence `seed'.
+    '''
+    inArrays=tuple(fromShared(*a) for a in inArrays)
+    outArrays=tuple(fromShared(*a) for a in outArrays)
+    rng=np.random.default_rng(seed)
+    numSlots=len(readySems)
+    slot=0
+
+    try:
+        while True:
+            workSem.acquire()
+            if stopEvent.is_set():
+                break
+
+            inarrs=applyAugmentsBatch(augments,*[a[slot,indices] for a in inArrays],rng=rng)
+
+            for ina,outa in zip(inarrs,outArrays):
+                outa[slot,indices]=ina
+
+            readySems[slot].release()
+            slot=(slot+1)%numSlots
+    except Exception as e:
+        errorQueue.put(e)
+
 
 class DataSource(object):
-    def __init__(self,*arrays,dataGen=None,selectProbs=None,augments=[]):
+    def __init__(self,*arrays,dataGen=None,selectProbs=None,augments=[],sharedMode=None,sharedDir=None,seed=None):
         self.arrays=list(arrays)
         self.dataGen=dataGen or self.defaultDataGen
         self.selectProbs=selectProbs
         self.augments=augments
         
+        # generators for threads and processes are spawned from this, each batch is reproducible if `seed' is given
+        self.seedSeq=np.random.SeedSequence(seed)
+        self.rng=trainutils.spawnRandom(self.seedSeq)
+        
+        self.sharedMode=None
+        self.sharedDir=sharedDir
+        self.sharedBlocks=[]
+        self.sharedDescs=[]
+        self.isSharedOwner=False
+        
+        if sharedMode is not None:
+            self.shareArrays(sharedMode,sharedDir)
+            
+    def __getstate__(self):
+        '''Pickle shared arrays as the descriptions of their blocks or files rather than their contents.'''
+        state=dict(self.__dict__)
+        state['sharedBlocks']=[]
+        state['isSharedOwner']=False
+        
+        if self.sharedDescs:
+            state['arrays']=[]
+            
+        return state
+    
+    def __setstate__(self,state):
+        '''Restore the pickled state, attaching to the shared memory blocks or memmap files of shared arrays.'''
+        self.__dict__.update(state)
+        
+        if self.sharedDescs:
+            for desc in self.sharedDescs:
+                if desc[0]=='shm':
+                    shm,arr=fromSharedMemory(*desc[1:])
+                    self.sharedBlocks.append(shm)
+                else:
+                    arr=np.load(desc[1],mmap_mode='r+')
+                    
+                self.arrays.append(arr)
+                
+    def shareArrays(self,sharedMode='shm',sharedDir=None):
+        '''
+        Move the arrays of this source into named shared memory blocks if `sharedMode' is "shm", or into memory-mapped .npy
+        files in directory `sharedDir' (a new temporary directory if not given) if it is "memmap". Other processes can use
+        arrays in either form without copying them, pickling this object (eg. to pass to a spawned process) stores only the
+        names of the blocks or files which are attached to when unpickled. Blocks and files created here are removed when
+        the arrays are shared again or when releaseShared() is called, which must be done once this object is finished
+        with to prevent leaking shared memory.
+        '''
+        assert sharedMode in ('shm','memmap'), 'Shared mode must be "shm" or "memmap"'
+        
+        arrays=[]
+        blocks=[]
+        descs=[]
+        
+        if sharedMode=='memmap':
+            self.sharedDir=sharedDir or self.sharedDir or tempfile.mkdtemp()
+        
+        for arr in self.arrays:
+            arr=np.asarray(arr)
+            
+            if sharedMode=='shm':
+                shm,arr=toSharedMemory(arr)
+                blocks.append(shm)
+                descs.append(('shm',shm.name,arr.shape,arr.dtype))
+            else:
+                fileName=os.path.join(self.sharedDir,'%s.npy'%uuid.uuid4().hex)
+                arr=toMemmap(arr,fileName)
+                descs.append(('memmap',fileName))
+                
+            arrays.append(arr)
+            
+        self.arrays=arrays
+        self.releaseShared(False) # release previous shared arrays now that self.arrays no longer references them
+        
+        self.sharedMode=sharedMode
+        self.sharedBlocks=blocks
+        self.sharedDescs=descs
+        self.isSharedOwner=True
+        
+    def releaseShared(self,copyBack=True):
+        '''
+        Stop using shared arrays, closing shared memory blocks and removing blocks or memmap files this object created. If
+        `copyBack' is True the current arrays are first copied into private memory so that they remain usable.
+        '''
+        if copyBack and self.sharedDescs:
+            self.arrays=[np.array(a) for a in self.arrays]
+            
+        for shm in self.sharedBlocks:
+            try:
+                shm.close()
+            except BufferError:
+                pass # views of the block are still in use, it will be closed when the block object is collected
+                
+            if self.isSharedOwner:
+                shm.unlink()
+                
+        if self.isSharedOwner:
+            for desc in self.sharedDescs:
+                if desc[0]=='memmap' and os.path.isfile(desc[1]):
+                    os.remove(desc[1])
+                    
+        self.sharedMode=None
+        self.sharedBlocks=[]
+        self.sharedDescs=[]
+        self.isSharedOwner=False
+        
     def defaultDataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
         if chosenInds is None:
-            chosenInds=np.random.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
+            chosenInds=self.rng.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
                 
         return tuple(a[chosenInds] for a in self.arrays)
     
     def stop(self,genType):
         assert genType in ('local','thread','process')
                 
+    def shardRandom(self,rank,numShards):
+        '''
+        Replace self.seedSeq and self.rng with those for shard `rank' of `numShards', this is used to give each of a set
+        of processes drawing from copies of this source (eg. data-parallel training workers) independent random batches
+        which remain reproducible if a seed was given.
+        '''
+        self.seedSeq=self.seedSeq.spawn(numShards)[rank]
+        self.rng=trainutils.spawnRandom(self.seedSeq)
+        
     def getRandomBatch(self,batchSize):
         '''Call the generator callable with the given `batchSize' value with self.selectProb as the second argument.'''
         return self.dataGen(batchSize,self.selectProbs)
@@ -73,20 +276,23 @@ class DataSource(object):
     
     def getAugmentedArrays(self,arrays):
         '''Apply the augmentations to single-instance arrays.'''
-        for aug in self.augments:
-            arrays=aug(*arrays)
+        with trainutils.useRandom(self.rng):
+            for aug in self.augments:
+                arrays=aug(*arrays)
             
         return arrays
     
-    def applyAugments(self,arrays,augArrays,indices=None):
-        '''Apply the augmentations to batch input and output arrays at `indices' or for the whole arrays if not given.'''
-        indices=range(arrays[0].shape[0]) if indices is None else indices
-            
-        for i in indices:
-            inarrs=[a[i] for a in arrays]
-            outarrs=self.getAugmentedArrays(inarrs)
-            for out,aug in zip(outarrs,augArrays):
-                aug[i]=out
+    def applyAugments(self,arrays,augArrays,indices=None,rng=None):
+        '''
+        Apply the augmentations to batch input and output arrays at `indices' or for the whole arrays if not given. This
+        uses the batch forms of augments where these are defined to augment all the items at `indices' at once. Random
+        values are drawn from np.random.Generator `rng', or from self.rng if None.
+        '''
+        indices=np.arange(arrays[0].shape[0]) if indices is None else np.asarray(indices)
+        
+        outarrs=applyAugmentsBatch(self.augments,*[a[indices] for a in arrays],rng=self.rng if rng is None else rng)
+        for out,aug in zip(outarrs,augArrays):
+            aug[indices]=out
                 
     @contextmanager
     def localBatchGen(self,batchSize):
@@ -107,58 +313,114 @@ class DataSource(object):
             self.stop('local')
                 
     @contextmanager
-    def threadBatchGen(self,batchSize,numThreads=None):
-        '''Yields a callable object which produces `batchSize' batches generated in `numThreads' threads.'''
+    def threadBatchGen(self,batchSize,numThreads=None,prefetch=1,numBuffers=None,autoRelease=False,timeout=0.1):
+        '''
+        Yields a callable object which produces `batchSize' batches generated in `numThreads' threads. A generating thread
+        keeps up to `prefetch' batches queued ahead of the consumer, dispatching the augmentation of each batch to a pool
+        of threads which lives as long as the context. If `numBuffers' is None every batch is written into newly allocated
+        arrays which the caller keeps. Otherwise a pool of `numBuffers' preallocated batch arrays is reused, so each batch
+        must be handed back by calling the `release' attribute of the callable once it's no longer needed (batches are
+        released in the order they were returned), or automatically on the next call if `autoRelease' is True. The
+        `timeout' value is the interval in seconds at which the generating thread checks for shutdown. The portion of each
+        batch augmented by a thread uses its own generator spawned from self.seedSeq.
+        '''
         numThreads=min(batchSize,numThreads or mp.cpu_count())
         threadIndices=np.array_split(np.arange(batchSize),numThreads)
         isRunning=True
-        batchQueue=queue.Queue(1)
+        batchQueue=queue.Queue(max(1,prefetch))
+        freeBuffers=queue.Queue()
+        outstanding=collections.deque()
         
         with self.localBatchGen(batchSize) as gen:
-            augs=gen()
+            sizeTypes=[(a.shape,a.dtype) for a in gen()]
+            
+        def _newBuffer():
+            return tuple(np.empty(*st) for st in sizeTypes)
+            
+        if numBuffers is not None:
+            assert numBuffers>0
+            for _ in range(numBuffers):
+                freeBuffers.put(_newBuffer())
+                
+        def _putBatch(item):
+            while isRunning:
+                try:
+                    batchQueue.put(item,timeout=timeout)
+                    break
+                except queue.Full:
+                    pass # try to add the item again
         
         def _batchThread():
-            while isRunning:
-                threads=[]
-                batch=self.getRandomBatch(batchSize)
+            try:
+                while isRunning:
+                    if numBuffers is None:
+                        augs=_newBuffer()
+                    else:
+                        try:
+                            augs=freeBuffers.get(timeout=timeout)
+                        except queue.Empty:
+                            continue # all buffers in use, check isRunning and try again
+                            
+                    batch=self.getRandomBatch(batchSize)
+                    rngs=trainutils.spawnRandom(self.seedSeq,len(threadIndices))
+                    tp.starmap(self.applyAugments,[(batch,augs,ind,rng) for ind,rng in zip(threadIndices,rngs)])
+                    _putBatch(augs)
+            except Exception as e:
+                _putBatch(e)
                 
-                for indices in threadIndices:
-                    t=threading.Thread(target=self.applyAugments,args=(batch,augs,indices))
-                    t.start()
-                    threads.append(t)
-                    
-                for t in threads:
-                    t.join()
-                    
-                batchQueue.put(tuple(a.copy() for a in augs)) # copy to prevent overwriting arrays before they're used
+        def _release():
+            if not outstanding and numBuffers is not None:
+                raise ValueError('No batches are waiting to be released')
+                
+            if outstanding:
+                freeBuffers.put(outstanding.popleft())
+                
+        def _get():
+            if autoRelease and outstanding:
+                _release()
+                
+            v=batchQueue.get()
+            if not isinstance(v,tuple):
+                raise v
+                
+            if numBuffers is not None:
+                outstanding.append(v)
                 
+            return v
+        
+        _get.release=_release
+        
+        tp=ThreadPool(numThreads)
         batchThread=threading.Thread(target=_batchThread)
         batchThread.start()
         
         try:
-            yield batchQueue.get
+            yield _get
         finally:
             isRunning=False
             self.stop('thread')
-            try:
-                batchQueue.get(True) # there may be a batch waiting on the queue, batchThread is stuck until this is removed
-            except queue.Empty:
-                pass
+            batchThread.join()
+            tp.close()
+            tp.join()
             
     @contextmanager
-    def processBatchGen(self,batchSize,numProcs=None):
-        '''Yields a callable object which produces `batchSize' batches generated in `numProcs' subprocesses.'''
-        assert platform.system().lower()!='windows', 'Generating batches with processes requires fork() semantics not present in Windows.'
-        
+    def processBatchGen(self,batchSize,numProcs=None,mpContext=None):
+        '''
+        Yields a callable object which produces `batchSize' batches generated in `numProcs' subprocesses. These are started
+        using the multiprocessing start method `mpContext' ("fork", "spawn", "forkserver", or None for the default), with
+        methods other than "fork" the augments of this source must be picklable. Each subprocess task is given its own
+        SeedSequence spawned from self.seedSeq so that processes do not repeat each other's random values.
+        '''
+        ctx=mp.get_context(mpContext)
         numProcs=min(batchSize,numProcs or mp.cpu_count())
         procIndices=np.array_split(np.arange(batchSize),numProcs)
         isRunning=True
-        batchQueue=mp.Queue(1)
+        batchQueue=ctx.Queue(1)
         
         with self.localBatchGen(batchSize) as gen:
-            augs=tuple(map(toShared,gen()))
+            augs=tuple(map(toSharedBytes,gen()))
         
-        inArrays=tuple(map(toShared,self.getIndexBatch(np.arange(batchSize))))
+        inArrays=tuple(map(toSharedBytes,self.getIndexBatch(np.arange(batchSize))))
         
         maugs=self.augments
         initargs=(inArrays,augs,maugs)
@@ -167,9 +429,9 @@ class DataSource(object):
             try:
                 initargs=(inArrays,augs,maugs)
                 
-                with mp.Pool(numProcs,initializer=initProc,initargs=initargs) as p:
-                    inArrays=tuple(map(fromShared,inArrays))
-                    augs=tuple(map(fromShared,augs))
+                with ctx.Pool(numProcs,initializer=initProc,initargs=initargs) as p:
+                    inArrays=tuple(fromShared(*a) for a in inArrays)
+                    augs=tuple(fromShared(*a) for a in augs)
                         
                     while isRunning:
                         batch=self.getRandomBatch(batchSize)
@@ -177,7 +439,7 @@ class DataSource(object):
                             a[...]=b
                             
                         if maugs:
-                            p.map(applyAugmentsProc,procIndices)
+                            p.starmap(applyAugmentsProc,zip(procIndices,self.seedSeq.spawn(len(procIndices))))
 
                         batchQueue.put(tuple(a.copy() for a in augs))
                         
@@ -203,8 +465,128 @@ class DataSource(object):
                 batchQueue.get(True) # there may be a batch waiting on the queue, batchThread is stuck until this is removed
             except queue.Empty:
                 pass
-        
-        
+
+    @contextmanager
+    def ringBatchGen(self,batchSize,numProcs=None,numSlots=2,autoRelease=False,timeout=0.1,mpContext=None):
+        '''
+        Yields a callable object which produces `batchSize' batches generated in `numProcs' long-running subprocesses.
+        Batches are stored in a ring of `numSlots' preallocated shared memory slots, a thread in this process fills the
+        input arrays of a free slot and the workers augment their portion of it directly into the slot's output arrays.
+        The callable returns zero-copy views of the next slot's outputs which are valid until that slot is released by
+        calling the `release' attribute of the callable, slots are released in the order they were returned. If
+        `autoRelease' is True the previously returned batch is released on every call instead, which makes the callable a
+        drop-in for the other generators provided a batch is finished with before the next is requested. The `timeout'
+        value is the interval in seconds at which waiting threads check for errors and shutdown. Workers are started using
+        the multiprocessing start method `mpContext' as with processBatchGen(), each with its own random generator.
+        '''
+        assert numSlots>0
+
+        ctx=mp.get_context(mpContext)
+        numProcs=min(batchSize,numProcs or mp.cpu_count())
+        procIndices=np.array_split(np.arange(batchSize),numProcs)
+        isRunning=True
+        errors=[]
+        outstanding=collections.deque()
+        nextSlot=[0]
+
+        with self.localBatchGen(batchSize) as gen:
+            augTest=gen()
+
+        inTest=self.getIndexBatch([0])
+
+        inArrays=tuple(toSharedBytes(np.zeros((numSlots,batchSize)+a.shape[1:],a.dtype)) for a in inTest)
+        outArrays=tuple(toSharedBytes(np.zeros((numSlots,)+a.shape,a.dtype)) for a in augTest)
+
+        freeSems=[threading.Semaphore(1) for _ in range(numSlots)]
+        readySems=[ctx.Semaphore(0) for _ in range(numSlots)]
+        workSems=[ctx.Semaphore(0) for _ in range(numProcs)]
+        stopEvent=ctx.Event()
+        errorQueue=ctx.Queue()
+
+        procs=[]
+        for indices,workSem,seed in zip(procIndices,workSems,self.seedSeq.spawn(numProcs)):
+            args=(indices,inArrays,outArrays,self.augments,workSem,readySems,stopEvent,errorQueue,seed)
+            p=ctx.Process(target=ringWorkerProc,args=args,daemon=True)
+            p.start()
+            procs.append(p)
+
+        inArrays=tuple(fromShared(*a) for a in inArrays)
+        outArrays=tuple(fromShared(*a) for a in outArrays)
+
+        def _fillThread():
+            slot=0
+            try:
+                while isRunning:
+                    if freeSems[slot].acquire(timeout=timeout):
+                        batch=self.getRandomBatch(batchSize)
+                        for a,b in zip(inArrays,batch):
+                            a[slot]=b
+
+                        for s in workSems:
+                            s.release()
+
+                        slot=(slot+1)%numSlots
+            except Exception as e:
+                errors.append(e)
+
+        def _waitReady(sem):
+            while not sem.acquire(timeout=timeout):
+                if errors:
+                    raise errors[0]
+
+                try:
+                    raise errorQueue.get_nowait()
+                except queue.Empty:
+                    pass
+
+                if not all(p.is_alive() for p in procs):
+                    raise RuntimeError('Batch worker process terminated unexpectedly')
+
+        def _release():
+            if not outstanding:
+                raise ValueError('No batches are waiting to be released')
+
+            freeSems[outstanding.popleft()].release()
+
+        def _get():
+            if autoRelease and outstanding:
+                _release()
+
+            if len(outstanding)==numSlots:
+                raise ValueError('All %i slots are in use, release a batch before requesting another'%numSlots)
+
+            slot=nextSlot[0]
+            for _ in procs:
+                _waitReady(readySems[slot])
+
+            nextSlot[0]=(slot+1)%numSlots
+            outstanding.append(slot)
+
+            return tuple(a[slot] for a in outArrays)
+
+        _get.release=_release
+
+        fillThread=threading.Thread(target=_fillThread,daemon=True)
+        fillThread.start()
+
+        try:
+            yield _get
+        finally:
+            isRunning=False
+            self.stop('process')
+            stopEvent.set()
+
+            for s in workSems:
+                s.release()
+
+            for p in procs:
+                p.join(timeout*10)
+                if p.is_alive():
+                    p.terminate()
+
+            fillThread.join()
+
+
 def randomDataSource(shape,augments=[],dtype=np.float32):
     '''
     Returns a DataSource producing batches of `shape'-sized standard normal random arrays of type `dtype'. The `augments'
@@ -221,12 +603,69 @@ def randomDataSource(shape,augments=[],dtype=np.float32):
 
         
 class BufferDataSource(DataSource):
+    '''
+    Source whose arrays are a buffer that is appended to and cleared, eg. to hold generated images between training steps.
+    In shared mode the arrays are views of shared blocks or files whose capacity grows geometrically, so appends which
+    fit into the current capacity are written in place and only reallocations copy the buffer into new shared arrays.
+    '''
+    def __init__(self,*arrays,**kwargs):
+        self.capacityArrays=[] # full-capacity shared arrays which self.arrays are views of
+        DataSource.__init__(self,*arrays,**kwargs)
+        
+    def __getstate__(self):
+        state=DataSource.__getstate__(self)
+        state['capacityArrays']=[]
+        state['bufferLength']=self.bufferSize()
+        return state
+    
+    def __setstate__(self,state):
+        bufferLength=state.pop('bufferLength')
+        DataSource.__setstate__(self,state)
+        
+        if self.sharedDescs: # attached arrays have the full capacity, view only the filled part
+            self.capacityArrays=self.arrays
+            self.arrays=[a[:bufferLength] for a in self.capacityArrays]
+            
+    def releaseShared(self,copyBack=True):
+        self.capacityArrays=[]
+        DataSource.releaseShared(self,copyBack)
+        
+    def bufferCapacity(self):
+        return self.capacityArrays[0].shape[0] if self.capacityArrays else self.bufferSize()
+        
     def appendBuffer(self,*arrays):
-        if not self.arrays:
-            self.arrays=list(arrays)
+        if self.sharedMode is None:
+            if not self.arrays:
+                self.arrays=list(arrays)
+            else:
+                for i in range(len(self.arrays)):
+                    self.arrays[i]=np.concatenate([self.arrays[i],arrays[i]])
         else:
-            for i in range(len(self.arrays)):
-                self.arrays[i]=np.concatenate([self.arrays[i],arrays[i]])
+            size=self.bufferSize()
+            newSize=size+arrays[0].shape[0]
+            
+            # reallocate with doubled capacity if full, or if the blocks belong to another process's copy of this source
+            if newSize>self.bufferCapacity() or not self.isSharedOwner or not self.capacityArrays:
+                capacity=max(newSize,2*self.bufferCapacity())
+                oldArrays=self.arrays or [None]*len(arrays)
+                newArrays=[]
+                
+                for old,arr in zip(oldArrays,arrays):
+                    buf=np.empty((capacity,)+arr.shape[1:],arr.dtype)
+                    if old is not None:
+                        buf[:size]=old
+                        
+                    newArrays.append(buf)
+                    
+                self.capacityArrays=[]
+                self.arrays=newArrays
+                self.shareArrays(self.sharedMode,self.sharedDir) # releases the old shared arrays
+                self.capacityArrays=self.arrays
+                
+            for buf,arr in zip(self.capacityArrays,arrays):
+                buf[size:newSize]=arr
+                
+            self.arrays=[buf[:newSize] for buf in self.capacityArrays]
                 
         if self.selectProbs is not None:
             size=self.arrays[0].shape[0]
@@ -234,7 +673,10 @@ class BufferDataSource(DataSource):
             
     def clearBuffer(self):
         if self.bufferSize()>0:
-            self.arrays=[]
+            if self.capacityArrays: # keep the shared capacity to refill
+                self.arrays=[buf[:0] for buf in self.capacityArrays]
+            else:
+                self.arrays=[]
             
             if self.selectProbs is not None:
                 self.selectProbs=self.selectProbs[:0]
@@ -244,16 +686,21 @@ class BufferDataSource(DataSource):
 
     
 class MergeDataSource(DataSource):
-    def __init__(self,*srcs,numThreads=None,augments=[]):
+    def __init__(self,*srcs,numThreads=None,augments=[],seed=None):
         self.srcs=srcs
         self.batchSize=0
         self.gen=None
         self.numThreads=numThreads
         
-        DataSource.__init__(self,dataGen=self._dataGen,augments=augments)
+        DataSource.__init__(self,dataGen=self._dataGen,augments=augments,seed=seed)
     
     def stop(self,getType):
         self.gen=None
+        
+    def shardRandom(self,rank,numShards):
+        DataSource.shardRandom(self,rank,numShards)
+        for src in self.srcs:
+            src.shardRandom(rank,numShards)
             
     def _setBatchSize(self,batchSize):
         def yieldData():
@@ -274,61 +721,317 @@ class MergeDataSource(DataSource):
         return next(self.gen) 
         
 
+class PackedDataSource(DataSource):
+    '''
+    Source drawing items from the packed dataset in directory `dirName' (see packeddata), using only the fields named in
+    `fieldNames' if given. The shard files are memory-mapped so only the items chosen for batches are read, and pickling
+    this object stores only the index so processes using other start methods map the files themselves. Other keyword
+    arguments are passed to DataSource.
+    '''
+    def __init__(self,dirName,fieldNames=None,**kwargs):
+        self.reader=PackedReader(dirName)
+        fields=[self.reader.getField(n) for n in fieldNames] if fieldNames else self.reader.fields
+        
+        super().__init__(*fields,**kwargs)
+        
+
+class FileCache(object):
+    '''
+    Thread-safe cache of arrays loaded from files by the callable `loadFunc', keeping the total size of cached arrays
+    within `maxSize' bytes (or without limit if this is 0 or less) by evicting the least recently used. Files can be
+    pinned with pin() so that they are never evicted, pinned arrays count towards the total so the cache can exceed the
+    budget if these alone do. The `hits' and `misses' counters record cache performance.
+    
+    If `sharedMode' is "shm" arrays are stored in shared memory blocks named after their file paths. A copy of the cache
+    in another process, eg. one pickled with a FileDataSource into a spawned process, attaches to the blocks already
+    loaded by others instead of reading the file again. Blocks are unlinked by the process which created them when they
+    are evicted or when close() is called, which must be done once the cache is finished with. A block whose header
+    isn't written within `headerTimeout' seconds is assumed to be left by a process which failed while creating it, so
+    it is unlinked and the file loaded again.
+    '''
+    headerSize=256 # bytes at the start of shared blocks storing the dtype and shape of the array
+    headerTimeout=10.0 # seconds to wait for another process to write a block's header
+    
+    def __init__(self,loadFunc,maxSize=100*(2**20),sharedMode=None):
+        assert sharedMode in (None,'shm'), 'Shared mode must be None or "shm"'
+        self.loadFunc=loadFunc
+        self.maxSize=maxSize
+        self.sharedMode=sharedMode
+        self.prefix='dlu%s'%uuid.uuid4().hex[:8] # prefix of shared block names, copies of this cache use the same
+        self.entries=collections.OrderedDict() # path -> (array, shared block or None, True if this process owns the block)
+        self.pinned=set()
+        self.loading={} # path -> Event set when another thread loading that path is done
+        self.currentSize=0
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+        
+    def __getstate__(self):
+        '''Pickle the cache without its contents, these are attached to again through shared memory if used.'''
+        state=dict(self.__dict__)
+        state.update(entries=collections.OrderedDict(),pinned=set(),loading={},currentSize=0,hits=0,misses=0,lock=None)
+        return state
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.lock=threading.Lock()
+        
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self,path):
+        return path in self.entries
+        
+    def getBlockName(self,path):
+        '''Returns the shared memory block name for `path'.'''
+        return self.prefix+hashlib.md5(str(path).encode()).hexdigest()[:16]
+        
+    def _loadShared(self,path):
+        '''Returns the array for `path' from its shared block, attaching to an existing block or creating it if needed.'''
+        name=self.getBlockName(path)
+        
+        try:
+            shm=attachSharedMemory(name)
+            isOwner=False
+        except FileNotFoundError:
+            arr=np.ascontiguousarray(self.loadFunc(path))
+            header=repr((arr.dtype.str,arr.shape)).encode()
+            assert len(header)<self.headerSize
+            
+            try:
+                shm=shared_memory.SharedMemory(name=name,create=True,size=self.headerSize+max(1,arr.nbytes))
+                isOwner=True
+            except FileExistsError: # another process created the block first
+                return self._loadShared(path)
+            
+            np.ndarray(arr.shape,arr.dtype,buffer=shm.buf,offset=self.headerSize)[...]=arr
+            shm.buf[:len(header)]=header # written last, other processes treat an empty header as still being written
+            
+        header=bytes(shm.buf[:self.headerSize]).rstrip(b'\0')
+        deadline=time.monotonic()+self.headerTimeout
+        
+        while not header: # wait for the creating process to finish writing
+            if time.monotonic()>deadline: # the creator failed, remove its block and load the file again
+                shm.close()
+                try:
+                    shared_memory.SharedMemory(name=name).unlink()
+                except FileNotFoundError:
+                    pass # another process has already removed it
+                
+                return self._loadShared(path)
+            
+            time.sleep(0.001)
+            header=bytes(shm.buf[:self.headerSize]).rstrip(b'\0')
+            
+        dtype,shape=ast.literal_eval(header.decode())
+        arr=np.ndarray(shape,np.dtype(dtype),buffer=shm.buf,offset=self.headerSize)
+        
+        return arr,shm,isOwner
+        
+    def get(self,path):
+        '''Returns the array loaded from `path', from the cache if present otherwise loading and storing it first.'''
+        while True:
+            with self.lock:
+                if path in self.entries:
+                    self.hits+=1
+                    self.entries.move_to_end(path)
+                    return self.entries[path][0]
+                
+                event=self.loading.get(path)
+                if event is None: # this thread loads the file, others requesting it wait for it to finish
+                    self.misses+=1
+                    event=self.loading[path]=threading.Event()
+                    break
+                    
+            event.wait()
+            
+        try:
+            if self.sharedMode=='shm':
+                entry=self._loadShared(path)
+            else:
+                entry=(self.loadFunc(path),None,False)
+                
+            with self.lock:
+                self.entries[path]=entry
+                self.currentSize+=entry[0].nbytes
+                self._evict()
+        finally:
+            with self.lock:
+                del self.loading[path]
+                
+            event.set()
+            
+        return entry[0]
+    
+    def _evict(self):
+        '''Remove least recently used unpinned entries until the size budget is met, the lock must be held.'''
+        if self.maxSize<=0:
+            return
+        
+        candidates=[p for p in self.entries if p not in self.pinned]
+        
+        # the newest entry is kept even if it alone exceeds the budget since it's about to be used 
+        while len(candidates)>1 and self.currentSize>self.maxSize:
+            self._remove(candidates.pop(0))
+            
+    def _remove(self,path):
+        arr,shm,isOwner=self.entries.pop(path)
+        self.currentSize-=arr.nbytes
+        
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                pass # the array is still in use, the block is closed when the block object is collected
+            
+            if isOwner:
+                shm.unlink()
+                
+    def pin(self,*paths):
+        '''Load the files `paths' if needed and prevent them from being evicted until unpinned.'''
+        for path in paths:
+            self.get(path)
+            
+            with self.lock:
+                self.pinned.add(path)
+            
+    def unpin(self,*paths):
+        '''Allow the files `paths' to be evicted again.'''
+        with self.lock:
+            self.pinned.difference_update(paths)
+            self._evict()
+            
+    def getStats(self):
+        '''Returns a dictionary of the cache's size and usage statistics.'''
+        with self.lock:
+            total=self.hits+self.misses
+            
+            return dict(
+                numEntries=len(self.entries),numPinned=len(self.pinned),currentSize=self.currentSize,
+                maxSize=self.maxSize,hits=self.hits,misses=self.misses,hitRate=self.hits/total if total else 0.0
+            )
+            
+    def close(self):
+        '''Empty the cache, unlinking the shared blocks this process created.'''
+        with self.lock:
+            for path in list(self.entries):
+                self._remove(path)
+                
+            self.pinned.clear()
+        
+
 class FileDataSource(DataSource):
-    def __init__(self,*filelists,maxSize=100*(2**20), selectProbs=None,augments=[]):
+    '''
+    Source loading images from the files named in `filelists', each list producing one array of the batch. Loaded images
+    are kept in a FileCache of `maxSize' bytes which is stored in shared memory if `sharedCache' is True. Files for a
+    batch are loaded concurrently by a pool of `numLoadThreads' threads (or one per CPU if None). If `prefetch' is True
+    the indices of the next random batch are chosen in advance and its files are loaded into the cache in the background
+    while the current batch is used, the cache must be large enough to hold two batches for this to be of benefit.
+    '''
+    def __init__(self,*filelists,maxSize=100*(2**20), selectProbs=None,augments=[],seed=None,sharedCache=False,
+                 numLoadThreads=None,prefetch=False):
         assert all(len(f)==len(filelists[0]) for f in filelists), "All members of `filelists' must be the same length"
         
+        self._importModules()
+        
+        self.cache=FileCache(self.loadFile,maxSize,'shm' if sharedCache else None)
+        self.numLoadThreads=numLoadThreads
+        self.loadPool=None
+        self.prefetch=prefetch
+        self.nextChosen=None # (batchSize, selectProbs, indices) for the next random batch chosen by prefetching
+        self.chooseLock=threading.Lock()
+        
+        super().__init__(*list(map(np.asarray,filelists)),dataGen=self._dataGen,selectProbs=selectProbs,augments=augments,
+                         seed=seed)
+        
+    def _importModules(self):
         import imageio
         self.iio=imageio
-        import PIL
+        import PIL.Image
         self.image=PIL.Image
         
-        self.imageCache={}
-        self.currentSize=0
-        self.maxSize=maxSize
-        super().__init__(*list(map(np.asarray,filelists)),dataGen=self._dataGen,selectProbs=selectProbs,augments=augments)
+    def __getstate__(self):
+        state=super().__getstate__()
+        del state['iio']
+        del state['image']
+        state['loadPool']=None
+        state['nextChosen']=None
+        del state['chooseLock']
+        return state
+    
+    def __setstate__(self,state):
+        super().__setstate__(state)
+        self._importModules()
+        self.chooseLock=threading.Lock()
         
     def loadFile(self,path):
 #        return self.iio.imread(path)
         return np.asarray(self.image.open(path)).copy()
         
     def _getCachedFile(self,path):
-        if path not in self.imageCache:
-            im=self.loadFile(path)
-            self.currentSize+=im.nbytes
-            self.imageCache[path]=im
+        return self.cache.get(path)
+    
+    def _getLoadPool(self):
+        if self.loadPool is None:
+            self.loadPool=ThreadPool(self.numLoadThreads or mp.cpu_count())
             
-        return self.imageCache[path]
-
-    def _removeFiles(self):
-        if self.maxSize<=0:
-            return 
+        return self.loadPool
+    
+    def releaseShared(self,copyBack=True):
+        '''
+        Release shared arrays, close the thread pool for loading files, and close the file cache which releases its shared
+        blocks if it has any. The pool is joined first so that prefetch loads still running don't add to a closed cache.
+        '''
+        if self.loadPool is not None:
+            self.loadPool.close()
+            self.loadPool.join()
+            self.loadPool=None
+            
+        super().releaseShared(copyBack)
+        self.cache.close()
         
-        candidates=list(self.imageCache)        
-        while len(candidates)>0 and self.currentSize>self.maxSize:
-            c=candidates.pop(0)
-            im=self.imageCache[c]
-            self.currentSize-=im.nbytes
-            del self.imageCache[c]
+    def _chooseIndices(self,batchSize,selectProbs):
+        '''
+        Returns the indices for a random batch, using those chosen in advance for the next batch by _prefetchNext() if 
+        they were chosen with the same arguments.
+        '''
+        with self.chooseLock:
+            nextChosen,self.nextChosen=self.nextChosen,None
+            
+            if nextChosen is not None and nextChosen[0]==batchSize and nextChosen[1] is selectProbs:
+                return nextChosen[2]
+            
+            return self.rng.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
         
-    def _dataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
-        if chosenInds is None:
-            chosenInds=np.random.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
+    def _prefetchNext(self,batchSize,selectProbs):
+        '''Choose the indices for the next random batch and start loading their files if none are already chosen.'''
+        with self.chooseLock:
+            if self.nextChosen is not None:
+                return
             
-        outs=[]
-        for arr in self.arrays:
-            chosen=arr[chosenInds]
-            im=self._getCachedFile(chosen[0])
-            out=np.zeros((len(chosenInds),)+im.shape,im.dtype)
+            nextInds=self.rng.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
+            self.nextChosen=(batchSize,selectProbs,nextInds)
             
-            for i,c in enumerate(chosen):
-                out[i]=self._getCachedFile(c)
-                
-            outs.append(out)
+        paths=set(p for arr in self.arrays for p in arr[nextInds] if p not in self.cache)
+        
+        if paths:
+            self._getLoadPool().map_async(self._getCachedFile,paths) # errors are raised when the batch is loaded
+        
+    def _dataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
+        isRandom=chosenInds is None
+        
+        if isRandom:
+            chosenInds=self._chooseIndices(batchSize,selectProbs)
             
-        self._removeFiles()
+        # load every file needed by the batch concurrently, keeping the images in case the cache evicts any of them
+        paths=list(set(p for arr in self.arrays for p in arr[chosenInds]))
+        images=dict(zip(paths,self._getLoadPool().map(self._getCachedFile,paths)))
+        
+        # only queue loading the next batch's files once this batch's are loaded so they don't delay it
+        if isRandom and self.prefetch:
+            self._prefetchNext(batchSize,selectProbs)
         
-        return tuple(outs)
+        return tuple(np.stack([images[p] for p in arr[chosenInds]]) for arr in self.arrays)
     
     
 if __name__=='__main__':
@@ -341,7 +1044,12 @@ if __name__=='__main__':
         batch=gen()
         
         print([a.shape for a in batch])
-        
+
+    with src.ringBatchGen(4,numSlots=3) as gen:
+        batch=gen()
+        print([a.shape for a in batch])
+        gen.release()
+
     bsrc=BufferDataSource()#np.random.randn(0,1,16,16),np.random.randn(0,2))
     
     bsrc.appendBuffer(np.random.randn(10,1,16,16),np.random.randn(10,2))
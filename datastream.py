@@ -1,12 +1,20 @@
 # DeepLearnUtils 
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
+import os
+import struct
+import zipfile
 from functools import wraps
+from multiprocessing import cpu_count
 from multiprocessing.pool import ThreadPool
 from queue import Queue, Full, Empty
 from threading import Thread, Event
 import numpy as np
 
+import trainutils
+from augments import applyAugmentsBatch
+from packeddata import PackedReader, PackedField
+
 
 class OrderType(object):
     SHUFFLE='shuffle'
@@ -87,10 +95,10 @@ class ArraySource(DataStream):
     are drawn in sequential order but can be set to shuffle the order so that each value appears exactly once
     per epoch, or to choose a random selection which may include items multiple times or not at all based off
     an optional probability distribution. By default the stream will iterate over the arrays indefinitely or
-    optionally only once.
+    optionally only once. PackedField objects can be given in place of arrays and are used as they are.
     """
     def __init__(self,*arrays,orderType=OrderType.LINEAR,doOnce=False,choiceProbs=None):
-        self.arrays=tuple(map(np.atleast_1d,arrays))
+        self.arrays=tuple(a if isinstance(a,PackedField) else np.atleast_1d(a) for a in arrays)
         arrayLen=self.arrays[0].shape[0]
         
         if any(arr.shape[0]!=arrayLen for arr in self.arrays):
@@ -139,12 +147,69 @@ class ArraySource(DataStream):
         return ArraySource(*subArrays,orderType=self.orderType,doOnce=self.doOnce,choiceProbs=subProbs)
                 
                 
+def mapNPZArrays(fileName,arrayNames,cacheDir=None):
+    """
+    Returns a dictionary of read-only memory-mapped arrays for the members `arrayNames` of .npz file `fileName` without
+    reading their contents. Uncompressed members are mapped directly from the .npz file at their offsets within it, while
+    compressed members (or those in a .npy format version which can't be read here) are first extracted to .npy files in
+    `cacheDir` (default is the .npz file name with ".cache" added) and these are mapped. Extraction is done once, files
+    in the cache are reused if they are newer than `fileName`.
+    """
+    cacheDir=cacheDir or fileName+'.cache'
+    headerReaders={(1,0):np.lib.format.read_array_header_1_0,(2,0):np.lib.format.read_array_header_2_0}
+    arrays={}
+    
+    with zipfile.ZipFile(fileName) as zf, open(fileName,'rb') as f:
+        for name in arrayNames:
+            info=zf.getinfo(name+'.npy')
+            
+            header=None
+            
+            if info.compress_type==zipfile.ZIP_STORED:
+                # skip the local file header, its name and extra field lengths may differ from the central directory's
+                f.seek(info.header_offset)
+                nameLen,extraLen=struct.unpack('<HH',f.read(30)[26:30])
+                f.seek(info.header_offset+30+nameLen+extraLen)
+                
+                readHeader=headerReaders.get(np.lib.format.read_magic(f))
+                header=readHeader and readHeader(f)
+                
+            if header is not None:
+                shape,fortran,dtype=header
+                
+                if dtype.hasobject:
+                    raise ValueError('Array %r contains objects and cannot be memory-mapped'%name)
+                
+                arrays[name]=np.memmap(fileName,dtype,'r',f.tell(),shape,'F' if fortran else 'C')
+            else:
+                npyFile=os.path.join(cacheDir,name+'.npy')
+                
+                if not os.path.isfile(npyFile) or os.path.getmtime(npyFile)<os.path.getmtime(fileName):
+                    os.makedirs(cacheDir,exist_ok=True)
+                    tmpFile=npyFile+'.tmp'
+                    
+                    with zf.open(info) as src, open(tmpFile,'wb') as dest:
+                        while True: # copy in chunks so that the whole array is never in memory
+                            chunk=src.read(2**24)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            
+                    os.replace(tmpFile,npyFile)
+                    
+                arrays[name]=np.load(npyFile,mmap_mode='r')
+                
+    return arrays
+                
+
 class NPZFileSource(ArraySource):
     """
     Loads arrays from an .npz file as the source data. Other values can be loaded from the file and stored in 
-    `otherValues` rather than used as source data.
+    `otherValues` rather than used as source data. If `lazy` is True the arrays are memory-mapped with mapNPZArrays()
+    instead so that only the items used are read, compressed arrays are extracted to `cacheDir` the first time.
     """
-    def __init__(self,fileName,arrayNames,otherValues=[],orderType=OrderType.LINEAR,doOnce=False):
+    def __init__(self,fileName,arrayNames,otherValues=[],orderType=OrderType.LINEAR,doOnce=False,lazy=False,
+                 cacheDir=None):
         self.fileName=fileName
         
         dat=np.load(fileName)
@@ -154,14 +219,30 @@ class NPZFileSource(ArraySource):
         
         if missing:
             raise ValueError('Array name(s) %r not in loaded npz file'%(missing,))
-                
-        arrays=[dat[name] for name in arrayNames]
+            
+        if lazy:
+            mapped=mapNPZArrays(fileName,arrayNames,cacheDir)
+            arrays=[mapped[name] for name in arrayNames]
+        else:
+            arrays=[dat[name] for name in arrayNames]
         
         super().__init__(*arrays,orderType=orderType,doOnce=doOnce)
         
         self.otherValues={n:dat[n] for n in otherValues if n in keys}
         
 
+class PackedSource(ArraySource):
+    """
+    Uses the fields of the packed dataset in directory `dirName` as the source data, or only those named in `fieldNames`
+    if given. Items are read from the memory-mapped shard files as they are yielded rather than loaded in advance.
+    """
+    def __init__(self,dirName,fieldNames=None,orderType=OrderType.LINEAR,doOnce=False):
+        self.reader=PackedReader(dirName)
+        fields=[self.reader.getField(n) for n in fieldNames] if fieldNames else self.reader.fields
+        
+        super().__init__(*fields,orderType=orderType,doOnce=doOnce)
+        
+
 class RandomGenerator(DataStream):
     """Randomly generates float32 arrays of the given shape using np.random.rand()."""
     def __init__(self,*shape):
@@ -212,26 +293,60 @@ class BatchStream(DataStream):
                 
             
 class AugmentStream(BatchStream):
-    """Applies the given augmentations in order to each value from the source and yields the results in batches."""
-    def __init__(self,src,batchSize,augments=[]):
+    """
+    Applies the given augmentations in order to each value from the source and yields the results in batches. If the
+    source values can be stacked into batch arrays the batch forms of augments are used where these are defined. Random
+    values for augments are drawn from generators spawned from a SeedSequence for `seed', so the output is reproducible
+    if this is given.
+    """
+    def __init__(self,src,batchSize,augments=[],seed=None):
         super().__init__(src,batchSize)
         self.augments=augments
+        self.seedSeq=np.random.SeedSequence(seed)
+        self.rng=trainutils.spawnRandom(self.seedSeq)
         
-    def generate(self,arrays):
+    def generate(self,arrays,rng=None):
         '''Apply the augmentations to single-instance arrays, yielding a single set of arrays.'''
-        for aug in self.augments:
-            arrays=aug(*arrays)
+        with trainutils.useRandom(self.rng if rng is None else rng):
+            for aug in self.augments:
+                arrays=aug(*arrays)
             
         yield arrays
         
+    def stackValues(self,srcVals):
+        '''Returns the values `srcVals' stacked into batch arrays, or None if their shapes differ.'''
+        srcArrays=list(zip(*srcVals))
+        if any(a.shape!=arrs[0].shape for arrs in srcArrays for a in arrs):
+            return None
+        
+        return tuple(map(np.stack,srcArrays))
+        
+    def __iter__(self):
+        srcVals=[]
+        
+        for srcVal in self.src:
+            srcVals.append(tuple(map(np.asarray,srcVal)))
+            
+            if len(srcVals)==self.batchSize:
+                batch=self.stackValues(srcVals)
+                
+                if batch is not None:
+                    yield applyAugmentsBatch(self.augments,*batch,rng=self.rng)
+                else:
+                    augVals=[next(self.generate(v)) for v in srcVals]
+                    yield tuple(map(np.stack,zip(*augVals)))
+                    
+                srcVals=[]
+        
 
 class ThreadAugmentStream(AugmentStream):
     """
     Applies the given augmentations to each value from the source using multiple threads. Resulting batches are yielded
-    synchronously so the client must wait for the threads to complete. 
+    synchronously so the client must wait for the threads to complete. Each portion of a batch given to a thread has its
+    own generator spawned from self.seedSeq so threads don't share random state.
     """
-    def __init__(self,src,batchSize,numThreads=None,augments=[]):
-        super().__init__(src,batchSize,augments)
+    def __init__(self,src,batchSize,numThreads=None,augments=[],seed=None):
+        super().__init__(src,batchSize,augments,seed)
         self.numThreads=numThreads
         self.batchArrays=None
         
@@ -239,28 +354,40 @@ class ThreadAugmentStream(AugmentStream):
         '''Returns a non-threaded iterator, ie. behaves like AugmentStream.'''
         return super().__iter__()
         
-    def applyAugments(self,arrays):
+    def applyAugments(self,arrays,rng=None):
         '''Apply the augmentations to single-instance arrays, returning a single set of arrays.'''
-        for a in self.generate(arrays):
+        for a in self.generate(arrays,rng):
             return a
         
-    def _applyAugmentThread(self,index,arrays):
+    def _applyAugmentThread(self,index,arrays,rng=None):
         '''
         Apply the augmentations to `arrays` and storing results in the position `index` in the appropriate array of 
         self.batchArrays. This is meant to be called by threads.
         '''
-        arrays=self.applyAugments(arrays)
+        arrays=self.applyAugments(arrays,rng)
         
         for i,arr in enumerate(arrays):
             self.batchArrays[i][index][...]=arr
+            
+    def _applyAugmentBatchThread(self,indices,batch,rng=None):
+        '''
+        Apply the augmentations to the items of batch arrays `batch` at `indices` together, storing the results in the same
+        positions of self.batchArrays. This is meant to be called by threads.
+        '''
+        arrays=applyAugmentsBatch(self.augments,*[a[indices] for a in batch],rng=rng)
+        
+        for i,arr in enumerate(arrays):
+            self.batchArrays[i][indices]=arr
         
     def __iter__(self):
         srcVals=[]
         arraySizeTypes=None
+        numThreads=self.numThreads or cpu_count()
+        threadIndices=np.array_split(np.arange(self.batchSize),min(self.batchSize,numThreads))
         
         with ThreadPool(self.numThreads) as tp:
             for srcVal in self.src:
-                srcVals.append(srcVal)
+                srcVals.append(tuple(map(np.asarray,srcVal)))
 
                 if arraySizeTypes is None:
                     testAug=self.applyAugments(srcVals[0])
@@ -268,7 +395,15 @@ class ThreadAugmentStream(AugmentStream):
                     
                 if len(srcVals)==self.batchSize:
                     self.batchArrays=tuple(np.zeros(*st) for st in arraySizeTypes) # create fresh arrays each time
-                    tp.starmap(self._applyAugmentThread,list(enumerate(srcVals)))
+                    batch=self.stackValues(srcVals)
+                    
+                    if batch is not None: # augment a portion of the stacked batch in each thread
+                        rngs=trainutils.spawnRandom(self.seedSeq,len(threadIndices))
+                        tp.starmap(self._applyAugmentBatchThread,[(ind,batch,r) for ind,r in zip(threadIndices,rngs)])
+                    else:
+                        rngs=trainutils.spawnRandom(self.seedSeq,len(srcVals))
+                        tp.starmap(self._applyAugmentThread,[(i,v,r) for i,(v,r) in enumerate(zip(srcVals,rngs))])
+                        
                     yield self.batchArrays
                     srcVals=[]
                             
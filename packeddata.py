@@ -0,0 +1,226 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Packed dataset format storing the items of one or more arrays in a directory of flat binary shard files. Each item is a
+tuple of arrays (one per field) stored contiguously in one shard, the file "index.json" names the fields, their dtypes
+and dimensions, and the shard files, while "index.npz" stores the shard, byte offset, and shape of every item. Readers
+memory-map the shards so that items are returned as zero-copy views and only the parts of the dataset used are read.
+'''
+
+from __future__ import division, print_function
+import os
+import json
+import numpy as np
+
+
+indexFile='index.json'
+indexArraysFile='index.npz'
+shardFileFormat='shard%05i.bin'
+alignment=64 # byte alignment of arrays in shard files
+
+
+class PackedWriter(object):
+    '''
+    Writes items to a packed dataset in directory `dirName' which is created if needed. Each item is a tuple of arrays
+    with one for each name in `fieldNames', the arrays of each field must always have the same dtype and number of
+    dimensions but their shapes may differ. A new shard file is started once the current one exceeds `shardSize' bytes.
+    The index is written by close(), this object can also be used as a context manager which does so on exit.
+    '''
+    def __init__(self,dirName,fieldNames,shardSize=2**30):
+        self.dirName=dirName
+        self.fieldNames=list(fieldNames)
+        self.shardSize=shardSize
+        self.dtypes=None
+        self.ndims=None
+        self.shardNames=[]
+        self.shardIds=[]
+        self.offsets=[]
+        self.shapes=[[] for _ in self.fieldNames]
+        self.shardFile=None
+        self.shardPos=0
+
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _newShard(self):
+        if self.shardFile is not None:
+            self.shardFile.close()
+
+        self.shardNames.append(shardFileFormat%len(self.shardNames))
+        self.shardFile=open(os.path.join(self.dirName,self.shardNames[-1]),'wb')
+        self.shardPos=0
+
+    def append(self,*arrays):
+        '''Append an item to the dataset, `arrays' are the values for each field in order.'''
+        if len(arrays)!=len(self.fieldNames):
+            raise ValueError('Expected %i arrays, got %i'%(len(self.fieldNames),len(arrays)))
+
+        arrays=[np.asarray(a) for a in arrays]
+
+        if self.dtypes is None:
+            self.dtypes=[a.dtype for a in arrays]
+            self.ndims=[a.ndim for a in arrays]
+        elif any(a.dtype!=d or a.ndim!=n for a,d,n in zip(arrays,self.dtypes,self.ndims)):
+            raise ValueError('Array dtypes and dimensions must match those of the first item')
+
+        if self.shardFile is None or self.shardPos>=self.shardSize:
+            self._newShard()
+
+        offsets=[]
+        for i,a in enumerate(arrays):
+            pad=-self.shardPos%alignment
+            self.shardFile.write(b'\0'*pad)
+            self.shardPos+=pad
+
+            offsets.append(self.shardPos)
+            self.shapes[i].append(a.shape)
+
+            self.shardFile.write(a.tobytes()) # always C order
+            self.shardPos+=a.nbytes
+
+        self.shardIds.append(len(self.shardNames)-1)
+        self.offsets.append(offsets)
+
+    def appendArrays(self,*arrays):
+        '''Append each item of the equal length `arrays', that is the values from each at index 0, then 1, and so on.'''
+        for item in zip(*arrays):
+            self.append(*item)
+
+    def close(self):
+        '''Close the current shard and write the index files.'''
+        if self.shardFile is not None:
+            self.shardFile.close()
+            self.shardFile=None
+
+        numFields=len(self.fieldNames)
+        index={
+            'fieldNames':self.fieldNames,
+            'dtypes':[np.dtype(d).str for d in self.dtypes or [np.float32]*numFields],
+            'ndims':self.ndims or [0]*numFields,
+            'shards':self.shardNames,
+            'numItems':len(self),
+        }
+
+        arrays={
+            'shardIds':np.asarray(self.shardIds,np.int32),
+            'offsets':np.asarray(self.offsets,np.int64).reshape(len(self),numFields),
+        }
+
+        for i,(shapes,ndim) in enumerate(zip(self.shapes,index['ndims'])):
+            arrays['shapes%i'%i]=np.asarray(shapes,np.int64).reshape(len(self),ndim)
+
+        np.savez(os.path.join(self.dirName,indexArraysFile),**arrays)
+
+        with open(os.path.join(self.dirName,indexFile),'w') as o:
+            json.dump(index,o,indent=4)
+
+
+def writePacked(dirName,*arrays,fieldNames=None,shardSize=2**30):
+    '''
+    Write the equal length `arrays' to a packed dataset in `dirName' with each item composed of the values from each array
+    at that index. The names of the fields default to "array0", "array1", etc. if `fieldNames' isn't given.
+    '''
+    fieldNames=fieldNames or ['array%i'%i for i in range(len(arrays))]
+
+    with PackedWriter(dirName,fieldNames,shardSize) as writer:
+        writer.appendArrays(*arrays)
+
+
+class PackedField(object):
+    '''
+    Array-like view of one field of a PackedReader. Indexing with an integer returns the zero-copy array for that item,
+    indexing with a slice, index list, or array returns the stacked copy of those items which must be the same shape.
+    The `shape' of the field is the number of items followed by the item shape if all items are the same shape.
+    '''
+    def __init__(self,reader,fieldIndex):
+        self.reader=reader
+        self.fieldIndex=fieldIndex
+        self.name=reader.fieldNames[fieldIndex]
+        self.dtype=reader.dtypes[fieldIndex]
+
+        shapes=reader.shapes[fieldIndex]
+        itemShape=tuple(map(int,shapes[0])) if len(shapes) and np.all(shapes==shapes[0]) else ()
+        self.shape=(len(reader),)+itemShape
+        self.ndim=len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,index):
+        if isinstance(index,(int,np.integer)):
+            return self.reader.getArray(index,self.fieldIndex)
+
+        indices=np.arange(len(self))[index]
+        return np.stack([self.reader.getArray(i,self.fieldIndex) for i in indices])
+
+    def __array__(self,dtype=None,copy=None):
+        return np.asarray(self[:],dtype)
+
+
+class PackedReader(object):
+    '''
+    Reads the packed dataset in directory `dirName', memory-mapping each shard file when first accessed. The `fields'
+    member is a list of PackedField objects for each field which can be used in place of arrays in DataSource and similar
+    objects. Pickling this object stores only the directory and index so that it can be sent to other processes cheaply.
+    '''
+    def __init__(self,dirName):
+        self.dirName=dirName
+
+        with open(os.path.join(dirName,indexFile)) as o:
+            index=json.load(o)
+
+        with np.load(os.path.join(dirName,indexArraysFile)) as arrays:
+            self.shardIds=arrays['shardIds']
+            self.offsets=arrays['offsets']
+            self.shapes=[arrays['shapes%i'%i] for i in range(len(index['fieldNames']))]
+
+        self.fieldNames=index['fieldNames']
+        self.dtypes=[np.dtype(d) for d in index['dtypes']]
+        self.shardNames=index['shards']
+        self.shards=[None]*len(self.shardNames)
+        self.fields=[PackedField(self,i) for i in range(len(self.fieldNames))]
+
+    def __getstate__(self):
+        state=dict(self.__dict__)
+        state['shards']=[None]*len(self.shardNames)
+        return state
+
+    def __len__(self):
+        return self.shardIds.shape[0]
+
+    def __getitem__(self,index):
+        '''Returns the tuple of arrays for item `index'.'''
+        return tuple(self.getArray(index,f) for f in range(len(self.fieldNames)))
+
+    def getField(self,name):
+        '''Returns the PackedField for the field `name'.'''
+        return self.fields[self.fieldNames.index(name)]
+
+    def getShard(self,shardId):
+        '''Returns the memory-mapped byte array for shard `shardId'.'''
+        shard=self.shards[shardId]
+        if shard is None:
+            fileName=os.path.join(self.dirName,self.shardNames[shardId])
+            shard=self.shards[shardId]=np.memmap(fileName,np.uint8,'r')
+
+        return shard
+
+    def getArray(self,index,fieldIndex):
+        '''Returns the read-only zero-copy array of field `fieldIndex' for item `index'.'''
+        shard=self.getShard(self.shardIds[index])
+        dtype=self.dtypes[fieldIndex]
+        shape=tuple(map(int,self.shapes[fieldIndex][index]))
+        offset=self.offsets[index,fieldIndex]
+        nbytes=int(np.prod(shape))*dtype.itemsize
+
+        return np.ndarray(shape,dtype,buffer=shard,offset=offset) if nbytes else np.zeros(shape,dtype)
@@ -8,11 +8,17 @@ import glob
 import time
 import datetime
 import threading
+import queue
+import contextlib
+import logging
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing
 import pytorchnet
 import augments
 import datasource
+import trainutils
 import numpy as np
 
 
@@ -43,7 +49,19 @@ def convert(*arrs,dims=2):
             return arr[None]
         else: 
             return np.rollaxis(arr,2)
-            
+
+    return _convOp
+
+
+@augments.batchaugment(convert)
+def convertBatch(*arrs,dims=2):
+    '''Batch form of convert(), with `dims` excluding the batch dimension.'''
+    def _convOp(arr):
+        if arr.ndim-1==dims:
+            return arr[:,None]
+        else:
+            return np.rollaxis(arr,3,1)
+
     return _convOp
 
 
@@ -73,6 +91,309 @@ class SimpleTrainer(object):
             self.opt.step()
     
 
+class OutputSink(object):
+    '''
+    Destination for the per-batch outputs of NetworkManager.evaluate() and infer() which stores them as each batch
+    completes rather than accumulating a list of batch results. The `out' value given to the constructor can be:
+        - an array (including a memmap) of length `length' in which outputs are written to the slice for each batch,
+        - a list or tuple of such arrays, one for each network output,
+        - a callable accepting the start index of the batch and a tuple of output arrays for that batch,
+        - a file name for a .npy file created as a memmap when the first batch is written, where for multiple outputs
+          the files are named by adding "_0", "_1", etc. before the extension.
+    The `result' member stores the array, memmap, or tuple of these, or None if `out' is callable.
+    '''
+    def __init__(self,out,length):
+        self.out=out
+        self.length=length
+        self.result=None
+        self.isCallable=callable(out)
+        
+        if isinstance(out,(tuple,list)):
+            self.result=tuple(out)
+        elif not self.isCallable and not isinstance(out,str):
+            self.result=out
+            
+    def _createMemmaps(self,outputs):
+        if len(outputs)==1:
+            names=[self.out]
+        else:
+            root,ext=os.path.splitext(self.out)
+            names=['%s_%i%s'%(root,i,ext or '.npy') for i in range(len(outputs))]
+            
+        mms=[np.lib.format.open_memmap(n,'w+',o.dtype,(self.length,)+o.shape[1:]) for n,o in zip(names,outputs)]
+        return mms[0] if len(mms)==1 else tuple(mms)
+            
+    def write(self,index,outputs):
+        '''Write the tuple of Numpy arrays `outputs' for the batch starting at position `index'.'''
+        if self.isCallable:
+            self.out(index,outputs)
+            return
+        
+        if self.result is None:
+            self.result=self._createMemmaps(outputs)
+            
+        dests=self.result if isinstance(self.result,tuple) else (self.result,)
+        
+        for dest,o in zip(dests,outputs):
+            dest[index:index+o.shape[0]]=o
+            
+    def flush(self):
+        '''Flush memmap results to disk.'''
+        for dest in self.result if isinstance(self.result,tuple) else (self.result,):
+            if isinstance(dest,np.memmap):
+                dest.flush()
+
+
+class InputPrefetcher(object):
+    '''
+    Calls `inputfunc' in a background thread to get batches of Numpy arrays and converts these to tensors on `device'
+    ahead of their use, so that loading and transferring the next batch overlaps with computing the current one. Up to
+    `depth' batches are kept ready, and `inputfunc' is called at most `count' times if this is given. When `device' is
+    a Cuda device arrays are copied into pinned memory and transferred with non-blocking copies on a separate stream, 
+    calling this object then makes the current stream wait for the transfer of the batch returned. For other devices 
+    the arrays are copied into new tensors, so batches from `inputfunc' are not needed once the next call is made and
+    may reuse buffers. Calling this object returns the next list of tensors, it also acts as a context manager which 
+    stops the thread on exit.
+    '''
+    def __init__(self,inputfunc,device,depth=1,count=None,timeout=0.1):
+        self.inputfunc=inputfunc
+        self.device=torch.device(device)
+        self.count=count
+        self.timeout=timeout
+        self.isCuda=self.device.type=='cuda' and torch.cuda.is_available()
+        self.stream=torch.cuda.Stream(self.device) if self.isCuda else None
+        self.buffer=queue.Queue(max(1,depth))
+        self.stopEvent=threading.Event()
+        self.thread=threading.Thread(target=self._loadThread,daemon=True)
+        self.thread.start()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        
+    def _convert(self,arr):
+        if self.isCuda:
+            tensor=torch.as_tensor(arr).pin_memory()
+            return tensor.to(self.device,non_blocking=True)
+        else:
+            return torch.tensor(arr).to(self.device)
+        
+    def _put(self,item):
+        while not self.stopEvent.is_set():
+            try:
+                self.buffer.put(item,timeout=self.timeout)
+                break
+            except queue.Full:
+                pass # try to add the item again
+        
+    def _loadThread(self):
+        try:
+            step=0
+            while not self.stopEvent.is_set() and (self.count is None or step<self.count):
+                step+=1
+                arrays=self.inputfunc()
+                
+                if self.isCuda:
+                    with torch.cuda.stream(self.stream):
+                        tensors=[self._convert(arr) for arr in arrays]
+                        ready=torch.cuda.Event()
+                        ready.record(self.stream)
+                else:
+                    tensors=[self._convert(arr) for arr in arrays]
+                    ready=None
+                    
+                self._put((tensors,ready))
+        except Exception as e:
+            self._put(e)
+            
+    def __call__(self):
+        while True:
+            try:
+                item=self.buffer.get(timeout=self.timeout)
+                break
+            except queue.Empty:
+                if not self.thread.is_alive() and self.buffer.empty():
+                    raise RuntimeError('No more batches are available')
+        
+        if isinstance(item,Exception):
+            raise item
+            
+        tensors,ready=item
+        
+        if ready is not None:
+            stream=torch.cuda.current_stream(self.device)
+            stream.wait_event(ready)
+            for t in tensors: # prevent the memory of tensors being reused by the copy stream while still in use
+                t.record_stream(stream)
+                
+        return tensors
+    
+    def close(self):
+        '''Stop the loading thread, waiting for it to finish its current batch.'''
+        self.stopEvent.set()
+        self.thread.join()
+        
+
+class CheckpointWriter(object):
+    '''
+    Saves checkpoints in a background thread so that training isn't stalled by serialization and disk writes. The save()
+    method snapshots the given state to CPU memory then queues it to be written, blocking only when `maxInFlight' saves
+    are already waiting to be written. Each file is written to a temporary file in the same directory, flushed and 
+    synced to disk, then atomically renamed so that no partial checkpoint file exists if the process is interrupted. If
+    `keepLast' is given only that many of the most recent files matching the group pattern given to save() are kept. 
+    Errors in the writing thread are raised by the next call to save() or wait().
+    '''
+    def __init__(self,maxInFlight=2,keepLast=None):
+        self.keepLast=keepLast
+        self.queue=queue.Queue(max(1,maxInFlight))
+        self.errors=[]
+        self.thread=None
+        self.lock=threading.Lock()
+        
+    @staticmethod
+    def snapshot(state):
+        '''Returns a copy of `state' with every tensor it contains copied to CPU memory, recursing into containers.'''
+        if isinstance(state,torch.Tensor):
+            return state.detach().to('cpu',copy=True)
+        elif isinstance(state,dict):
+            return type(state)((k,CheckpointWriter.snapshot(v)) for k,v in state.items())
+        elif isinstance(state,(list,tuple)):
+            return type(state)(map(CheckpointWriter.snapshot,state))
+        else:
+            return state
+        
+    @staticmethod
+    def writeFile(state,path):
+        '''Save `state' to `path' by atomically replacing it with a temporary file which is synced to disk first.'''
+        tmppath='%s.tmp%i'%(path,threading.get_ident())
+        
+        try:
+            with open(tmppath,'wb') as o:
+                torch.save(state,o)
+                o.flush()
+                os.fsync(o.fileno())
+                
+            os.replace(tmppath,path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        
+    def _removeOld(self,group):
+        files=sorted(glob.glob(group))
+        for f in files[:max(0,len(files)-self.keepLast)]:
+            os.remove(f)
+        
+    def _writeThread(self):
+        while True:
+            item=self.queue.get()
+            
+            try:
+                if item is None:
+                    break
+                
+                state,path,group=item
+                self.writeFile(state,path)
+                
+                if self.keepLast is not None and group is not None:
+                    self._removeOld(group)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+                
+    def _raiseErrors(self):
+        if self.errors:
+            raise self.errors.pop(0)
+            
+    def save(self,state,path,group=None):
+        '''
+        Snapshot `state' and queue it to be saved to `path'. The glob pattern `group' matches the files of the series of
+        checkpoints `path' belongs to, those which sort before the last self.keepLast are deleted after writing.
+        '''
+        self._raiseErrors()
+        
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread=threading.Thread(target=self._writeThread,daemon=True)
+                self.thread.start()
+                
+        self.queue.put((self.snapshot(state),path,group))
+        
+    def wait(self):
+        '''Wait for all queued checkpoints to be written.'''
+        self.queue.join()
+        self._raiseErrors()
+        
+    def close(self):
+        '''Wait for all queued checkpoints to be written then stop the writing thread.'''
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread=None
+                
+        self._raiseErrors()
+        
+
+def distributedTrainProc(localRank,createManager,createSource,batchSize,steps,substeps,savesteps,initMethod,
+                         backend,rankOffset,worldSize,numThreads):
+    '''
+    Process function of trainDistributed(), this joins the process group as rank `localRank'+`rankOffset', creates the 
+    source and manager, shards the source's random draws by rank, then trains the manager.
+    '''
+    rank=localRank+rankOffset
+    dist.init_process_group(backend,init_method=initMethod,rank=rank,world_size=worldSize)
+    
+    try:
+        if numThreads:
+            torch.set_num_threads(numThreads)
+            
+        src=createSource()
+        src.shardRandom(rank,worldSize)
+        
+        mgr=createManager(rank)
+        mgr.setDistributed(rank,worldSize)
+        
+        with src.localBatchGen(batchSize) as gen:
+            mgr.train(gen,steps,substeps,savesteps,prefetch=True) # gen is only used by the prefetching thread
+            
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
+        
+        
+def trainDistributed(createManager,createSource,batchSize,steps,substeps=1,savesteps=5,numProcs=None,initMethod=None,
+                     backend='gloo',nodeRank=0,numNodes=1,numThreads=None):
+    '''
+    Train a network with data-parallel training in `numProcs' processes on this node (default is one per 4 CPUs), each
+    training a replica of the network on its own batches of size `batchSize' and averaging gradients between replicas
+    before each optimizer step using torch.distributed with the `backend' backend (gloo works on CPU-only hosts). The 
+    picklable callables `createSource' and `createManager' are called in each process to create the DataSource and the
+    NetworkManager for the process's rank, the latter should only give a save directory for rank 0 which is the only one
+    logging and saving checkpoints. For training over `numNodes' nodes, this is called on each with its own `nodeRank'
+    and the same `initMethod' URL (eg. "tcp://host:port" for the node with rank 0), which defaults to a free local port
+    for a single node. The threads each process uses for Torch operations defaults to the CPU count divided by the total
+    number of processes. The arguments `steps', `substeps', and `savesteps' are passed to NetworkManager.train().
+    '''
+    numProcs=numProcs or max(1,os.cpu_count()//4)
+    worldSize=numProcs*numNodes
+    numThreads=numThreads or max(1,os.cpu_count()//numProcs)
+    
+    if initMethod is None:
+        assert numNodes==1, 'An initialization method URL must be given for multiple nodes'
+        import socket
+        
+        with socket.socket() as sock: # choose an unused port
+            sock.bind(('127.0.0.1',0))
+            initMethod='tcp://127.0.0.1:%i'%sock.getsockname()[1]
+            
+    args=(createManager,createSource,batchSize,steps,substeps,savesteps,initMethod,backend,nodeRank*numProcs,
+          worldSize,numThreads)
+    torch.multiprocessing.spawn(distributedTrainProc,args,numProcs)
+    
+
 class NetworkManager(object):
     '''
     This manages the training, loading, saving, and evaluation of a input network. It defines the train, evaluate, and
@@ -87,6 +408,18 @@ class NetworkManager(object):
         If `isCuda' is True the network and inputs are converted to cuda tensors. The `saveDirPrefix' is the prefix for
         the new directory to create if it doesn't exist, if it does exist it is expected to be a previously created
         directory with a stored network that is reloaded. The `params' value is a user parameter dict for the network.
+        The following values in `params' control how training steps are performed:
+            - autocast: if True forward passes are run in mixed precision with torch.autocast (default False)
+            - autocastDtype: the autocast type, default is bfloat16 on CPU and float16 on Cuda which also uses a GradScaler
+            - accumSteps: number of backward passes gradients are accumulated over per optimizer step (default 1)
+            - gradClip: if given, the maximum norm gradients are clipped to before each optimizer step
+            - checkpointsInFlight: maximum number of checkpoints waiting to be written in the background (default 2)
+            - keepCheckpoints: if given, only this many of the most recent checkpoints are kept in the save directory
+            - logLevel: minimum level of messages logged, using logging module levels, per-step messages are DEBUG (default)
+            - logRecords: if True JSON-lines records of values at each step are written to getRecordFilename()
+            - timePhases: if True the time of each phase of training steps is recorded in self.timer (default True)
+            - timingSync: if True Cuda is synchronized when timing phases so that times include asynchronous GPU work
+            - monitorTimes: if True and this object is a JupyterThreadMonitor, phase times are added to its graph values
         '''
         self.net=net
         self.isCuda=isCuda
@@ -100,6 +433,9 @@ class NetworkManager(object):
         self.lossoutput=None
         self.isRunning=True
         self.lock=threading.RLock()
+        self.evalSink=None
+        self.rank=0
+        self.worldSize=1
         
         self.savedir=None
         self.savePrefix=savePrefix
@@ -115,6 +451,20 @@ class NetworkManager(object):
             lr=params.get('learningRate',1e-3)
             betas=params.get('betas',(0.9, 0.999))
             self.opt=torch.optim.Adam(self.net.parameters(),lr=lr,betas=betas)
+            
+        self.autocast=params.get('autocast',False)
+        self.autocastDtype=params.get('autocastDtype',torch.float16 if self.device.type=='cuda' else torch.bfloat16)
+        self.accumSteps=max(1,params.get('accumSteps',1))
+        self.gradClip=params.get('gradClip',None)
+        self.accumCount=0
+        self.scaler=torch.amp.GradScaler(self.device.type,enabled=self.autocast and self.autocastDtype==torch.float16)
+        self.checkpointWriter=CheckpointWriter(params.get('checkpointsInFlight',2),params.get('keepCheckpoints',None))
+        self.logWriter=trainutils.LogWriter(level=params.get('logLevel',logging.DEBUG))
+        self.logRecords=params.get('logRecords',False)
+        
+        syncFunc=torch.cuda.synchronize if params.get('timingSync',False) and self.device.type=='cuda' else None
+        self.timer=trainutils.PhaseTimer(syncFunc=syncFunc,enabled=params.get('timePhases',True))
+        self.monitorTimes=params.get('monitorTimes',False)
 
         if saveDirPrefix is not None:
             # attempt to choose the most recent saved directory having the given prefix
@@ -146,18 +496,22 @@ class NetworkManager(object):
     def saveStep(self,step,steploss):
         '''
         Called at every save operation, with arguments for the step number and loss at that step. By default this saves
-        the model to a file named for the self.savePrefix value and self.step (ie. ignores `step' and `steploss'). 
+        the model to a file named for the self.savePrefix value and `step' (ie. ignores `steploss') using saveAsync().
         '''
-        self.save(os.path.join(self.savedir,'%s_%.6i.pth'%(self.savePrefix,step)))
+        self.saveAsync(os.path.join(self.savedir,'%s_%.6i.pth'%(self.savePrefix,step)))
     
     def evalStep(self,index,steploss,results):
         '''
         Called after every evaluation step, with arguments for the step number and loss at that step. The `results' list
         is the accumulated result from each application of this method. Given self.traininputs and self.netoutputs this
         method is expected to calculate some evaluation result or metric from these and append it to `results'. The
-        default implementation simply appends self.netoutputs to `results'.
+        default implementation writes self.netoutputs to self.evalSink if evaluate() was given an output, otherwise
+        it simply appends self.netoutputs to `results'. Overrides keeping only reduced metrics use bounded memory.
         '''
-        results.append(self.netoutputs)
+        if self.evalSink is not None:
+            self.evalSink.write(index,self.outputsToNumpy(self.netoutputs))
+        else:
+            results.append(self.netoutputs)
     
     def netForward(self):
         '''
@@ -180,16 +534,32 @@ class NetworkManager(object):
     
     def getLogFilename(self):
         return os.path.join(self.savedir,'%s_train.log'%(self.savePrefix,))
+    
+    def getRecordFilename(self):
+        return os.path.join(self.savedir,'%s_train.jsonl'%(self.savePrefix,))
+    
+    def _updateLogWriter(self):
+        self.logWriter.fileName=self.getLogFilename()
+        self.logWriter.recordFileName=self.getRecordFilename() if self.logRecords else None
                 
-    def log(self,*items):
-        '''Log the given values to getLogFilename().'''
-        if self.doLog:
-            dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
-            msg=dt+' '.join(map(str,items))
+    def log(self,*items,level=logging.INFO):
+        '''
+        Log the given values to getLogFilename() through self.logWriter, which buffers messages and writes them in the 
+        background. Nothing is done if `level' is below params['logLevel'], so the values aren't converted to strings.
+        '''
+        if self.doLog and self.savedir and self.logWriter.isEnabled(level):
+            self._updateLogWriter()
+            self.logWriter.log(*items,level=level)
+            
+    def logRecord(self,**values):
+        '''Write `values' as a JSON-lines record to getRecordFilename() if params['logRecords'] is True.'''
+        if self.doLog and self.savedir and self.logRecords:
+            self._updateLogWriter()
+            self.logWriter.record(**values)
             
-            if self.savedir:
-                with open(self.getLogFilename(),'a') as o:
-                    print(msg,file=o)
+    def flushLog(self):
+        '''Write all buffered log messages and records to their files.'''
+        self.logWriter.flush()
     
     def reload(self,prefix=None):
         '''Reload the network state by loading the most recent .pth file in the save directory if there is one.'''
@@ -205,7 +575,20 @@ class NetworkManager(object):
     
     def save(self,path):
         '''Save the network state to the given path.'''
-        torch.save(self.net.state_dict(),path)
+        CheckpointWriter.writeFile(self.net.state_dict(),path)
+        
+    def saveAsync(self,path):
+        '''
+        Save the network state to the given path using self.checkpointWriter, this returns once the state is copied to 
+        CPU memory and the file is written in the background, with old checkpoints in the save directory deleted if 
+        params['keepCheckpoints'] was given. Use waitSaves() to wait for writing to complete.
+        '''
+        group=os.path.join(self.savedir,'%s_*.pth'%(self.savePrefix,)) if self.savedir else None
+        self.checkpointWriter.save(self.net.state_dict(),path,group)
+        
+    def waitSaves(self):
+        '''Wait for all checkpoints queued by saveAsync() to be written.'''
+        self.checkpointWriter.wait()
         
     def loadNet(self,path):
         '''Load the network and its state from the given path, value "__net__" in the state dict should be network itself.'''
@@ -236,25 +619,129 @@ class NetworkManager(object):
         '''Convert the PyTorch Tensor `arr' to a Numpy array.'''
         return arr.to('cpu').data.numpy()
     
+    def outputsToNumpy(self,outputs):
+        '''Convert `outputs' to a tuple of Numpy arrays, `outputs' is a tensor or a list or tuple of tensors.'''
+        if isinstance(outputs,(tuple,list)):
+            return tuple(map(self.toNumpy,outputs))
+        else:
+            return (self.toNumpy(outputs),)
+    
+    def setDistributed(self,rank,worldSize):
+        '''
+        Set this manager to be the replica of rank `rank' in data-parallel training over `worldSize' processes, the 
+        default process group must already be initialized. Parameters and buffers of self.net are broadcast from rank 0
+        so that replicas start identical, gradients are averaged between replicas by allReduceGradients() before each 
+        optimizer step, and only rank 0 logs and saves checkpoints.
+        '''
+        self.rank=rank
+        self.worldSize=worldSize
+        self.doLog=self.doLog and rank==0
+        
+        if self.net is not None and worldSize>1:
+            with torch.no_grad():
+                for t in list(self.net.parameters())+list(self.net.buffers()):
+                    dist.broadcast(t.data,0)
+                    
+    def allReduceGradients(self):
+        '''
+        Average the gradients of the optimizer's parameters between all replicas if distributed training is being used.
+        The gradients are flattened into one tensor so that a single all-reduce operation is used.
+        '''
+        if self.worldSize<=1:
+            return
+        
+        params=[p for group in self.opt.param_groups for p in group['params'] if p.requires_grad]
+        
+        for p in params:
+            if p.grad is None: # replicas must reduce the same tensors even if a parameter was unused on this one
+                p.grad=torch.zeros_like(p)
+        
+        with self.timer.phase('allreduce'):
+            flat=torch.cat([p.grad.reshape(-1) for p in params])
+            dist.all_reduce(flat)
+            flat/=self.worldSize
+            
+            offset=0
+            for p in params:
+                p.grad.copy_(flat[offset:offset+p.numel()].view_as(p.grad))
+                offset+=p.numel()
+                
+    def autocastContext(self):
+        '''Returns the context to run forward passes in, this is autocast if self.autocast is True.'''
+        if self.autocast:
+            return torch.autocast(self.device.type,self.autocastDtype)
+        else:
+            return contextlib.nullcontext()
+        
+    def zeroGradients(self):
+        '''Zero the optimizer gradients if a new accumulation of gradients is being started.'''
+        if self.accumCount==0:
+            with self.timer.phase('optimizer'):
+                self.opt.zero_grad()
+            
+    def backwardLoss(self,loss):
+        '''Feed `loss' backward, dividing by the number of accumulation steps and scaling it if a GradScaler is used.'''
+        if self.accumSteps>1:
+            loss=loss/self.accumSteps
+            
+        with self.timer.phase('backward'):
+            self.scaler.scale(loss).backward()
+        
+    def optimizerStep(self):
+        '''
+        Count one accumulation step and step the optimizer once self.accumSteps of these have been made, first averaging
+        gradients between distributed replicas and clipping gradients if self.gradClip is given. Returns True if the 
+        optimizer was stepped.
+        '''
+        self.accumCount+=1
+        
+        if self.accumCount<self.accumSteps:
+            return False
+        
+        self.accumCount=0
+        self.allReduceGradients()
+        
+        with self.timer.phase('optimizer'):
+            if self.gradClip is not None:
+                self.scaler.unscale_(self.opt)
+                params=[p for group in self.opt.param_groups for p in group['params']]
+                torch.nn.utils.clip_grad_norm_(params,self.gradClip)
+                
+            self.scaler.step(self.opt)
+            self.scaler.update()
+            
+        return True
+    
     def trainStep(self,numSubsteps):
         '''
         Implements the basic training sequence for `numSubsteps' number of times. Each sequence is composed of running
         the network forward, running the loss function forward, zeroing optimizer gradients, feeding the loss result
-        backward, and stepping the optimizer.
+        backward, and stepping the optimizer. The forward passes are run in autocastContext(), and the gradients are 
+        zeroed, fed backward, and stepped with zeroGradients(), backwardLoss(), and optimizerStep() which together 
+        implement mixed precision, gradient accumulation, and gradient clipping as configured in the constructor. The
+        time of each phase is recorded with self.timer.
         '''
         for sub in range(numSubsteps):
-            self.netoutputs=self.netForward()
-            self.lossoutput=self.lossForward()
+            with self.autocastContext():
+                with self.timer.phase('forward'):
+                    self.netoutputs=self.netForward()
+                    
+                with self.timer.phase('loss'):
+                    self.lossoutput=self.lossForward()
             
-            self.opt.zero_grad()
-            self.lossoutput.backward()
-            self.opt.step()
+            self.zeroGradients()
+            self.backwardLoss(self.lossoutput)
+            self.optimizerStep()
 
-    def train(self,inputfunc,steps,substeps=1,savesteps=5):
+    def train(self,inputfunc,steps,substeps=1,savesteps=5,prefetch=False):
         '''
         Train the network for `step' number of steps starting at 1, saving `savesteps' number of times at regular 
         intervals. The callable `inputfunc' is expected to take no arguments and return a tuple pf batch Numpy arrays of 
-        shape, B, BC, BCHW or BCDHW. A train step is composed of these steps:
+        shape, B, BC, BCHW or BCDHW. If `prefetch' is True an InputPrefetcher is used to call `inputfunc' and convert
+        its results for the next step in a separate thread while the current step runs. `inputfunc' must then be safe to
+        call from another thread and is called a step ahead of training. The batch it returns is copied before it's
+        called again so generators reusing buffers (eg. DataSource.threadBatchGen() with `numBuffers' and `autoRelease')
+        can be used, but not those requiring batches to be released manually. A train step is composed of these steps:
             1. `inputfunc' is called, each returned value is converted to a tensor, then tuple of all assigned to self.traininputs
             2. trainStep() is called which is expected to do the following for `substeps' number of times:
               a. self.netForward() is called and results assigned to self.netoutputs
@@ -263,10 +750,14 @@ class NetworkManager(object):
             3. self.updateStep() is called and the loss value is assigned to self.params['loss']
             4. If the model is saved on the current step, self.save() is used to save then self.saveStep() is called
             
-        Throughout the training process self.log() is called regularly to save logging information.
+        Throughout the training process self.log() is called regularly to save logging information. The time spent in
+        each phase of a step (input, convert, forward, loss, backward, optimizer, save, and the whole step) is recorded 
+        in self.timer, the times of each step are logged at DEBUG level, and statistics for all steps are logged at the 
+        end of training.
         '''
         self.log('=================================Starting=================================')
         start=time.time()
+        prefetcher=None
         
         try:
             assert self.opt is not None
@@ -278,22 +769,40 @@ class NetworkManager(object):
             
             if self.net is not None:
                 self.net.train()
+                
+            if prefetch:
+                prefetcher=InputPrefetcher(inputfunc,self.device,count=steps)
             
             for s in range(1,steps+1):
-                self.log('Timestep',s,'/',steps)
+                self.log('Timestep',s,'/',steps,level=logging.DEBUG)
                 self.step+=1
+                stepStart=time.perf_counter()
+                
+                with self.timer.phase('input'):
+                    traininputs=prefetcher() if prefetcher is not None else inputfunc()
                 
                 with self.lock:
-                    self.traininputs=[self.convertArray(arr) for arr in inputfunc()] 
+                    if prefetcher is not None:
+                        self.traininputs=traininputs
+                    else:
+                        with self.timer.phase('convert'):
+                            self.traininputs=[self.convertArray(arr) for arr in traininputs] 
+                        
                     self.trainStep(substeps)
                 
                     lossval=self.lossoutput.item()
-                    self.log('Loss:',lossval)
+                    self.log('Loss:',lossval,level=logging.DEBUG)
                     self.updateStep(s,lossval)
                     self.params['loss']=lossval
                 
-                    if self.savedir and savesteps>0 and (not self.isRunning or s==steps or (s%(steps//savesteps))==0):
-                        self.saveStep(self.step,lossval)
+                    canSave=self.savedir and self.rank==0 and savesteps>0
+                    
+                    if canSave and (not self.isRunning or s==steps or (s%(steps//savesteps))==0):
+                        with self.timer.phase('save'):
+                            self.saveStep(self.step,lossval)
+                            
+                self.timer.add('step',time.perf_counter()-stepStart)
+                self.endStepTiming(lossval)
                     
                 if not self.isRunning:
                     break
@@ -302,16 +811,38 @@ class NetworkManager(object):
             self.log(e)
             raise
         finally:
+            if prefetcher is not None:
+                prefetcher.close()
+                
+            self.waitSaves()
+            
             self.log('Total time (s): %s'%(time.time()-start))
+            self.log('Phase times (s):',self.timer.getStats())
             self.log('Params:',self.params)
             self.log('===================================Done===================================')
+            self.flushLog()
 
-    def evaluate(self,inputs,batchSize=2):
+    def endStepTiming(self,lossval):
+        '''
+        Called at the end of each train step to store the phase times of the step in self.timer, log them at DEBUG level
+        and in the step's JSON record, and add them to the graph values if this is a monitor and params['monitorTimes'].
+        '''
+        times=self.timer.endStep()
+        
+        self.log('Times:',times,level=logging.DEBUG)
+        self.logRecord(step=self.step,loss=lossval,times=times)
+        
+        if self.monitorTimes and times and isinstance(self,trainutils.JupyterThreadMonitor):
+            self.updateGraphVals({'time '+k:v for k,v in times.items()})
+    
+    def evaluate(self,inputs,batchSize=2,out=None):
         '''
         Evaluate the network by applying it to batches of size `batchSize' from the input arrays given in `inputs'. The
         evaluation process differs from training in that the optimizer is not used and inputs are given together as one
         large chunk rather than from than input source callable. The results are a list of loss values one for each batch
-        and a list of outputs one for each batch. The process is:
+        and a list of outputs one for each batch. If `out' is given it is used to create an OutputSink assigned to 
+        self.evalSink which the default evalStep() writes outputs to instead of the results list, the sink's `result'
+        value is then returned in place of the list as infer() does. The process is:
             1. Convert each batch slice of arrays in `inputs' to Variables and store all in self.traininputs
             2. self.netForward() is called and results assigned to self.netoutputs
             3. self.lossForward() is called and results assigned to self.lossoutput
@@ -325,6 +856,7 @@ class NetworkManager(object):
             inputlen=inputs[0].shape[0]
             losses=[]
             results=[]
+            self.evalSink=OutputSink(out,inputlen) if out is not None else None
             
             if self.net is not None:
                 self.net.eval()
@@ -343,6 +875,10 @@ class NetworkManager(object):
                         self.netoutputs=None
                         self.lossoutput=None
                 
+            if self.evalSink is not None:
+                self.evalSink.flush()
+                results=self.evalSink.result
+                
         except Exception as e:
             self.log(e)
             raise
@@ -350,13 +886,16 @@ class NetworkManager(object):
             if self.net is not None:
                 self.net.train()
                 
+            self.evalSink=None
+                
             self.log('Total time (s): %s'%(time.time()-start))
             self.log('Losses:',losses)
             self.log('===================================Done===================================')
+            self.flushLog()
             
         return losses,results
     
-    def infer(self,inputs,batchSize=2):
+    def infer(self,inputs,batchSize=2,out=None):
         '''
         Infer results by applying it to batches of size `batchSize' from the input arrays given in `inputs'. This only 
         uses the forward pass of the network to compute output and does not compute loss or use the optimizer:
@@ -366,11 +905,14 @@ class NetworkManager(object):
             results list, if a single tensor this is converted then appended
             4. Clear the stored variables to free the graph
             
-        The result is a list of converted outputs, one for each batch. 
+        The result is a list of converted outputs, one for each batch. If `out' is given the outputs are instead written
+        to an OutputSink created from it as each batch completes and the sink's `result' value is returned, this is the
+        output array, memmap, or tuple of these, or None if `out' is a callable.
         '''
         assert all(i.shape[0]==inputs[0].shape[0] for i in inputs)
         inputlen=inputs[0].shape[0]
         results=[]
+        sink=OutputSink(out,inputlen) if out is not None else None
         
         try:
             if self.net is not None:
@@ -382,7 +924,9 @@ class NetworkManager(object):
                         self.traininputs=[self.convertArray(arr[i:i+batchSize]) for arr in inputs]
                         self.netoutputs=self.netForward()
     
-                        if isinstance(self.netoutputs,(tuple,list)):
+                        if sink is not None:
+                            sink.write(i,self.outputsToNumpy(self.netoutputs))
+                        elif isinstance(self.netoutputs,(tuple,list)):
                             results.append(tuple(map(self.toNumpy, self.netoutputs)))
                         else:
                             results.append(self.toNumpy(self.netoutputs))
@@ -390,10 +934,85 @@ class NetworkManager(object):
                         self.traininputs=None
                         self.netoutputs=None
 
+            if sink is not None:
+                sink.flush()
+                return sink.result
+            
             return results
         finally:
             if self.net is not None:
                 self.net.train()
+                
+    def inferWindows(self,inputs,windowSize,overlap=0.25,blendMode='gaussian',windowBatchSize=4,padMode='constant'):
+        '''
+        Infer results for inputs larger than the network accepts by applying it to overlapping windows of spatial size
+        `windowSize' (an int for a square or cube window) and blending the results together. The arrays in `inputs' are
+        BC[D]HW with the same batch and spatial dimensions, windows are taken from the same position in each and the
+        network's output is expected to have the same spatial size as its inputs. Windows overlap by the fraction
+        `overlap' of `windowSize' and are weighted by trainutils.windowWeights() using the mode `blendMode', the
+        weighted sum of each window's outputs is accumulated into a preallocated array and normalized by the sum of
+        weights at each position. Windows from all the batch items are stacked into batches of `windowBatchSize' to
+        apply to the network, so this value controls throughput and memory use. Inputs smaller than `windowSize' are
+        padded with mode `padMode'. If self.netoutputs is a list or tuple the first member is used as the result, which
+        is returned as a Numpy array of shape BC[D]HW.
+        '''
+        assert all(i.shape[0]==inputs[0].shape[0] for i in inputs)
+        assert all(i.shape[2:]==inputs[0].shape[2:] for i in inputs)
+        
+        inputlen=inputs[0].shape[0]
+        dims=inputs[0].shape[2:]
+        windowSize=(windowSize,)*len(dims) if isinstance(windowSize,int) else windowSize
+        windowSize=tuple(w or d for w,d in zip(trainutils.ensureTupleSize(windowSize,len(dims)),dims))
+        paddedDims=tuple(max(d,w) for d,w in zip(dims,windowSize))
+        
+        if paddedDims!=dims:
+            pad=[(0,0),(0,0)]+[(0,p-d) for p,d in zip(paddedDims,dims)]
+            inputs=[np.pad(arr,pad,padMode) for arr in inputs]
+            
+        weights=trainutils.windowWeights(windowSize,blendMode)
+        windows=list(trainutils.iterWindowSlices(paddedDims,windowSize,overlap))
+        weightSum=np.zeros(paddedDims,np.float32)
+        result=None
+        
+        for slices in windows:
+            weightSum[slices]+=weights
+            
+        # every (batch index, window slices) pair to apply
+        items=[(b,slices) for b in range(inputlen) for slices in windows]
+        
+        try:
+            if self.net is not None:
+                self.net.eval()
+                
+            with torch.no_grad():
+                for i in range(0,len(items),windowBatchSize):
+                    batchItems=items[i:i+windowBatchSize]
+                    
+                    with self.lock:
+                        self.traininputs=[]
+                        for arr in inputs:
+                            batch=np.stack([arr[(b,slice(None))+slices] for b,slices in batchItems])
+                            self.traininputs.append(self.convertArray(batch))
+                            
+                        self.netoutputs=self.netForward()
+                        out=self.netoutputs
+                        out=self.toNumpy(out[0] if isinstance(out,(tuple,list)) else out)
+    
+                        self.traininputs=None
+                        self.netoutputs=None
+                    
+                    if result is None:
+                        result=np.zeros((inputlen,out.shape[1])+paddedDims,np.float32)
+                        
+                    for o,(b,slices) in zip(out,batchItems):
+                        result[(b,slice(None))+slices]+=o*weights
+                    
+            result/=weightSum
+            
+            return result[(slice(None),slice(None))+tuple(slice(0,d) for d in dims)]
+        finally:
+            if self.net is not None:
+                self.net.train()
     
     
 class SegmentMgr(NetworkManager):
@@ -467,41 +1086,53 @@ class DiscriminatorMgr(NetworkManager):
         loss=loss if loss is not None else torch.nn.BCELoss()
         super().__init__(net,loss,isCuda,opt,saveDirPrefix,savePrefix,**params)
     
+    def setDistributed(self,rank,worldSize):
+        super().setDistributed(rank,worldSize)
+        self.realDataSrc.shardRandom(rank,worldSize)
+        
     def trainStep(self,numSubsteps):
         realinputs=self.traininputs # already filled by train()
         geninputs=[self.convertArray(arr) for arr in self.geninputfunc()] 
         
         for s in range(numSubsteps):
             if self.stepOptimizer:
-                self.opt.zero_grad()
+                self.zeroGradients()
     
             # train with real images
             self.traininputs=realinputs 
-            self.netoutputs=self.netForward()
-            self.realloss=self.lossForward()
+            with self.autocastContext():
+                with self.timer.phase('forward'):
+                    self.netoutputs=self.netForward()
+                    
+                with self.timer.phase('loss'):
+                    self.realloss=self.lossForward()
             
             if self.separateBackward:
-                self.realloss.backward()
+                self.backwardLoss(self.realloss)
     
             # train with generated images
             self.traininputs=geninputs
-            self.netoutputs=self.netForward()
-            self.genloss=self.lossForward()
+            with self.autocastContext():
+                with self.timer.phase('forward'):
+                    self.netoutputs=self.netForward()
+                    
+                with self.timer.phase('loss'):
+                    self.genloss=self.lossForward()
             
             if self.separateBackward:
-                self.genloss.backward()
+                self.backwardLoss(self.genloss)
     
             self.lossoutput=self.realloss+self.genloss
     
             if not self.separateBackward:
-                self.lossoutput.backward()
+                self.backwardLoss(self.lossoutput)
     
             if self.stepOptimizer:
-                self.opt.step()
+                self.optimizerStep()
     
-    def train(self,realinputfunc,geninputfunc,steps,substeps=1,savesteps=5):
+    def train(self,realinputfunc,geninputfunc,steps,substeps=1,savesteps=5,prefetch=False):
         self.geninputfunc=geninputfunc
-        NetworkManager.train(self,realinputfunc,steps,substeps,savesteps)
+        NetworkManager.train(self,realinputfunc,steps,substeps,savesteps,prefetch)
         self.geninputfunc=None
     
     def trainDiscriminator(self,batchSize,steps,substeps=1,savesteps=5,numThreads=None,clearBuffer=True):
@@ -537,6 +1168,10 @@ class GeneratorMgr(NetworkManager):
             loss=disc
             
         super().__init__(net,loss,isCuda,opt,saveDirPrefix,savePrefix,**params)
+        
+    def setDistributed(self,rank,worldSize):
+        super().setDistributed(rank,worldSize)
+        self.disc.setDistributed(rank,worldSize)
     
     def lossForward(self):
         preds=self.netoutputs[0]
@@ -578,10 +1213,20 @@ class CycleGANMgr(NetworkManager):
         imA,_,imB,_=self.traininputs
         return self.net(imA,imB)
     
+    def setDistributed(self,rank,worldSize):
+        super().setDistributed(rank,worldSize)
+        self.discA.setDistributed(rank,worldSize)
+        self.discB.setDistributed(rank,worldSize)
+    
     def saveStep(self,step,steploss):
         self.discA.saveStep(step,steploss)
         self.discB.saveStep(step,steploss)
         super().saveStep(step,steploss)
+        
+    def waitSaves(self):
+        self.discA.waitSaves()
+        self.discB.waitSaves()
+        super().waitSaves()
     
     def trainStep(self,numSubsteps):
         super().trainStep(numSubsteps)
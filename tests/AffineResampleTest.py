@@ -0,0 +1,47 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of the fused affine resampling kernel affineResample() against the ndimage functions it replaces, run from the
+tests directory like the notebooks with "python AffineResampleTest.py". Each check prints the largest difference found
+and fails with an AssertionError if this exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys
+import numpy as np
+import scipy.ndimage as ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import trainutils, augments
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+def testAffineResample():
+    '''Compare affineResample() using the rotate and shift affine forms with ndimage.rotate() and ndimage.shift().'''
+    im=np.zeros((2,64,48))
+    im[:,10:20,5:15]=1
+
+    with trainutils.useRandom(np.random.default_rng(1)):
+        rotmats=augments.rotateAffine(im)
+        shiftmats=augments.shiftAffine(im)
+
+    result=augments.affineResample(im,rotmats,1)
+    shifted=augments.affineResample(im,shiftmats,1)
+
+    for i in range(im.shape[0]):
+        angle=np.rad2deg(np.arctan2(rotmats[i,0,1],rotmats[i,0,0]))
+        ref=ndimage.rotate(im[i],angle,reshape=False,order=1)
+        check('affineResample rotate item %i'%i,np.abs(result[i]-ref).max())
+
+        ref=ndimage.shift(im[i],-shiftmats[i,:2,2],order=1)
+        check('affineResample shift item %i'%i,np.abs(shifted[i]-ref).max())
+
+
+if __name__=='__main__':
+    testAffineResample()
+    print('All checks passed')
@@ -0,0 +1,102 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of batching concurrent NetServ inference requests with netserv.BatchScheduler, run from the tests directory like
+the notebooks with "python BatchSchedulerTest.py" (this requires the NetServ dependencies such as Flask). Each check
+fails with an AssertionError if the scheduler misbehaves.
+'''
+
+from __future__ import print_function,division
+import os, sys, time, threading
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','NetServ'))
+import netserv
+
+
+class RecordingContainer(netserv.InferenceContainer):
+    '''Container recording the size and arguments of each batch, and whether it was ever used concurrently.'''
+    def __init__(self,maxBatchSize,resultCount=None):
+        super().__init__('recording','Test container',{},{},{},maxBatchSize)
+        self.batches=[]
+        self.resultCount=resultCount
+        self.active=0
+        self.concurrent=False
+
+    def inferBatch(self,inputs,scale=1,fail=False):
+        self.active+=1
+        self.concurrent=self.concurrent or self.active>1
+        time.sleep(0.02)
+        self.active-=1
+        self.batches.append((len(inputs),scale))
+
+        if fail:
+            raise ValueError('Inference failed')
+
+        return [inp*scale for inp in inputs][:self.resultCount]
+
+
+def submitAll(scheduler,count,getArgs=lambda i:{}):
+    '''Submit `count' requests at once from separate threads, returning the list of results or raised exceptions.'''
+    results=[None]*count
+
+    def _submit(i):
+        try:
+            results[i]=scheduler.submit(np.full((2,),i),**getArgs(i))
+        except Exception as e:
+            results[i]=e
+
+    threads=[threading.Thread(target=_submit,args=(i,)) for i in range(count)]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+        assert not t.is_alive(), 'Request was never answered'
+
+    return results
+
+
+def testBatching():
+    '''Check requests are grouped by their arguments into batches of up to maxBatchSize and each gets its own result.'''
+    container=RecordingContainer(4)
+    scheduler=netserv.BatchScheduler(container,maxDelay=0.1)
+    results=submitAll(scheduler,10,lambda i:{'scale':2} if i%3==0 else {})
+
+    for i,result in enumerate(results):
+        assert np.array_equal(result,np.full((2,),i*(2 if i%3==0 else 1))), (i,result)
+
+    assert sum(b[0] for b in container.batches)==10 and max(b[0] for b in container.batches)<=4, container.batches
+    assert len(container.batches)<10, 'Requests were not batched: %r'%container.batches
+    print('batching ok',container.batches)
+
+
+def testSingleBatch():
+    '''Check a container with maxBatchSize 1 is given requests one at a time and never concurrently.'''
+    container=RecordingContainer(1)
+    scheduler=netserv.BatchScheduler(container)
+    results=submitAll(scheduler,6)
+
+    assert all(np.array_equal(r,np.full((2,),i)) for i,r in enumerate(results))
+    assert all(b[0]==1 for b in container.batches) and not container.concurrent
+    print('single batches ok')
+
+
+def testErrors():
+    '''Check exceptions from inferBatch(), and too few results, are raised in every request of the batch.'''
+    scheduler=netserv.BatchScheduler(RecordingContainer(4),maxDelay=0.1)
+    results=submitAll(scheduler,3,lambda i:{'fail':True})
+    assert all(isinstance(r,ValueError) for r in results), results
+
+    scheduler=netserv.BatchScheduler(RecordingContainer(4,resultCount=1),maxDelay=0.1)
+    results=submitAll(scheduler,3)
+    assert all(isinstance(r,ValueError) for r in results), results
+    print('errors ok')
+
+
+if __name__=='__main__':
+    testBatching()
+    testSingleBatch()
+    testErrors()
+    print('All checks passed')
@@ -0,0 +1,46 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of the deformation field kernel mapField() against map_coordinates(), run from the tests directory like the
+notebooks with "python DeformFieldTest.py". Each check prints the largest difference found and fails with an
+AssertionError if this exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys
+import numpy as np
+import scipy.ndimage as ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import augments
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+def testMapField():
+    '''Compare mapField() with map_coordinates() for orders 0 and 1, including coordinates on and past the edges.'''
+    rng=np.random.default_rng(0)
+    h,w=40,48
+    field=np.stack(np.meshgrid(np.arange(h),np.arange(w),indexing='ij')).astype(float)+rng.uniform(-3,3,(2,h,w))
+    field[1,0,:5]=[w-0.7,-0.3,w-1,0,-0.5]
+
+    for dtype in (np.float32,np.uint8):
+        im=(rng.random((h,w))*250).astype(dtype)
+
+        for order in (0,1):
+            ref=ndimage.map_coordinates(im,field,order=order,mode='constant')
+            result=augments.mapField(im,field,order)
+            check('mapField %s order %i'%(dtype.__name__,order),np.abs(result.astype(float)-ref.astype(float)).max())
+
+    im=rng.random((h,w,3)).astype(np.float32)
+    ref=np.stack([ndimage.map_coordinates(im[...,c],field,order=1,mode='constant') for c in range(3)],2)
+    check('mapField channels order 1',np.abs(augments.mapField(im,field,1)-ref).max())
+
+
+if __name__=='__main__':
+    testMapField()
+    print('All checks passed')
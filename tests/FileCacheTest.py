@@ -0,0 +1,134 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of the LRU file cache datasource.FileCache in private and shared memory modes, run from the tests directory like
+the notebooks with "python FileCacheTest.py". Each check fails with an AssertionError if the cache misbehaves.
+'''
+
+from __future__ import print_function,division
+import os, sys, time, threading, pickle
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import datasource
+
+
+itemSize=1000 # elements in each loaded array, 8000 bytes
+
+
+def loadPath(path):
+    '''Load function returning an array filled with the number in `path'.'''
+    return np.full((itemSize,),float(path.split('_')[-1]))
+
+
+def failLoad(path):
+    raise IOError('File %r should have been attached to, not loaded'%path)
+
+
+def testEviction():
+    '''Check the least recently used unpinned entries are evicted to keep within the budget.'''
+    cache=datasource.FileCache(loadPath,maxSize=3*itemSize*8)
+
+    for i in range(3):
+        assert cache.get('file_%i'%i)[0]==i
+
+    cache.get('file_0') # order is now file_1, file_2, file_0
+    cache.pin('file_1') # a hit since it's already loaded, moving it to the end
+    cache.get('file_3') # evicts file_2
+
+    assert 'file_2' not in cache and all(('file_%i'%i) in cache for i in (0,1,3)), list(cache.entries)
+    stats=cache.getStats()
+    assert stats['hits']==2 and stats['misses']==4 and stats['numPinned']==1, stats
+    assert stats['currentSize']<=stats['maxSize']
+
+    cache.unpin('file_1')
+    cache.get('file_4') # file_0 is now the least recently used
+    assert list(cache.entries)==['file_1','file_3','file_4'], list(cache.entries)
+    print('eviction and pinning ok')
+
+
+def testConcurrentLoad():
+    '''Check that threads requesting the same file at once load it only once.'''
+    loads=[]
+
+    def slowLoad(path):
+        loads.append(path)
+        time.sleep(0.1)
+        return loadPath(path)
+
+    cache=datasource.FileCache(slowLoad)
+    results=[]
+    threads=[threading.Thread(target=lambda:results.append(cache.get('file_7'))) for _ in range(8)]
+
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert loads==['file_7'] and len(results)==8 and all(r[0]==7 for r in results), loads
+    print('concurrent load ok')
+
+
+def attachProc(state,queue):
+    cache=pickle.loads(state)
+    queue.put(float(cache.get('file_5')[0]))
+    cache.close()
+
+
+def testSharedAttach():
+    '''Check a copy of a shared cache in a spawned process attaches to a loaded block rather than loading the file.'''
+    cache=datasource.FileCache(loadPath,sharedMode='shm')
+    cache.get('file_5')
+
+    copy=pickle.loads(pickle.dumps(cache))
+    copy.loadFunc=failLoad
+    state=pickle.dumps(copy)
+
+    ctx=mp.get_context('spawn')
+    queue=ctx.Queue()
+    proc=ctx.Process(target=attachProc,args=(state,queue))
+    proc.start()
+    value=queue.get(timeout=60)
+    proc.join()
+
+    assert value==5 and proc.exitcode==0, (value,proc.exitcode)
+
+    name=cache.getBlockName('file_5')
+    cache.close()
+
+    try:
+        shared_memory.SharedMemory(name=name).close()
+        raise AssertionError('Block %r was not unlinked by close()'%name)
+    except FileNotFoundError:
+        pass
+
+    print('shared attach ok')
+
+
+def testStaleBlock():
+    '''Check a block left without a header by a failed creator is removed and the file loaded after the timeout.'''
+    cache=datasource.FileCache(loadPath,sharedMode='shm')
+    cache.headerTimeout=0.2
+    stale=shared_memory.SharedMemory(name=cache.getBlockName('file_9'),create=True,size=cache.headerSize+8)
+
+    try:
+        start=time.time()
+        assert cache.get('file_9')[0]==9
+        assert time.time()-start<5.0
+        assert cache.entries['file_9'][2] # this process created the replacement block
+    finally:
+        cache.close()
+        stale.close()
+
+    print('stale block ok')
+
+
+if __name__=='__main__':
+    testEviction()
+    testConcurrentLoad()
+    testSharedAttach()
+    testStaleBlock()
+    print('All checks passed')
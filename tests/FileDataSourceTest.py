@@ -0,0 +1,104 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of concurrent loading and next-batch prefetching in datasource.FileDataSource, run from the tests directory like
+the notebooks with "python FileDataSourceTest.py". Each check fails with an AssertionError if the source misbehaves.
+'''
+
+from __future__ import print_function,division
+import os, sys, time, shutil, tempfile
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import datasource
+
+
+loadDelay=0.05 # seconds each file load takes
+
+
+class SlowFileDataSource(datasource.FileDataSource):
+    '''Source whose file loads take `loadDelay' seconds, as they would with files on a slow disk.'''
+    def loadFile(self,path):
+        time.sleep(loadDelay)
+        return super().loadFile(path)
+
+
+def createFiles(dirName,count):
+    '''Write `count' images to `dirName' each filled with its index, returning the list of file names.'''
+    files=[]
+
+    for i in range(count):
+        files.append(os.path.join(dirName,'%03i.png'%i))
+        Image.fromarray(np.full((16,16),i,np.uint8)).save(files[-1])
+
+    return files
+
+
+def sharedBlocks():
+    return set(f for f in os.listdir('/dev/shm') if f.startswith('dlu')) if os.path.isdir('/dev/shm') else set()
+
+
+def testPrefetchSequence(files):
+    '''Check batches are the same with and without prefetching and that prefetching makes the next batch a cache hit.'''
+    batches={}
+
+    for prefetch in (False,True):
+        src=SlowFileDataSource(files,numLoadThreads=4,prefetch=prefetch,seed=0)
+
+        try:
+            batches[prefetch]=[src.getRandomBatch(8)[0] for _ in range(3)]
+            time.sleep(loadDelay*8) # give the prefetch time to finish
+            start=time.time()
+            batches[prefetch].append(src.getRandomBatch(8)[0])
+            elapsed=time.time()-start
+        finally:
+            src.releaseShared()
+
+        assert src.loadPool is None
+        print('prefetch %s last batch time %.3f'%(prefetch,elapsed))
+
+        if prefetch:
+            assert elapsed<loadDelay, 'Prefetched batch took %.3f'%elapsed
+
+    for a,b in zip(batches[False],batches[True]):
+        assert np.array_equal(a,b), 'Prefetching changed the batch sequence'
+
+    # each item is an image filled with its file index
+    assert all(len(np.unique(img))==1 for batch in batches[True] for img in batch)
+
+
+def testReleaseWithPending(files):
+    '''Check releasing the source while prefetch loads are running leaves no shared memory blocks behind.'''
+    before=sharedBlocks()
+    src=SlowFileDataSource(files,numLoadThreads=4,prefetch=True,sharedCache=True,seed=1)
+    src.getRandomBatch(6) # starts prefetching the next batch
+    src.releaseShared()
+
+    leftover=sharedBlocks()-before
+    assert not leftover, 'Leaked blocks %r'%sorted(leftover)
+    print('release with pending prefetch ok')
+
+
+def testDefaultNoPrefetch(files):
+    src=SlowFileDataSource(files)
+    src.getRandomBatch(4)
+
+    assert not src.prefetch and src.nextChosen is None and len(src.cache)<=4
+    src.releaseShared()
+    print('prefetch off by default ok')
+
+
+if __name__=='__main__':
+    dirName=tempfile.mkdtemp()
+
+    try:
+        files=createFiles(dirName,64)
+        testPrefetchSequence(files)
+        testReleaseWithPending(files)
+        testDefaultNoPrefetch(files)
+    finally:
+        shutil.rmtree(dirName)
+
+    print('All checks passed')
@@ -0,0 +1,43 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of sliding-window inference with NetworkManager.inferWindows() against NetworkManager.infer(), run from the tests
+directory like the notebooks with "python InferWindowsTest.py". Each check prints the largest difference found and fails
+with an AssertionError if this exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pytorchutils
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+def testInferWindows():
+    '''Compare inferWindows() with infer() for a pointwise network, where blending windows must reproduce the identity.'''
+    x=np.random.default_rng(2).random((3,2,37,29)).astype(np.float32)
+    mgr=pytorchutils.NetworkManager(torch.nn.Conv2d(2,3,1),None,isCuda=False)
+    full=mgr.infer([x],3)[0]
+
+    for blendMode in ('gaussian','constant'):
+        result=mgr.inferWindows([x],(16,16),0.5,blendMode,windowBatchSize=5)
+        check('inferWindows %s'%blendMode,np.abs(result-full).max())
+
+    result=mgr.inferWindows([x],16,0.5) # int window size for a square window
+    check('inferWindows int window',np.abs(result-full).max())
+
+    result=mgr.inferWindows([x],(64,64)) # window larger than the input
+    check('inferWindows padded',np.abs(result-full).max())
+
+
+if __name__=='__main__':
+    testInferWindows()
+    print('All checks passed')
@@ -0,0 +1,101 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of memory-mapping .npz members with datastream.mapNPZArrays() and the lazy mode of NPZFileSource, run from the
+tests directory like the notebooks with "python NPZMapTest.py". Each check fails with an AssertionError if the mapped
+arrays differ from those loaded by np.load().
+'''
+
+from __future__ import print_function,division
+import os, sys, time, shutil, tempfile
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import datastream
+
+
+def createArrays():
+    rng=np.random.default_rng(0)
+    return dict(
+        images=rng.random((20,8,8)).astype(np.float32),
+        labels=np.arange(20),
+        fortran=np.asfortranarray(rng.random((5,6))),
+        empty=np.zeros((0,3),np.int16),
+    )
+
+
+def checkMapped(fileName,arrays,cacheDir):
+    mapped=datastream.mapNPZArrays(fileName,list(arrays),cacheDir)
+
+    for name,arr in arrays.items():
+        assert isinstance(mapped[name],np.memmap), '%s is not mapped'%name
+        assert not mapped[name].flags.writeable, '%s is writeable'%name
+        assert mapped[name].dtype==arr.dtype and mapped[name].shape==arr.shape, name
+        assert np.array_equal(mapped[name],arr), '%s differs'%name
+
+    return mapped
+
+
+def testUncompressed(dirName):
+    '''Check uncompressed members are mapped from the .npz file itself without extracting anything.'''
+    arrays=createArrays()
+    fileName=os.path.join(dirName,'uncompressed.npz')
+    cacheDir=os.path.join(dirName,'uncompressed.cache')
+    np.savez(fileName,**arrays)
+
+    mapped=checkMapped(fileName,arrays,cacheDir)
+    assert not os.path.isdir(cacheDir) or not os.listdir(cacheDir), 'Uncompressed members were extracted'
+    assert mapped['images'].filename==os.path.abspath(fileName)
+    print('uncompressed ok')
+
+
+def testCompressed(dirName):
+    '''Check compressed members are extracted to the cache once and the cached files reused while newer than the .npz.'''
+    arrays=createArrays()
+    fileName=os.path.join(dirName,'compressed.npz')
+    cacheDir=os.path.join(dirName,'compressed.cache')
+    np.savez_compressed(fileName,**arrays)
+
+    checkMapped(fileName,arrays,cacheDir)
+    cached=sorted(os.listdir(cacheDir))
+    mtimes=[os.path.getmtime(os.path.join(cacheDir,f)) for f in cached]
+    assert len(cached)==len(arrays), cached
+
+    time.sleep(0.05)
+    checkMapped(fileName,arrays,cacheDir)
+    assert mtimes==[os.path.getmtime(os.path.join(cacheDir,f)) for f in cached], 'Cached files were extracted again'
+
+    arrays['labels']=arrays['labels']*2 # rewriting the .npz makes the cached files stale
+    time.sleep(0.05)
+    np.savez_compressed(fileName,**arrays)
+    checkMapped(fileName,arrays,cacheDir)
+    print('compressed ok')
+
+
+def testLazySource(dirName):
+    '''Check NPZFileSource in lazy mode produces the same items as in normal mode.'''
+    arrays=createArrays()
+    fileName=os.path.join(dirName,'source.npz')
+    np.savez_compressed(fileName,**arrays)
+
+    src=datastream.NPZFileSource(fileName,['images','labels'],doOnce=True)
+    lazy=datastream.NPZFileSource(fileName,['images','labels'],doOnce=True,lazy=True)
+
+    for item,lazyItem in zip(src,lazy):
+        assert all(np.array_equal(a,b) for a,b in zip(item,lazyItem))
+
+    print('lazy source ok')
+
+
+if __name__=='__main__':
+    dirName=tempfile.mkdtemp()
+
+    try:
+        testUncompressed(dirName)
+        testCompressed(dirName)
+        testLazySource(dirName)
+    finally:
+        shutil.rmtree(dirName)
+
+    print('All checks passed')
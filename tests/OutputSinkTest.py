@@ -0,0 +1,86 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of streaming NetworkManager.evaluate() and infer() outputs into arrays, memmap files, and callables through
+OutputSink, run from the tests directory like the notebooks with "python OutputSinkTest.py". Each check prints the
+largest difference found and fails with an AssertionError if this exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys, shutil, tempfile
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pytorchutils
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+class TwoOutputNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv=torch.nn.Conv2d(1,2,1)
+
+    def forward(self,x):
+        out=self.conv(x)
+        return out,out.mean(axis=(2,3))
+
+
+class MeanLossManager(pytorchutils.NetworkManager):
+    def lossForward(self):
+        return self.netoutputs[0].mean()
+
+
+def testInferSink():
+    '''Compare infer() writing to an array, memmap files, and a callable with infer() returning its list of results.'''
+    x=np.random.default_rng(0).random((7,1,8,8)).astype(np.float32)
+    mgr=MeanLossManager(TwoOutputNet(),None,isCuda=False)
+    expected=mgr.infer([x],7)[0]
+    dirName=tempfile.mkdtemp()
+
+    try:
+        out=(np.zeros((7,2,8,8),np.float32),np.zeros((7,2),np.float32))
+        result=mgr.infer([x],3,out=out)
+        assert all(r is o for r,o in zip(result,out))
+        check('infer array sink',max(np.abs(r-e).max() for r,e in zip(result,expected)))
+
+        result=mgr.infer([x],3,out=os.path.join(dirName,'infer.npy'))
+        assert all(isinstance(r,np.memmap) for r in result)
+        loaded=[np.load(os.path.join(dirName,'infer_%i.npy'%i)) for i in range(2)]
+        check('infer memmap sink',max(np.abs(l-e).max() for l,e in zip(loaded,expected)))
+
+        indices=[]
+        result=mgr.infer([x],3,out=lambda index,outputs:indices.append((index,outputs[0].shape[0])))
+        assert result is None and indices==[(0,3),(3,3),(6,1)], indices
+    finally:
+        shutil.rmtree(dirName,ignore_errors=True)
+
+
+def testEvaluateSink():
+    '''Check evaluate() returns the sink result when given an output, and its losses match those without one.'''
+    x=np.random.default_rng(1).random((5,1,8,8)).astype(np.float32)
+    mgr=MeanLossManager(TwoOutputNet(),None,isCuda=False)
+    expected=mgr.infer([x],5)[0]
+    losses,_=mgr.evaluate([x],2)
+    dirName=tempfile.mkdtemp()
+
+    try:
+        fileName=os.path.join(dirName,'eval.npy')
+        sinkLosses,result=mgr.evaluate([x],2,out=fileName)
+        check('evaluate losses',np.abs(np.asarray(sinkLosses)-losses).max())
+        check('evaluate memmap sink',np.abs(result[0]-expected[0]).max())
+        check('evaluate memmap file',np.abs(np.load(os.path.join(dirName,'eval_0.npy'))-expected[0]).max())
+        assert mgr.evalSink is None
+    finally:
+        shutil.rmtree(dirName,ignore_errors=True)
+
+
+if __name__=='__main__':
+    testInferSink()
+    testEvaluateSink()
+    print('All checks passed')
@@ -0,0 +1,52 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of writing and reading the packed dataset format in packeddata, run from the tests directory like the notebooks
+with "python PackedDataTest.py". Each check prints the largest difference found and fails with an AssertionError if this
+exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys, shutil, tempfile
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import packeddata
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+def testPackedRoundTrip():
+    '''Write arrays to a packed dataset with several shards and read them back.'''
+    rng=np.random.default_rng(3)
+    images=rng.random((50,8,8)).astype(np.float32)
+    labels=np.arange(50)
+    ragged=[rng.random((i%5+1,3)) for i in range(50)]
+    dirName=tempfile.mkdtemp()
+
+    try:
+        packeddata.writePacked(dirName,images,labels,fieldNames=['images','labels'],shardSize=1000)
+        reader=packeddata.PackedReader(dirName)
+        assert len(reader)==images.shape[0] and len(reader.shardNames)>1
+        check('packed images',np.abs(np.asarray(reader.getField('images'))-images).max(),0)
+        check('packed labels',np.abs(np.asarray(reader.getField('labels'))-labels).max(),0)
+
+        shutil.rmtree(dirName)
+
+        with packeddata.PackedWriter(dirName,['ragged']) as writer:
+            for r in ragged:
+                writer.append(r)
+
+        reader=packeddata.PackedReader(dirName)
+        check('packed ragged',max(np.abs(reader[i][0]-r).max() for i,r in enumerate(ragged)),0)
+    finally:
+        shutil.rmtree(dirName,ignore_errors=True)
+
+
+if __name__=='__main__':
+    testPackedRoundTrip()
+    print('All checks passed')
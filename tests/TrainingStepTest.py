@@ -0,0 +1,97 @@
+# DeepLearnUtils
+# Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
+
+'''
+Checks of gradient accumulation, gradient clipping, and mixed precision in NetworkManager.trainStep(), run from the
+tests directory like the notebooks with "python TrainingStepTest.py". Each check prints the largest difference found
+and fails with an AssertionError if this exceeds its tolerance.
+'''
+
+from __future__ import print_function,division
+import os, sys
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pytorchutils
+
+
+def check(name,diff,tol=1e-5):
+    print('%-40s max diff %g'%(name,diff))
+    assert diff<=tol, '%s: difference %g exceeds %g'%(name,diff,tol)
+
+
+class TupleLinear(torch.nn.Linear):
+    def forward(self,x):
+        return (super().forward(x),)
+
+
+def createManager(**params):
+    torch.manual_seed(0)
+    net=TupleLinear(4,2)
+    opt=torch.optim.SGD(net.parameters(),lr=params.pop('lr',0.1))
+    return pytorchutils.NetworkManager(net,torch.nn.MSELoss(),isCuda=False,opt=opt,**params)
+
+
+def getWeights(mgr):
+    return torch.cat([p.detach().reshape(-1) for p in mgr.net.parameters()]).numpy()
+
+
+def runStep(mgr,*inputs):
+    mgr.traininputs=[mgr.convertArray(arr) for arr in inputs]
+    mgr.trainStep(1)
+
+
+def testAccumulation():
+    '''Check accumulating gradients over two half batches gives the same step as one full batch.'''
+    rng=np.random.default_rng(0)
+    x=rng.random((8,4)).astype(np.float32)
+    y=rng.random((8,2)).astype(np.float32)
+
+    full=createManager()
+    runStep(full,x,y)
+
+    accum=createManager(accumSteps=2)
+    start=getWeights(accum)
+    runStep(accum,x[:4],y[:4])
+    check('weights unchanged after first half',np.abs(getWeights(accum)-start).max(),0)
+    runStep(accum,x[4:],y[4:])
+    check('accumulated step',np.abs(getWeights(accum)-getWeights(full)).max())
+
+
+def testClipping():
+    '''Check the gradient norm is clipped to gradClip, so an SGD step of rate 1 moves the weights by at most that.'''
+    rng=np.random.default_rng(1)
+    x=rng.random((8,4)).astype(np.float32)*100
+    y=np.zeros((8,2),np.float32)
+    clip=0.01
+
+    mgr=createManager(lr=1.0,gradClip=clip)
+    start=getWeights(mgr)
+    runStep(mgr,x,y)
+    norm=np.linalg.norm(getWeights(mgr)-start)
+    check('clipped step norm over limit',max(0,norm-clip),1e-6)
+    assert norm>clip/2, 'Step of norm %g was not taken'%norm
+
+
+def testAutocast():
+    '''Check forward passes run in reduced precision with autocast and the full precision weights are still updated.'''
+    rng=np.random.default_rng(2)
+    x=rng.random((8,4)).astype(np.float32)
+    y=rng.random((8,2)).astype(np.float32)
+
+    mgr=createManager(autocast=True,autocastDtype=torch.bfloat16)
+    start=getWeights(mgr)
+    runStep(mgr,x,y)
+
+    assert mgr.netoutputs[0].dtype==torch.bfloat16, mgr.netoutputs[0].dtype
+    assert all(p.dtype==torch.float32 for p in mgr.net.parameters())
+    assert np.isfinite(mgr.lossoutput.item()) and np.abs(getWeights(mgr)-start).max()>0
+    print('autocast ok')
+
+
+if __name__=='__main__':
+    testAccumulation()
+    testClipping()
+    testAutocast()
+    print('All checks passed')
@@ -4,44 +4,76 @@
 
 from __future__ import division, print_function
 import argparse
+import tempfile
 import nibabel
 import tensorflow as tf
 import numpy as np
 
-from segmenter import Segmenter
-from trainutils import rescaleArray
+from tfsegmenter import Segmenter
 
 
-def applySegmentation(metafilename,img,device='/gpu:0',conf=None):
+def getPlaneIndex(ndim,s,t):
+    '''Returns the index tuple selecting the XY plane (with any channel dimension) at slice `s' and time `t' of a `ndim' image.'''
+    return (slice(None),slice(None))+(s,t)[:max(0,ndim-2)]
+
+
+def iterPlaneChunks(img,chunkSize):
+    '''
+    Yields (indices,planes) pairs for the XY planes of `img' in chunks of up to `chunkSize', where `indices' is the list of
+    (s,t) slice and time indices and `planes' is the (N,X,Y,C) float32 array of those planes. Only one chunk is read from
+    `img' at a time so this works with lazily-loading arrays like nibabel image proxies without loading the whole image.
+    '''
+    shape=tuple(img.shape)+(1,1,1)
+    width,height,slices,timesteps,depth=shape[:5]
+    indices=[(s,t) for s in range(slices) for t in range(timesteps)]
+    
+    for i in range(0,len(indices),chunkSize):
+        chunkInds=indices[i:i+chunkSize]
+        planes=np.empty((len(chunkInds),width,height,depth),np.float32)
+        
+        for p,(s,t) in enumerate(chunkInds):
+            planes[p]=np.asarray(img[getPlaneIndex(len(img.shape),s,t)]).reshape(width,height,depth)
+            
+        yield chunkInds,planes
+        
+
+def applySegmentation(metafilename,img,device='/gpu:0',conf=None,out=None,dtype=np.float32,chunkSize=16):
     '''
     Loads the graph from the meta file `metafilename' and predicts segmentations for the image stack `img'. The graph is
     expected to have a collection "endpoints" storing the x,y_,y,ypred list of tensors where x is the input and ypred the
     predicted segmentation. The first 2 dimensions of `img' must be the XY dimensions, other dimensions are flattened out.
-    The values of `img' are also expected to be normalized. Returns a stack of binary masks with the same shape as `img'.
+    Each XY plane is normalized independently before segmenting. Returns a stack of binary masks with the same shape as
+    `img', where for 5D images the mask is in the first channel and others are 0.
+    
+    The image is streamed in chunks of `chunkSize' XY planes so `img' can be a lazily-read array such as the `dataobj'
+    proxy of a nibabel image, with memory use then bounded by the chunk size rather than the image size. The results are
+    written into `out' if given, eg. a np.memmap of the image's shape, otherwise into a new array of type `dtype'. Each
+    chunk is segmented as a batch with Segmenter.applyBatch().
     '''
-    seg=Segmenter(metafilename,device,conf)
+    seg=Segmenter(metafilename,device,conf,chunkSize)
     
     origshape=tuple(img.shape)
     tf.logging.info('Input dimensions: %r'%(origshape,))
     
-    shape=origshape+(1,1,1) # add extra dimensions to the shape to make a 4D shape
-    shape=shape[:5] # clip extra dimensions off so that this is a 5D shape description
-    width,height,slices,timesteps,depth=shape
-    
-    img=img.astype(np.dtype('<f8')).reshape(shape) # convert input into a 5D image of shape XYZTC
-    img=rescaleArray(img)
+    if out is None:
+        out=np.zeros(origshape,dtype)
+    else:
+        assert tuple(out.shape)==origshape, 'Output shape %r does not match input shape %r'%(tuple(out.shape),origshape)
+        out[...]=0
     
-    for s in range(slices):
-        tf.logging.info('Segmenting slice %s'%s)
-        for t in range(timesteps):
-            st=img[...,s,t,:]
+    for indices,planes in iterPlaneChunks(img,chunkSize):
+        tf.logging.info('Segmenting slices/timesteps %r to %r'%(indices[0],indices[-1]))
+        preds=seg.applyBatch(planes) # blank planes produce blank results
+        
+        for (s,t),pred in zip(indices,preds):
+            index=getPlaneIndex(len(origshape),s,t)
             
-            if st.max()>st.min(): # segment if the image is not blank
-                pred=seg.apply(st)
-                img[...,s,t,:]=0
-                img[...,s,t,0]=pred
+            if len(origshape)==5:
+                out[index+(0,)]=pred
+            else:
+                out[index]=pred
                 
-    return img.reshape(origshape) 
+    return out
             
 
 if __name__=='__main__':
@@ -50,17 +82,23 @@ if __name__=='__main__':
     parser.add_argument('infile',help='Nifti file to segment')
     parser.add_argument('outfile',help='Nifti output filename')
     parser.add_argument('--device',help='Tensorflow device name to compute on',default='/gpu:0')
+    parser.add_argument('--chunksize',help='Number of slices to load and segment at once',type=int,default=16)
+    parser.add_argument('--memmap',help='Store the output in a temporary memory-mapped file',action='store_true')
     args=parser.parse_args()
     
     tf.logging.set_verbosity(tf.logging.INFO)
     
     tf.logging.info('Loading '+args.infile)
     infile=nibabel.load(args.infile)
-    dat=infile.get_data()
+    dat=infile.dataobj # array proxy which reads the image data as it's sliced
+    dtype=infile.get_data_dtype()
     
-    preds=applySegmentation(args.metafilename,dat,args.device)
+    out=None
+    if args.memmap:
+        out=np.memmap(tempfile.TemporaryFile(),dtype,'w+',shape=tuple(dat.shape))
+    
+    preds=applySegmentation(args.metafilename,dat,args.device,out=out,dtype=dtype,chunkSize=args.chunksize)
     
     tf.logging.info('Saving '+args.outfile)
-    outfile = nibabel.Nifti1Image(preds.astype(dat.dtype), infile.affine, infile.header)
+    outfile = nibabel.Nifti1Image(preds, infile.affine, infile.header)
     nibabel.save(outfile,args.outfile)
-    
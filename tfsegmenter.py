@@ -23,18 +23,22 @@
 import os
 
 import numpy as np
-from scipy import ndimage
 
 import tensorflow as tf
 
-from trainutils import rescaleArray
+from trainutils import rescaleInstanceArray, getLargestMaskObjects
 
 
 class Segmenter(object):
+    '''
+    Applies the segmentation network loaded from meta graph file `metafilename' to 2D images. Images are center cropped
+    or padded to the network's input size, a single image is segmented by calling this object and a stack of images by
+    applyBatch(). Batches of up to `batchSize' images are run at once, or the network's batch size if this is fixed.
+    '''
     defaultconf = tf.ConfigProto(allow_soft_placement=True)
     defaultconf.gpu_options.allow_growth = True
     
-    def __init__(self,metafilename,device='/gpu:0',conf=None):
+    def __init__(self,metafilename,device='/gpu:0',conf=None,batchSize=32):
         with tf.device(device):
             self.device=device
             conf=conf or self.defaultconf
@@ -63,54 +67,73 @@ class Segmenter(object):
                 
                 self.tempimg=np.ndarray(((1,1) if len(xshape)==5 else (1,))+(self.xwidth,self.xheight,self.xchannels))
                 self.feeddict={self.x:self.tempimg}
+                
+                self.is5D=len(xshape)==5
+                self.fixedBatchSize=xshape[0] # None if the network accepts any batch size
+                self.batchSize=self.fixedBatchSize or batchSize
             
     def __call__(self,img, keepLargest=True,normalizeImg=True,resultScale=None):
         assert img.ndim in (2,3), 'Image dimension must be 2 or 3, is %r'%img.ndim
+        
+        return self.applyBatch(img[np.newaxis],keepLargest,normalizeImg,resultScale)[0]
+    
+    def applyBatch(self,imgs,keepLargest=True,normalizeImg=True,resultScale=None):
+        '''
+        Segment the stack of images `imgs' of shape (N,W,H) or (N,W,H,C), returning the (N,W,H) float32 stack of results.
+        Each image is normalized independently if `normalizeImg' is True, blank images produce blank results and are not
+        run through the network. The non-blank images are center cropped or padded into batches of self.batchSize which
+        are each segmented in one session call. If `keepLargest' is True only the largest object in each result is kept,
+        if `resultScale' is given each result is rescaled to be between 0 and this value.
+        '''
+        assert imgs.ndim in (3,4), 'Image stack dimension must be 3 or 4, is %r'%imgs.ndim
     
-        if img.ndim==2: # extend a (H,W) stack to be (H,W,C) with a single channel
-            img=np.expand_dims(img,axis=-1)
+        if imgs.ndim==3: # extend a (N,H,W) stack to be (N,H,W,C) with a single channel
+            imgs=np.expand_dims(imgs,axis=-1)
             assert self.xchannels==1,'Input image requires %i channels'%self.xchannels
             
-        assert img.shape[-1]==self.xchannels, 'Input image channels %r does not match network input channels %r'%(img.shape[-1],self.xchannels)
+        assert imgs.shape[-1]==self.xchannels, 'Input image channels %r does not match network input channels %r'%(imgs.shape[-1],self.xchannels)
         
-        result=np.zeros(img.shape[:-1],np.float32)
-        imin=img.min()
-        imax=img.max()
+        numImgs,width,height=imgs.shape[:3]
+        result=np.zeros(imgs.shape[:-1],np.float32)
+        axes=tuple(range(1,imgs.ndim))
+        nonblank=np.flatnonzero(imgs.max(axis=axes)>imgs.min(axis=axes))
         
         if normalizeImg:
-            tf.logging.info('Input range: %r %r'%(img.min(),img.max()))
-            img=rescaleArray(img)
+            tf.logging.info('Input range: %r %r'%(imgs.min(),imgs.max()))
+            imgs=rescaleInstanceArray(imgs)
         
-        if imax>imin:
-            tf.logging.info('Segmenting image of dimensions %r on device %r'%(img.shape,self.device))
-            #img=(img-imin)/(imax-imin) # normalize image
-            width,height,depth=img.shape
+        if nonblank.shape[0]>0:
+            tf.logging.info('Segmenting %i images of dimensions %r on device %r'%(nonblank.shape[0],imgs.shape[1:],self.device))
         
             w2=width//2
             h2=height//2
             wmin=min(w2,self.xw2)
             hmin=min(h2,self.xh2)
             
-            st=img[w2-wmin:w2+wmin,h2-hmin:h2+hmin]
-            self.tempimg[...,self.xw2-wmin:self.xw2+wmin,self.xh2-hmin:self.xh2+hmin,:]=st
-        
-            pred=self.sess.run(self.ypred,feed_dict=self.feeddict)
-            pred=np.squeeze(pred[0]) # pred[0,0] if pred.ndim==4 else pred[0]
-            
-            labeled,numfeatures=ndimage.label(pred) # label each separate object with a different number
-            if keepLargest and numfeatures>1: # if there's more than one object in the segmentation, keep only the largest as the best guess
-                tf.logging.info('Segment size: %r'%np.sum(pred))    
-                tf.logging.info('Isolating largest segment feature')
-                sums=ndimage.sum(pred,labeled,range(numfeatures+1)) # sum the pixels under each label
-                maxfeature=np.where(sums==max(sums)) # choose the maximum sum whose index will be the label number
-                pred=pred*(labeled==maxfeature) # mask out the prediction under the largest label
+            batch=np.zeros((self.batchSize,)+self.tempimg.shape[1:],self.tempimg.dtype)
             
-            result[w2-wmin:w2+wmin,h2-hmin:h2+hmin]=pred[self.xw2-wmin:self.xw2+wmin,self.xh2-hmin:self.xh2+hmin]
+            for i in range(0,nonblank.shape[0],self.batchSize):
+                inds=nonblank[i:i+self.batchSize]
+                numInds=inds.shape[0]
+                
+                # networks with a fixed batch size are given the whole batch, zero padded after the last image
+                batchLen=self.batchSize if self.fixedBatchSize else numInds
+                crop=imgs[inds,w2-wmin:w2+wmin,h2-hmin:h2+hmin]
+                batch[:numInds,...,self.xw2-wmin:self.xw2+wmin,self.xh2-hmin:self.xh2+hmin,:]=crop[:,np.newaxis] if self.is5D else crop
+                batch[numInds:]=0
+                
+                pred=self.sess.run(self.ypred,feed_dict={self.x:batch[:batchLen]})
+                pred=pred[:numInds].reshape(numInds,self.xwidth,self.xheight)
+                
+                result[inds,w2-wmin:w2+wmin,h2-hmin:h2+hmin]=pred[:,self.xw2-wmin:self.xw2+wmin,self.xh2-hmin:self.xh2+hmin]
+                
+            if keepLargest: # keep only the largest object in each segmentation as the best guess
+                tf.logging.info('Isolating largest segment features')
+                result[nonblank]=getLargestMaskObjects(result[nonblank])
             
         if resultScale is not None:
             tf.logging.info('Result range: %f %f'%(result.min(),result.max()))
-            result=rescaleArray(result,0,float(resultScale))
+            result=rescaleInstanceArray(result,0,float(resultScale))
             tf.logging.info('Result range: %f %f'%(result.min(),result.max()))
             
         return result
-    
\ No newline at end of file
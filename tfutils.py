@@ -9,6 +9,7 @@ import os
 import datetime
 import collections
 import threading
+import trainutils
 
 try:
     import queue
@@ -94,7 +95,7 @@ class BaseEstimator(tf.estimator.Estimator):
         self.summaries={}
         
         self.logfilename='train.log'
-        self.logqueue=[]
+        self.logWriter=trainutils.LogWriter()
 
         if savedirprefix:
             if os.path.exists(savedirprefix):
@@ -105,14 +106,11 @@ class BaseEstimator(tf.estimator.Estimator):
         tf.estimator.Estimator.__init__(self, model_fn=self._modelfn, model_dir=self.savedir,params=params, config=self.runconf)
         
     def log(self,*items):
-        dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
-        msg=dt+' '.join(map(str,items))
-        self.logqueue.append(msg)
-        
-        if os.path.isdir(self.savedir):
-            with open(os.path.join(self.savedir,self.logfilename),'a') as o:
-                o.write('\n'.join(self.logqueue)+'\n')
-            self.logqueue=[]
+        # messages are buffered by the writer until the save directory exists
+        if self.savedir and os.path.isdir(self.savedir):
+            self.logWriter.fileName=os.path.join(self.savedir,self.logfilename)
+            
+        self.logWriter.log(*items)
 
     def _modelfn(self,features, labels, mode, params):
 
@@ -166,7 +164,7 @@ class BinarySegmentNN(tf.estimator.Estimator):
         self.summaries={}
         
         self.logfilename='train.log'
-        self.logqueue=[]
+        self.logWriter=trainutils.LogWriter()
 
         if savedirprefix:
             if os.path.exists(savedirprefix):
@@ -177,14 +175,11 @@ class BinarySegmentNN(tf.estimator.Estimator):
         tf.estimator.Estimator.__init__(self, model_fn=self._modelfn, model_dir=self.savedir,params=params, config=self.runconf)
         
     def log(self,*items):
-        dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
-        msg=dt+' '.join(map(str,items))
-        self.logqueue.append(msg)
-        
-        if os.path.isdir(self.savedir):
-            with open(os.path.join(self.savedir,self.logfilename),'a') as o:
-                o.write('\n'.join(self.logqueue)+'\n')
-            self.logqueue=[]
+        # messages are buffered by the writer until the save directory exists
+        if self.savedir and os.path.isdir(self.savedir):
+            self.logWriter.fileName=os.path.join(self.savedir,self.logfilename)
+            
+        self.logWriter.log(*items)
 
     def _modelfn(self,features, labels, mode, params):
         global_step = tf.train.get_global_step()
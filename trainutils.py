@@ -3,14 +3,14 @@
 
 
 from __future__ import division, print_function
-import subprocess, re, time, platform, threading, random, contextlib
-from collections import OrderedDict
+import subprocess, re, time, platform, threading, contextlib, datetime, json, logging, atexit, weakref
+from collections import OrderedDict, deque
 from itertools import product, starmap
 import inspect
 import numpy as np
 
 import scipy.spatial
-from scipy.ndimage import label, binary_fill_holes, maximum_filter, sum as ndsum
+from scipy.ndimage import label, binary_fill_holes, maximum_filter, sum as ndsum, find_objects, generate_binary_structure
 
 #import matplotlib.pyplot as plt
 #from matplotlib.ticker import MaxNLocator
@@ -38,9 +38,70 @@ def loadURLMod(url,name=None):
     return mod
 
 
+class GlobalRandom(object):
+    '''
+    Adapter providing the np.random.Generator methods used by augments on top of the global np.random state, this is
+    what getRandom() returns when no generator has been set for the current thread.
+    '''
+    def random(self,size=None):
+        return np.random.random(size)
+    
+    def integers(self,low,high=None,size=None):
+        return np.random.randint(low,high,size)
+    
+    def uniform(self,low=0.0,high=1.0,size=None):
+        return np.random.uniform(low,high,size)
+    
+    def choice(self,a,size=None,replace=True,p=None):
+        return np.random.choice(a,size,replace,p)
+    
+    def shuffle(self,x):
+        np.random.shuffle(x)
+        
+
+globalRandom=GlobalRandom()
+randomLocal=threading.local()
+
+
+def getRandom():
+    '''
+    Returns the np.random.Generator set for the current thread by useRandom(), or `globalRandom' if there is none. Code
+    drawing random values should use this so that callers can provide independent and reproducible random streams.
+    '''
+    rng=getattr(randomLocal,'rng',None)
+    return globalRandom if rng is None else rng
+
+
+@contextlib.contextmanager
+def useRandom(rng):
+    '''
+    Context manager in which getRandom() returns the np.random.Generator `rng' in the current thread, the previous value
+    is restored on exit. If `rng' is None the current generator is left unchanged.
+    '''
+    prev=getattr(randomLocal,'rng',None)
+    if rng is not None:
+        randomLocal.rng=rng
+        
+    try:
+        yield getRandom()
+    finally:
+        randomLocal.rng=prev
+        
+
+def spawnRandom(seedSeq,count=None):
+    '''
+    Returns a new np.random.Generator from the next child of np.random.SeedSequence `seedSeq', or a list of `count' such
+    generators if given. Each generator has an independent stream and is reproducible if `seedSeq' was given a seed.
+    '''
+    if count is None:
+        return np.random.default_rng(seedSeq.spawn(1)[0])
+    
+    return [np.random.default_rng(s) for s in seedSeq.spawn(count)]
+
+
 def randChoice(prob=0.5):
     '''Returns True if a randomly chosen number is less than or equal to `prob', by default this is a 50/50 chance.'''
-    return random.random()<=prob
+    return getRandom().random()<=prob
 
 
 def imgBounds(img):
@@ -49,6 +110,30 @@ def imgBounds(img):
     ax1 = np.any(img, axis=1)
     return np.concatenate((np.where(ax0)[0][[0, -1]], np.where(ax1)[0][[0, -1]]))
 
+
+
+def nonzeroExtremePoints(img):
+    '''
+    Returns a (N,2) array of the first and last non-zero indices in axis 1 for each line in axis 0 of `img' containing a
+    non-zero value, with any further axes collapsed. These points include the vertices of the convex hull of the non-zero
+    region so checking where they land under an affine transform is equivalent to checking the transformed region.
+    '''
+    mask=np.any(img.reshape(img.shape[:2]+(-1,)),axis=2) if img.ndim>2 else img.astype(bool)
+    rows=np.where(np.any(mask,axis=1))[0]
+    first=np.argmax(mask[rows],axis=1)
+    last=mask.shape[1]-1-np.argmax(mask[rows,::-1],axis=1)
+    
+    return np.concatenate([np.stack([rows,first],1),np.stack([rows,last],1)]).astype(float)
+
+
+def pointsInMargins(points,shape,margin):
+    '''
+    Returns True if each of the (N,2) array of index `points' rounded to the nearest index lies outside the `margin'
+    indices of the edges of an image of dimensions `shape', this is the point equivalent of zeroMargins().
+    '''
+    points=np.round(points)
+    return bool(np.all(points>=margin) and np.all(points<(np.asarray(shape[:2])-margin)))
+
     
 def inBounds(x,y,margin,maxx,maxy):
     '''Returns True if (x,y) is within the rectangle (margin,margin,maxx-margin,maxy-margin).'''
@@ -280,11 +365,16 @@ def rescaleArray(arr,minv=0.0,maxv=1.0,dtype=np.float32):
 
 def rescaleInstanceArray(arr,minv=0.0,maxv=1.0,dtype=np.float32):
     '''Rescale each array slice along the first dimension of `arr' independently.'''
-    out=np.zeros(arr.shape,dtype)
-    for i in range(arr.shape[0]):
-        out[i]=rescaleArray(arr[i],minv,maxv,dtype)
+    if dtype is not None:
+        arr=arr.astype(dtype)
         
-    return out
+    axes=tuple(range(1,arr.ndim))
+    mina=np.min(arr,axis=axes,keepdims=True)
+    maxa=np.max(arr,axis=axes,keepdims=True)
+    isFlat=mina==maxa
+    
+    norm=(arr-mina)/np.where(isFlat,1,maxa-mina) # normalize each slice, avoiding division by zero for flat slices
+    return np.where(isFlat,arr*minv,(norm*(maxv-minv))+minv).astype(dtype)
 
 
 def rescaleArrayIntMax(arr,dtype=np.uint16):
@@ -300,6 +390,28 @@ def getLargestMaskObject(mask):
     maxfeature=np.where(sums==max(sums)) # choose the maximum sum whose index will be the label number
     
     return mask*(labeled==maxfeature)
+
+
+def getLargestMaskObjects(masks):
+    '''
+    Given a stack of binary masks `masks' with the stack index as the first dimension, returns an equivalent array with
+    only the largest mask object in each. All masks are labeled together without connecting objects in adjacent masks.
+    '''
+    structure=np.zeros((3,)*masks.ndim,bool)
+    structure[1]=generate_binary_structure(masks.ndim-1,1) # same connectivity as label() within masks, none between them
+    labeled,numfeatures=label(masks,structure)
+    
+    if numfeatures==0:
+        return masks*0
+    
+    labels=np.arange(1,numfeatures+1)
+    sizes=ndsum(masks,labeled,labels)
+    stackInds=np.array([objslices[0].start for objslices in find_objects(labeled)])
+    
+    maxSizes=np.zeros(masks.shape[0])
+    np.maximum.at(maxSizes,stackInds,sizes) # largest object size in each mask
+    
+    return masks*np.isin(labeled,labels[sizes==maxSizes[stackInds]])
     
     
 def getLargestSegments(segments,numClasses=1):
@@ -477,27 +589,74 @@ def equalizeImageHistogram(image, number_bins=512):
     return equalized, cdf
 
 
-def iterPatchSlices(dims,patchSize,startPos=()):
+def iterPatchSlices(dims,patchSize,startPos=(),stride=()):
     '''
     Yield successive tuples of slices defining patches of size `patchSize' from an array of dimensions `dims'. The 
-    iteration starts from position `startPos' in the array, or starting at the origin if this isn't provided.
+    iteration starts from position `startPos' in the array, or starting at the origin if this isn't provided. Patches
+    are spaced `stride' apart in each dimension which defaults to `patchSize', smaller values produce overlapping patches.
     '''
-    # ensure patchSize and startPos are the right length
+    # ensure patchSize, startPos, and stride are the right length
     ndim=len(dims)
     patchSize=ensureTupleSize(patchSize,ndim)
     startPos=ensureTupleSize(startPos,ndim)
+    stride=ensureTupleSize(stride,ndim)
     
     # substitute sizes if None was specified in the patchSize (meaning full dimensions)
     patchSize=tuple(p or dims[i] for i,p in enumerate(patchSize))
+    stride=tuple(s or p for s,p in zip(stride,patchSize))
     
     # collect the ranges to step over each dimension
-    ranges = tuple(starmap(range, zip(startPos, dims, patchSize)))
+    ranges = tuple(starmap(range, zip(startPos, dims, stride)))
     
     # choose patches by applying product to the ranges
     for position in product(*ranges[::-1]): # reverse ranges order to iterate in index order
         yield tuple(slice(s,s+p) for s,p in zip(position[::-1],patchSize))
         
 
+def iterWindowSlices(dims,windowSize,overlap=0.25):
+    '''
+    Yield tuples of slices defining windows of size `windowSize' which together cover all of an array of dimensions 
+    `dims', where successive windows overlap by the fraction `overlap' of the window size. Windows which would extend
+    past the end of a dimension are shifted back to end at it, so every window is inside the array if `dims' is at 
+    least `windowSize' in every dimension.
+    '''
+    ndim=len(dims)
+    windowSize=tuple(w or dims[i] for i,w in enumerate(ensureTupleSize(windowSize,ndim)))
+    stride=tuple(max(1,int(w*(1-overlap))) for w in windowSize)
+    lastPos=tuple(max(0,d-w) for d,w in zip(dims,windowSize))
+    seen=set()
+    
+    for slices in iterPatchSlices(dims,windowSize,stride=stride):
+        start=tuple(min(s.start,l) for s,l in zip(slices,lastPos))
+        
+        # skip windows which have already been produced by shifting back from the end of a dimension
+        if start not in seen: 
+            seen.add(start)
+            yield tuple(slice(s,s+w) for s,w in zip(start,windowSize))
+            
+
+def windowWeights(windowSize,mode='gaussian',sigmaScale=0.125,minWeight=1e-3):
+    '''
+    Returns a float32 array of shape `windowSize' with weights used to blend overlapping windows together. If `mode' is 
+    "constant" this is all 1, if "gaussian" it's a Gaussian centered in the window with standard deviation `sigmaScale'
+    times the window size in each dimension, normalized to a maximum of 1 and clipped below at `minWeight' so that edge
+    regions covered by only one window still have non-zero weight.
+    '''
+    if mode=='constant':
+        return np.ones(windowSize,np.float32)
+    elif mode!='gaussian':
+        raise ValueError('Unknown blend mode %r'%(mode,))
+    
+    weights=np.ones((),np.float32)
+    
+    for w in windowSize:
+        x=np.arange(w)-(w-1)/2
+        g=np.exp(-0.5*(x/max(w*sigmaScale,1e-6))**2).astype(np.float32)
+        weights=np.multiply.outer(weights,g)
+        
+    return np.maximum(weights/weights.max(),minWeight).astype(np.float32)
+    
+
 def iterPatch(arr,patchSize,startPos=(),copyBack=True,padMode='wrap',**padOpts):
     '''
     Yield successive patches from `arr' of size `patchSize'. The iteration can start from position `startPos' in `arr' 
@@ -791,6 +950,194 @@ def viewVolumeJupyter(vol,figSize=(8,8),interval=250,textSize=10):
     return HTML(ani.to_jshtml())
 
 
+_logWriters=weakref.WeakSet()
+
+@atexit.register
+def _flushLogWriters():
+    for writer in list(_logWriters):
+        writer.flush()
+
+
+class LogWriter(object):
+    '''
+    Buffered log file writer. Log messages and JSON-lines records are appended to in-memory buffers and written to their
+    files periodically by a background thread every `flushInterval' seconds, when `maxBuffered' lines are waiting, or
+    when flush() is called, so that a file is opened once per flush rather than once per message. Messages are written
+    to the file `fileName' and records to `recordFileName', either can be None in which case lines are kept buffered
+    until a file name is assigned. Messages below level `level' (using the levels of the logging module) are discarded
+    by log() without being formatted. Writers are flushed when the interpreter exits.
+    '''
+    def __init__(self,fileName=None,recordFileName=None,level=logging.DEBUG,flushInterval=1.0,maxBuffered=1000):
+        self.fileName=fileName
+        self.recordFileName=recordFileName
+        self.level=level
+        self.flushInterval=flushInterval
+        self.maxBuffered=maxBuffered
+        self.lines=[]
+        self.records=[]
+        self.lock=threading.Lock()
+        self.writeLock=threading.Lock()
+        self.stopEvent=threading.Event()
+        self.thread=None
+        _logWriters.add(self)
+        
+    def __del__(self):
+        self.close()
+        
+    def isEnabled(self,level):
+        '''Returns True if messages of level `level' are logged.'''
+        return level>=self.level
+    
+    @staticmethod
+    def _flushThread(ref,stopEvent,flushInterval):
+        # hold only a weak reference to the writer so that it can be collected while this thread runs
+        while not stopEvent.wait(flushInterval):
+            writer=ref()
+            if writer is None:
+                break
+            
+            writer.flush()
+            del writer
+            
+    def _append(self,buffer,line):
+        with self.lock:
+            buffer.append(line)
+            
+            if self.thread is None and self.flushInterval is not None:
+                args=(weakref.ref(self),self.stopEvent,self.flushInterval)
+                self.thread=threading.Thread(target=self._flushThread,args=args,daemon=True)
+                self.thread.start()
+                
+            needsFlush=len(buffer)>=self.maxBuffered
+            
+        if needsFlush:
+            self.flush()
+        
+    def log(self,*items,level=logging.INFO):
+        '''Log a message composed of the string forms of `items' prefixed with a timestamp if `level' is enabled.'''
+        if self.isEnabled(level):
+            dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
+            self._append(self.lines,dt+' '.join(map(str,items)))
+        
+    def record(self,**values):
+        '''Write `values' as a JSON record with an added "time" value, this does nothing if self.recordFileName is None.'''
+        if self.recordFileName is not None:
+            values['time']=time.time()
+            self._append(self.records,json.dumps(values,default=str))
+            
+    def _write(self,fileName,buffer):
+        if fileName is not None and buffer:
+            with open(fileName,'a') as o:
+                o.write('\n'.join(buffer)+'\n')
+        
+    def flush(self):
+        '''Write all buffered lines to their files if these are given.'''
+        with self.writeLock:
+            # swap out the buffers so that logging isn't blocked while writing
+            with self.lock:
+                lines=self.lines if self.fileName is not None else []
+                records=self.records if self.recordFileName is not None else []
+                self.lines=[] if lines else self.lines
+                self.records=[] if records else self.records
+                fileName=self.fileName
+                recordFileName=self.recordFileName
+                
+            self._write(fileName,lines)
+            self._write(recordFileName,records)
+            
+    def close(self):
+        '''Stop the flushing thread and flush remaining lines.'''
+        self.stopEvent.set()
+        
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+            
+        self.flush()
+
+
+class PhaseTimer(object):
+    '''
+    Records the wall time spent in named phases of a repeated process such as a training step. Times for phases in the
+    current step are accumulated with phase() or add(), then endStep() stores these in rolling histories of the last 
+    `historyLen' steps for each phase from which statistics and histograms are computed. If `syncFunc' is given it's 
+    called before starting and ending each phase timing, eg. to synchronize a GPU whose operations are asynchronous. If
+    `enabled' is False phase() does nothing and nothing is recorded.
+    '''
+    def __init__(self,historyLen=1000,syncFunc=None,enabled=True):
+        self.historyLen=historyLen
+        self.syncFunc=syncFunc
+        self.enabled=enabled
+        self.history=OrderedDict()
+        self.current=OrderedDict()
+        self.lastStep=OrderedDict()
+        self.lock=threading.Lock()
+        
+    @contextlib.contextmanager
+    def phase(self,name):
+        '''Context manager adding the time spent in its block to phase `name' of the current step.'''
+        if not self.enabled:
+            yield
+            return
+        
+        if self.syncFunc is not None:
+            self.syncFunc()
+            
+        start=time.perf_counter()
+        
+        try:
+            yield
+        finally:
+            if self.syncFunc is not None:
+                self.syncFunc()
+                
+            self.add(name,time.perf_counter()-start)
+            
+    def add(self,name,duration):
+        '''Add `duration' seconds to phase `name' of the current step.'''
+        if self.enabled:
+            with self.lock:
+                self.current[name]=self.current.get(name,0.0)+duration
+            
+    def endStep(self):
+        '''Store the phase times of the current step in the histories and start a new step, returning the stored times.'''
+        with self.lock:
+            times,self.current=self.current,OrderedDict()
+            
+            for name,duration in times.items():
+                self.history.setdefault(name,deque(maxlen=self.historyLen)).append(duration)
+                
+            self.lastStep=times
+            return times
+        
+    def getStats(self):
+        '''Returns a dictionary mapping each phase name to a dictionary of mean, median, 95th percentile, and max times.'''
+        stats=OrderedDict()
+        
+        with self.lock:
+            for name,hist in self.history.items():
+                vals=np.asarray(hist)
+                stats[name]={
+                    'mean':float(vals.mean()),
+                    'median':float(np.median(vals)),
+                    'p95':float(np.percentile(vals,95)),
+                    'max':float(vals.max())
+                }
+            
+        return stats
+    
+    def getHistogram(self,name,bins=20):
+        '''Returns the histogram counts and bin edges of the time history for phase `name'.'''
+        with self.lock:
+            return np.histogram(np.asarray(self.history[name]),bins)
+        
+    def reset(self):
+        '''Clear all recorded times.'''
+        with self.lock:
+            self.history.clear()
+            self.current.clear()
+            self.lastStep=OrderedDict()
+
+
 class JupyterThreadMonitor(threading.Thread):
     def __init__(self,*args,**kwargs):
         threading.Thread.__init__(self,*args,**kwargs)